@@ -0,0 +1,84 @@
+"""
+Compares merging file lists with the old list scans against the Catalog used by merge_files.
+
+Every round merges the lists of a number of peers, each sharing the same number of files, into an empty list or
+catalog, like a new user receiving the files of everyone on the network. The list merge checks every received file
+against every file already known, so it is only run up to --list-limit files.
+
+Run from the Source folder (the same folder run.py is run from):
+    python -m Benchmarks.benchmark_catalog [files per peer] [peers] [list limit]
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Classes import Catalog, File
+
+import sys
+import time
+
+
+def legacy_merge(client_file_list: list[File], file_list: list[File], current_files: list[str]):
+    """
+    The list comprehension merge_files used before the catalog was introduced
+    """
+    new_files = [
+        f for f in client_file_list
+        if not any(sf.filename == f.filename and sf.addr == f.addr for sf in file_list)
+        and f.filename not in current_files
+    ]
+    file_list.extend(new_files)
+
+
+def catalog_merge(client_file_list: list[File], file_catalog: Catalog, current_files: frozenset[str]):
+    file_catalog.merge(client_file_list, skip_filenames=current_files)
+
+
+def make_peer_lists(files_per_peer: int, peers: int) -> list[list[File]]:
+    """
+    Half of the files of every peer are shared by all peers, the other half are the peer's own
+    """
+    peer_lists: list[list[File]] = []
+    for peer in range(peers):
+        addr: tuple[str, int] = ('127.0.0.1', 10000 + peer)
+        shared: list[File] = [File(f"shared_{i}.bin", f"user{peer}", addr) for i in range(files_per_peer // 2)]
+        own: list[File] = [File(f"peer{peer}_{i}.bin", f"user{peer}", addr)
+                           for i in range(files_per_peer - files_per_peer // 2)]
+        peer_lists.append(shared + own)
+    return peer_lists
+
+
+def time_merge(peer_lists: list[list[File]], merge, destination, current_files) -> float:
+    start: float = time.perf_counter()
+    for client_file_list in peer_lists:
+        merge(client_file_list, destination, current_files)
+    return time.perf_counter() - start
+
+
+def main():
+    files_per_peer: int = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    peers: int = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    list_limit: int = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+
+    print(f"Merging the files of {peers} peers into an empty catalog")
+    size: int = max(files_per_peer // 8, 1)
+    while True:
+        size = min(size, files_per_peer)
+        peer_lists: list[list[File]] = make_peer_lists(size, peers)
+        current_files: list[str] = [f"local_{i}.bin" for i in range(100)]
+        total: int = size * peers
+
+        catalog_time: float = time_merge(peer_lists, catalog_merge, Catalog(), frozenset(current_files))
+        if total <= list_limit:
+            list_time: float = time_merge(peer_lists, legacy_merge, [], current_files)
+            print(f"{total:>9} files: list {list_time * 1000:10.1f} ms   catalog {catalog_time * 1000:8.1f} ms"
+                  f"   {list_time / catalog_time:8.0f}x")
+        else:
+            print(f"{total:>9} files: list {'(skipped)':>13}   catalog {catalog_time * 1000:8.1f} ms")
+
+        if size == files_per_peer:
+            break
+        size *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Measures how fast files are cut in to chunks, and how much of a changed copy of a file has to be sent when the
+receiver already has the old one (DownloadFileChunks and SyncFileUpdateChunks) instead of the whole file.
+
+Run from the Source folder (the same folder run.py is run from):
+    python -m Benchmarks.benchmark_chunks [file size in MiB]
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Chunk_Functions as CH
+
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+def edits(data: bytes) -> list[tuple[str, bytes]]:
+    middle: int = len(data) // 2
+    return [("8 bytes overwritten", data[:middle] + b'changed!' + data[middle + 8:]),
+            ("100 bytes inserted", data[:middle] + os.urandom(100) + data[middle:]),
+            ("first 4 KiB removed", data[4096:]),
+            ("10 scattered inserts", scattered_inserts(data, 10)),
+            ("unrelated data", os.urandom(len(data)))]
+
+
+def scattered_inserts(data: bytes, count: int) -> bytes:
+    positions: list[int] = sorted(random.Random(count).sample(range(len(data)), count))
+    parts: list[bytes] = []
+    previous: int = 0
+    for position in positions:
+        parts.append(data[previous:position])
+        parts.append(b'inserted')
+        previous = position
+    parts.append(data[previous:])
+    return b''.join(parts)
+
+
+def chunk_bytes(data: bytes) -> dict[bytes, int]:
+    boundaries: list[int] = CH.chunk_boundaries(data)
+    return {CH.chunk_hash(data[start:end]): end - start for start, end in zip([0] + boundaries, boundaries)}
+
+
+def main():
+    size: int = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 32 * 1024 * 1024
+    data: bytes = os.urandom(size)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_path: Path = Path(directory) / 'original.bin'
+        file_path.write_bytes(data)
+        start: float = time.perf_counter()
+        _, chunks = CH.chunk_file(file_path)
+        elapsed: float = time.perf_counter() - start
+    print(f"chunk_file: {size // 1024 ** 2} MiB in {elapsed * 1000:.0f} ms ({size / elapsed / 1024 ** 2:.0f} MiB/s), "
+          f"{len(chunks)} chunks of {size // len(chunks)} bytes on average")
+
+    old_chunks: dict[bytes, int] = chunk_bytes(data)
+    for name, new_data in edits(data):
+        new_chunks: dict[bytes, int] = chunk_bytes(new_data)
+        sent: int = sum(length for chunk_hash, length in new_chunks.items() if chunk_hash not in old_chunks)
+        recipe: int = len(CH.encode_recipe(len(new_data), '00' * CH.FILE_HASH_SIZE, list(new_chunks.items())))
+        print(f"{name:>22}: {sent:>10} bytes of chunks + {recipe:>7} bytes of recipe "
+              f"({(sent + recipe) / len(new_data):7.2%} of the file)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Compares the JSON and binary payload encodings on large peer lists, file catalogs and sync file lists.
+
+Run from the Source folder (the same folder run.py is run from):
+    python -m Benchmarks.benchmark_codec [peers] [files per peer] [rounds]
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Classes import File, Peer, SyncFile
+# noinspection PyUnresolvedReferences
+from Constants import BINARY_CODEC, JSON_CODEC
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+
+import sys
+import time
+
+
+def make_payloads(peer_count: int, files_per_peer: int) -> list[tuple[str, type, list]]:
+    """
+    A peer list, the files of every peer, and sync files that every tenth peer is subscribed to
+    """
+    peers: list[Peer] = [Peer((f"10.0.{i // 250}.{i % 250 + 1}", 5000 + i % 1000), f"user{i}")
+                         for i in range(peer_count)]
+    files: list[File] = [File(f"document_{i}_{j}.pdf", peer.username, peer.addr)
+                         for i, peer in enumerate(peers) for j in range(files_per_peer)]
+    sync_files: list[SyncFile] = [SyncFile(f"shared_{i}.txt", peers[i % 10::10]) for i in range(files_per_peer * 10)]
+
+    return [(f"{peer_count} peers", Peer, peers),
+            (f"{len(files)} files", File, files),
+            (f"{len(sync_files)} sync files", SyncFile, sync_files)]
+
+
+def best_time(function, rounds: int) -> float:
+    best: float = float('inf')
+    for _ in range(rounds):
+        start: float = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    peer_count: int = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    files_per_peer: int = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rounds: int = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    print(f"Best of {rounds} rounds")
+    for name, object_class, objects in make_payloads(peer_count, files_per_peer):
+        print(name)
+        for codec in (JSON_CODEC, BINARY_CODEC):
+            payload: bytes = FF.encode_object_list(objects, codec)
+            assert FF.decode_object_list(payload, object_class) == objects
+
+            encode_time: float = best_time(lambda: FF.encode_object_list(objects, codec), rounds)
+            decode_time: float = best_time(lambda: FF.decode_object_list(payload, object_class), rounds)
+            print(f"{codec:>12}: {len(payload):>10} bytes  encode {encode_time * 1000:8.1f} ms"
+                  f"  decode {decode_time * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
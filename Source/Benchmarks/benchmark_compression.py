@@ -0,0 +1,86 @@
+"""
+Compares the compression algorithms peers can agree on (see Compression_Functions) on the kinds of data they send: a
+catalog payload in both encodings, a text file, and data that doesn't compress (like a JPEG or an archive). For each
+it prints the size after compression and how fast it compresses, next to what choose_file_compression and
+compress_payload would pick.
+
+Run from the Source folder (the same folder run.py is run from):
+    python -m Benchmarks.benchmark_compression [file size in MiB]
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Classes import File, DiskStorage
+# noinspection PyUnresolvedReferences
+from Constants import JSON_CODEC, BINARY_CODEC, WIRE_COMPRESSIONS
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Compression_Functions as CP
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+
+from pathlib import Path
+import os
+import sys
+import tempfile
+import time
+
+
+class AgreedConnection:
+    """
+    Stands in for a connection whose peer agreed on every algorithm, for compress_payload
+    """
+    compressions: tuple[str, ...] = WIRE_COMPRESSIONS
+
+
+def text_data(size: int) -> bytes:
+    lines: list[bytes] = []
+    total: int = 0
+    line_number: int = 0
+    while total < size:
+        line: bytes = (f"{line_number}: the peer at 10.0.{line_number % 256}.{line_number % 97} shares "
+                       f"notes_{line_number}.txt, updated {line_number * 37 % 86400} seconds ago\n").encode('utf-8')
+        lines.append(line)
+        total += len(line)
+        line_number += 1
+    return b''.join(lines)[:size]
+
+
+def measure(name: str, data: bytes):
+    for algorithm in WIRE_COMPRESSIONS:
+        start: float = time.perf_counter()
+        compressed: bytes = CP.compress(data, algorithm)
+        elapsed: float = time.perf_counter() - start
+        ratio: float = len(compressed) / len(data)
+        print(f"{name:>19} {algorithm:>4}: {len(data):>10} -> {len(compressed):>10} bytes ({ratio:6.1%})  "
+              f"{len(data) / elapsed / 1024 ** 2:8.1f} MiB/s")
+
+
+def main():
+    size: int = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 8 * 1024 * 1024
+
+    files: list[File] = [File(f"shared_file_{i}.txt", f"user_{i % 50}", ('10.0.0.1', 5000 + i % 50))
+                         for i in range(5000)]
+    for codec in (JSON_CODEC, BINARY_CODEC):
+        payload: bytes = FF.encode_object_list(files, codec)
+        measure(f"catalog ({codec})", payload)
+        sent: bytes = CP.compress_payload(AgreedConnection(), payload)
+        print(f"{'compress_payload':>24}: {len(sent)} bytes")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, data, suffix in (("text file", text_data(size), '.txt'),
+                                   ("random file", os.urandom(size), '.bin'),
+                                   ("random, as .jpg", os.urandom(size), '.jpg')):
+            file_path: Path = Path(directory) / f"sample{suffix}"
+            file_path.write_bytes(data)
+            if suffix != '.jpg':
+                measure(name, data)
+            start: float = time.perf_counter()
+            chosen: str | None = CP.choose_file_compression(DiskStorage(Path(directory)), file_path.name, len(data),
+                                                            WIRE_COMPRESSIONS)
+            elapsed: float = time.perf_counter() - start
+            print(f"{'choose_file_compression':>24}: {chosen or 'none'} (decided in {elapsed * 1000:.1f} ms)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Compares ways of hashing a folder of SyncFiles: MD5 read BUFFER_SIZE bytes at a time one file after another (how
+SyncFiles used to be hashed), BLAKE2b read HASH_READ_SIZE bytes at a time, the same on HASH_THREADS threads, and a
+restart where every hash comes from the cache file.
+
+Run from the Source folder (the same folder run.py is run from):
+    python -m Benchmarks.benchmark_hash [files] [file size in KiB]
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Classes import HashCache
+# noinspection PyUnresolvedReferences
+from Constants import BUFFER_SIZE, HASH_THREADS
+
+from pathlib import Path
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+
+def md5_file(file_path: Path) -> str:
+    hasher = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        while True:
+            data = file.read(BUFFER_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def make_files(directory: Path, count: int, size: int) -> list[Path]:
+    file_paths: list[Path] = []
+    for i in range(count):
+        file_path: Path = directory / f"shared_{i}.bin"
+        file_path.write_bytes(os.urandom(size))
+        file_paths.append(file_path)
+
+    # Old enough that the cache trusts the hashes it records
+    old: int = time.time_ns() - 10 * HashCache.RACY_WINDOW_NS
+    for file_path in file_paths:
+        os.utime(file_path, ns=(old, old))
+    return file_paths
+
+
+def timed(name: str, function, total_size: int):
+    start: float = time.perf_counter()
+    function()
+    elapsed: float = time.perf_counter() - start
+    print(f"{name:>34}: {elapsed * 1000:9.1f} ms  {total_size / elapsed / 1024 ** 2:9.1f} MiB/s")
+
+
+def main():
+    count: int = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size: int = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 4 * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory_path: Path = Path(directory)
+        file_paths: list[Path] = make_files(directory_path, count, size)
+        cache_path: Path = directory_path / 'hashes.json'
+        total_size: int = count * size
+        print(f"{count} files of {size // 1024} KiB (the operating system has them cached)")
+
+        timed("MD5, one file at a time", lambda: [md5_file(file_path) for file_path in file_paths], total_size)
+        timed("BLAKE2b, one file at a time",
+              lambda: HashCache(cache_path).hash_files(file_paths, threads=1), total_size)
+        cache: HashCache = HashCache(cache_path)
+        timed(f"BLAKE2b, {HASH_THREADS} threads", lambda: cache.hash_files(file_paths), total_size)
+        cache.save()
+        timed("restart, hashes from the cache", lambda: HashCache(cache_path).hash_files(file_paths), total_size)
+
+
+if __name__ == '__main__':
+    main()
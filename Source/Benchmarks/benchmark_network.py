@@ -0,0 +1,199 @@
+"""
+Starts whole peers on 127.0.0.1 (each in a process and folder of its own, see loopback_peer) and measures what users
+wait for:
+    - download: how fast a file is downloaded from another peer (option 2), for files of different sizes
+    - join: how long initial_connection takes for the newest peer as the network grows to the given amount of peers
+    - sync_update: how long it takes a changed SyncFile to reach every subscriber (option 4), as subscribers are added
+    - catalog: how long it takes to receive and merge the file catalog of a peer sharing more and more files
+
+The results are printed and written as JSON, together with the commit they were measured on, so runs on different
+commits can be compared.
+
+Run from the Source folder (the same folder run.py is run from):
+    python -m Benchmarks.benchmark_network [output file] [peers] [threads|asyncio]
+"""
+from __future__ import annotations
+
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SOURCE_DIRECTORY: Path = Path(__file__).resolve().parent.parent
+
+DOWNLOAD_SIZES: tuple[int, ...] = (64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+DOWNLOAD_ROUNDS: int = 3
+SYNC_FILE_SIZE: int = 4 * 1024 * 1024
+SYNC_CHANGED_BYTES: int = 64 * 1024
+CATALOG_SIZES: tuple[int, ...] = (100, 1000, 10000)
+
+
+class LoopbackPeer:
+    """
+    A loopback_peer process, asked to do things with call
+    """
+
+    def __init__(self, directory: Path, engine: str):
+        self.directory: Path = directory
+        (directory / 'Files').mkdir(parents=True, exist_ok=True)
+        (directory / 'SyncFiles').mkdir(exist_ok=True)
+        self.port: int = free_port()
+
+        environment: dict[str, str] = dict(os.environ, PYTHONPATH=str(SOURCE_DIRECTORY))
+        self.process: subprocess.Popen = subprocess.Popen(
+            [sys.executable, '-m', 'Benchmarks.loopback_peer', str(self.port), engine], cwd=directory,
+            env=environment, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        self.read_answer()
+
+    def read_answer(self) -> dict:
+        line: str = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"The peer on port {self.port} stopped")
+        result: dict = json.loads(line)
+        if 'error' in result:
+            raise RuntimeError(f"The peer on port {self.port} failed: {result['error']}")
+        return result
+
+    def call(self, command: str, **arguments) -> dict:
+        self.process.stdin.write(json.dumps({'command': command, **arguments}) + '\n')
+        self.process.stdin.flush()
+        return self.read_answer()
+
+    def stop(self):
+        try:
+            self.process.stdin.write(json.dumps({'command': 'exit'}) + '\n')
+            self.process.stdin.close()
+            self.process.wait(5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SOURCE_DIRECTORY, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_download(directory: Path, engine: str) -> list[dict]:
+    owner_directory: Path = directory / 'download_owner'
+    (owner_directory / 'Files').mkdir(parents=True)
+    for size in DOWNLOAD_SIZES:
+        (owner_directory / 'Files' / f'{size}.bin').write_bytes(os.urandom(size))
+
+    owner: LoopbackPeer = LoopbackPeer(owner_directory, engine)
+    downloader: LoopbackPeer = LoopbackPeer(directory / 'downloader', engine)
+    try:
+        downloader.call('join', port=owner.port)
+
+        results: list[dict] = []
+        for size in DOWNLOAD_SIZES:
+            seconds: list[float] = []
+            for _ in range(DOWNLOAD_ROUNDS):
+                result: dict = downloader.call('download', filename=f'{size}.bin')
+                if not result['downloaded'] or result['size'] != size:
+                    raise RuntimeError(f"The download of {size} bytes failed")
+                seconds.append(result['seconds'])
+
+            median: float = statistics.median(seconds)
+            results.append({'size': size, 'seconds': seconds, 'mib_per_second': size / median / 1024 ** 2})
+            print(f"download {size / 1024 ** 2:8.2f} MiB: {median * 1000:8.1f} ms "
+                  f"({size / median / 1024 ** 2:8.1f} MiB/s)")
+        return results
+    finally:
+        downloader.stop()
+        owner.stop()
+
+
+def benchmark_join_and_sync(directory: Path, engine: str, peer_count: int) -> tuple[list[dict], list[dict]]:
+    """
+    Peers join one at a time, each subscribing to the first peer's SyncFile once it has joined. The first peer sends an
+    update every time the subscribers have doubled
+    """
+    first_directory: Path = directory / 'peer0'
+    (first_directory / 'SyncFiles').mkdir(parents=True)
+    (first_directory / 'SyncFiles' / 'shared.bin').write_bytes(os.urandom(SYNC_FILE_SIZE))
+
+    peers: list[LoopbackPeer] = [LoopbackPeer(first_directory, engine)]
+    joins: list[dict] = []
+    updates: list[dict] = []
+    try:
+        for index in range(1, peer_count):
+            peer: LoopbackPeer = LoopbackPeer(directory / f'peer{index}', engine)
+            peers.append(peer)
+
+            result: dict = peer.call('join', port=peers[0].port)
+            joins.append({'peers': index + 1, 'seconds': result['seconds']})
+            print(f"join     {index + 1:5} peers: {result['seconds'] * 1000:8.1f} ms")
+
+            peer.call('subscribe', filename='shared.bin')
+            if index & (index - 1) == 0:
+                result = peers[0].call('update', filename='shared.bin', changed_bytes=SYNC_CHANGED_BYTES)
+                updates.append({'subscribers': result['subscribers'], 'seconds': result['seconds']})
+                print(f"update   {result['subscribers']:5} subscribers: {result['seconds'] * 1000:8.1f} ms")
+        return joins, updates
+    finally:
+        for peer in peers:
+            peer.stop()
+
+
+def benchmark_catalog(directory: Path, engine: str) -> list[dict]:
+    client: LoopbackPeer = LoopbackPeer(directory / 'catalog_client', engine)
+    results: list[dict] = []
+    try:
+        for file_count in CATALOG_SIZES:
+            owner_directory: Path = directory / f'catalog_owner_{file_count}'
+            (owner_directory / 'Files').mkdir(parents=True)
+            for i in range(file_count):
+                (owner_directory / 'Files' / f'file_{i}.txt').touch()
+
+            owner: LoopbackPeer = LoopbackPeer(owner_directory, engine)
+            try:
+                result: dict = client.call('catalog', port=owner.port)
+            finally:
+                owner.stop()
+
+            results.append({'files': result['files'], 'request_seconds': result['request_seconds'],
+                            'merge_seconds': result['merge_seconds']})
+            print(f"catalog  {file_count:5} files: {result['request_seconds'] * 1000:8.1f} ms to receive, "
+                  f"{result['merge_seconds'] * 1000:8.1f} ms to merge")
+        return results
+    finally:
+        client.stop()
+
+
+def main():
+    output_path: Path = Path(sys.argv[1]) if len(sys.argv) > 1 else Path('benchmark_network.json')
+    peer_count: int = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    engine: str = sys.argv[3] if len(sys.argv) > 3 else 'threads'
+
+    results: dict = {'commit': current_commit(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'engine': engine,
+                     'measured_at': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+    with tempfile.TemporaryDirectory() as directory:
+        results['download'] = benchmark_download(Path(directory), engine)
+        results['join'], results['sync_update'] = benchmark_join_and_sync(Path(directory), engine, peer_count)
+        results['catalog'] = benchmark_catalog(Path(directory), engine)
+
+    output_path.write_text(json.dumps(results, indent=2) + '\n')
+    print(f"Results written to {output_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Compares the old BUFFER_SIZE read/sendall loop against send_file_contents (socket.sendfile) on loopback.
+
+Run from the Source folder (the same folder run.py is run from):
+    python -m Benchmarks.benchmark_sendfile [size in MB] [rounds]
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import BUFFER_SIZE
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+def legacy_send(connection_socket: socket.socket, file_path: Path, file_size: int) -> None:
+    """
+    The loop send_full_file used before sendfile was introduced
+    """
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(BUFFER_SIZE)
+            if not data:
+                break
+            connection_socket.sendall(data)
+
+
+def drain(listening_socket: socket.socket, file_size: int, done: threading.Event) -> None:
+    """
+    Accepts one connection and throws away file_size bytes
+    """
+    conn, _ = listening_socket.accept()
+    with conn:
+        view = memoryview(bytearray(1 << 20))
+        received_size: int = 0
+        while received_size < file_size:
+            received = conn.recv_into(view)
+            if not received:
+                break
+            received_size += received
+    done.set()
+
+
+def run_round(send_function, file_path: Path, file_size: int) -> tuple[float, float]:
+    """
+    Sends the file once over loopback
+    :return: (wall seconds, sender thread cpu seconds)
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listening_socket:
+        listening_socket.bind(('127.0.0.1', 0))
+        listening_socket.listen(1)
+
+        done: threading.Event = threading.Event()
+        receiver: threading.Thread = threading.Thread(target=drain, args=(listening_socket, file_size, done))
+        receiver.start()
+
+        with socket.create_connection(listening_socket.getsockname()) as sender_socket:
+            wall_start: float = time.perf_counter()
+            cpu_start: float = time.thread_time()
+            send_function(sender_socket, file_path, file_size)
+            cpu_time: float = time.thread_time() - cpu_start
+            done.wait()
+            wall_time: float = time.perf_counter() - wall_start
+
+        receiver.join()
+
+    return wall_time, cpu_time
+
+
+def main():
+    size_mb: int = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    rounds: int = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    file_size: int = size_mb * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        file_path: Path = Path(temp_directory) / 'payload.bin'
+        with open(file_path, 'wb') as f:
+            block: bytes = os.urandom(1024 * 1024)
+            for _ in range(size_mb):
+                f.write(block)
+
+        print(f"Sending {size_mb} MB over loopback, best of {rounds} rounds")
+        for name, send_function in (('read/sendall loop', legacy_send), ('sendfile', FF.send_file_contents)):
+            results = [run_round(send_function, file_path, file_size) for _ in range(rounds)]
+            wall_time, cpu_time = min(results)
+            gigabytes: float = file_size / (1024 ** 3)
+            print(f"{name:>18}: {size_mb / wall_time:9.1f} MB/s  {cpu_time / gigabytes:6.3f} cpu s/GB")
+
+
+if __name__ == '__main__':
+    main()
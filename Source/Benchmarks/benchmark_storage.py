@@ -0,0 +1,78 @@
+"""
+Compares ways of sending a file on a multiplexed stream, where sendfile can't be used: reading it in to bytes a frame at
+a time (MuxStream.sendfile, how files were sent before storages), reading it in to a reused buffer (DiskStorage) and
+views of the file held in memory (MemoryStorage).
+
+Run from the Source folder (the same folder run.py is run from):
+    python -m Benchmarks.benchmark_storage [size in MiB] [rounds]
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Classes import DiskStorage, MemoryStorage, MuxSession, MuxStream
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+def drain(stream: MuxStream, file_size: int, done: threading.Event):
+    received_size: int = 0
+    while received_size < file_size:
+        data: bytes = stream.recv(1 << 20)
+        if not data:
+            break
+        received_size += len(data)
+    stream.close()
+    done.set()
+
+
+def main():
+    file_size: int = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 256 * 1024 * 1024
+    rounds: int = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    data: bytes = os.urandom(file_size)
+    done: threading.Event = threading.Event()
+
+    with socket.create_server(('127.0.0.1', 0)) as listening_socket:
+        client_socket: socket.socket = socket.create_connection(listening_socket.getsockname())
+        server_socket, _ = listening_socket.accept()
+    server: MuxSession = MuxSession(server_socket, is_client=False,
+                                    on_new_stream=lambda stream: threading.Thread(target=drain,
+                                                                                  args=(stream, file_size, done),
+                                                                                  daemon=True).start())
+    threading.Thread(target=server.run, daemon=True).start()
+    client: MuxSession = MuxSession(client_socket, is_client=True)
+    client.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        Path(directory, 'sample.bin').write_bytes(data)
+        disk: DiskStorage = DiskStorage(Path(directory))
+        memory: MemoryStorage = MemoryStorage({'sample.bin': data})
+
+        def read_into_bytes(stream: MuxStream):
+            with open(disk.path('sample.bin'), 'rb') as f:
+                stream.sendfile(f, 0, file_size)
+
+        for name, send in (("read in to bytes", read_into_bytes),
+                           ("DiskStorage", lambda stream: disk.send_range(stream, 'sample.bin', 0, file_size)),
+                           ("MemoryStorage", lambda stream: memory.send_range(stream, 'sample.bin', 0, file_size))):
+            best: float = float('inf')
+            for _ in range(rounds):
+                done.clear()
+                stream: MuxStream = client.open_stream()
+                start: float = time.perf_counter()
+                send(stream)
+                done.wait()
+                best = min(best, time.perf_counter() - start)
+                stream.close()
+            print(f"{name:>17}: {file_size / best / 1024 ** 2:8.1f} MiB/s")
+
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+One peer of benchmark_network. It runs the same server as run.py (in the folder it is started in, which has its own
+Files and SyncFiles) and does what the benchmark asks it to, one JSON object per line on stdin, answering each with
+one JSON object per line on stdout. Everything the program prints goes to stderr, so it can't get mixed in.
+
+Started by benchmark_network, from the peer's folder, with the Source folder on PYTHONPATH:
+    python -m Benchmarks.loopback_peer <port> [threads|asyncio]
+"""
+from __future__ import annotations
+
+import run
+# noinspection PyUnresolvedReferences
+from Classes import Catalog, File
+# noinspection PyUnresolvedReferences
+from Classes.CRequest import CRequest
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+ANSWERS = sys.stdout
+
+
+def answer(result: dict):
+    ANSWERS.write(json.dumps(result) + '\n')
+    ANSWERS.flush()
+
+
+def wait_for_server(port: int, timeout: float = 10):
+    deadline: float = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def this_peer() -> run.Peer:
+    return run.Peer((run.G_USER_IP, run.G_USER_PORT), run.G_USER_USERNAME)
+
+
+def join(port: int) -> dict:
+    """
+    What run.main does before showing the menu: AddMe, then the peer list and catalogs from every peer
+    """
+    run.g_server_ip, run.g_server_port = '127.0.0.1', port
+    start: float = time.perf_counter()
+    run.initial_connection()
+    return {'seconds': time.perf_counter() - start, 'peers': len(run.g_peer_list)}
+
+
+def download(filename: str) -> dict:
+    """
+    Downloads the file the way option 2 does for a file with one owner, then deletes it so it can be downloaded again
+    """
+    file: File = run.g_available_files.with_filename(filename)[0]
+    start: float = time.perf_counter()
+    downloaded: bool = FF.download_file(file, file.addr)
+    seconds: float = time.perf_counter() - start
+
+    file_path = FF.FILES_DIRECTORY / filename
+    size: int = file_path.stat().st_size if downloaded else 0
+    file_path.unlink(missing_ok=True)
+    return {'seconds': seconds, 'downloaded': downloaded, 'size': size}
+
+
+def subscribe(filename: str) -> dict:
+    sync_file = next(sync_file for sync_file in run.g_available_sync_files if sync_file.filename == filename)
+    start: float = time.perf_counter()
+    FF.subscribe_to_file(sync_file, this_peer(), sync_file.users_subbed[0].addr)
+    run.g_available_sync_files.remove(sync_file)
+    run.g_subscribed_sync_files.add(sync_file)
+    return {'seconds': time.perf_counter() - start}
+
+
+def update(filename: str, changed_bytes: int) -> dict:
+    """
+    Changes changed_bytes in the middle of the SyncFile and sends the update to every subscriber, the way option 4
+    does. send_sync_file_update returns once every subscriber has the new copy
+    """
+    file_path = FF.SYNC_FILES_DIRECTORY / filename
+    with open(file_path, 'r+b') as f:
+        f.seek(max(0, file_path.stat().st_size // 2 - changed_bytes // 2))
+        f.write(os.urandom(changed_bytes))
+
+    sync_file = next(sync_file for sync_file in run.g_subscribed_sync_files if sync_file.filename == filename)
+    subscribers: list = [peer for peer in sync_file.users_subbed if peer != this_peer()]
+    start: float = time.perf_counter()
+    FF.send_sync_file_update(sync_file, subscribers)
+    return {'seconds': time.perf_counter() - start, 'subscribers': len(subscribers)}
+
+
+def catalog(port: int) -> dict:
+    """
+    Asks the peer at port for its whole file catalog, and merges it in to an empty one
+    """
+    start: float = time.perf_counter()
+    files: list[File] = FF.request_catalog(('127.0.0.1', port), CRequest.RequestFiles, File, 60)
+    received: float = time.perf_counter()
+    FF.merge_files(files, Catalog())
+    return {'request_seconds': received - start, 'merge_seconds': time.perf_counter() - received,
+            'files': len(files)}
+
+
+COMMANDS: dict = {'join': join, 'download': download, 'subscribe': subscribe, 'update': update, 'catalog': catalog}
+
+
+def main():
+    global ANSWERS
+    ANSWERS, sys.stdout = sys.stdout, sys.stderr
+
+    port: int = int(sys.argv[1])
+    run.G_USER_IP, run.G_USER_PORT, run.G_USER_USERNAME = '127.0.0.1', port, f'bench{port}'
+    run.G_SERVER_ENGINE = sys.argv[2] if len(sys.argv) > 2 else 'threads'
+    # Nobody is at the keyboard to say the second user is there
+    run.first_user_wait = lambda: None
+
+    threading.Thread(target=run.run_server, daemon=True).start()
+    wait_for_server(port)
+    answer({'ready': True})
+
+    for line in sys.stdin:
+        command: dict = json.loads(line)
+        name: str = command.pop('command')
+        if name == 'exit':
+            break
+        try:
+            answer(COMMANDS[name](**command))
+        except Exception as e:
+            answer({'error': repr(e)})
+
+
+if __name__ == '__main__':
+    main()
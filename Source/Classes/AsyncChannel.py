@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import (BUFFER_SIZE,
+                       JSON_CODEC)
+
+import asyncio
+import os
+import stat
+
+
+class AsyncChannel:
+    """
+    One connection accepted by the AsyncServer. It wraps the asyncio streams of the connection with the same calls the
+    request handlers use on a socket (recv, sendall, sendfile), except that they have to be awaited.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader: asyncio.StreamReader = reader
+        self.writer: asyncio.StreamWriter = writer
+        self.addr: tuple[str, int] | None = writer.get_extra_info('peername')
+        self.bytes_received: int = 0
+        self.bytes_sent: int = 0
+
+    async def recv(self, size: int) -> bytes:
+        """
+        :return: up to size bytes, or b'' once the client has closed the connection
+        """
+        data: bytes = await self.reader.read(size)
+        self.bytes_received += len(data)
+        return data
+
+    async def recv_exactly(self, size: int) -> bytes:
+        try:
+            data: bytes = await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            self.bytes_received += len(e.partial)
+            raise ConnectionError(f"Connection closed after {len(e.partial)} of {size} bytes") from None
+        self.bytes_received += size
+        return data
+
+    async def sendall(self, data):
+        self.writer.write(data)
+        self.bytes_sent += memoryview(data).nbytes
+        await self.writer.drain()
+
+    async def sendfile(self, file, offset: int = 0, count: int | None = None) -> int:
+        """
+        Regular files are sent with the loop's sendfile, which hands them to the kernel the same way socket.sendfile
+        does for the threaded server
+        """
+        if stat.S_ISREG(os.fstat(file.fileno()).st_mode):
+            sent: int = await asyncio.get_running_loop().sendfile(self.writer.transport, file, offset, count)
+            self.bytes_sent += sent
+            return sent
+
+        # Non-regular files can't seek, so skip ahead by reading
+        while offset > 0:
+            skipped: bytes = file.read(min(BUFFER_SIZE, offset))
+            if not skipped:
+                return 0
+            offset -= len(skipped)
+
+        sent_size: int = 0
+        while count is None or sent_size < count:
+            data: bytes = file.read(BUFFER_SIZE if count is None else min(BUFFER_SIZE, count - sent_size))
+            if not data:
+                break
+            await self.sendall(data)
+            sent_size += len(data)
+        return sent_size
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class BlockingChannel:
+    """
+    Lets blocking code running on a worker thread use an AsyncChannel (or AsyncMuxStream) as if it were a socket.
+    Every call is run on the event loop and waited for, so the request handlers of Server can be reused as they are
+    for the few requests that do a lot of blocking work (disk I/O, hashing, contacting other peers).
+    """
+
+    def __init__(self, channel, loop: asyncio.AbstractEventLoop):
+        self.channel = channel
+        self.loop: asyncio.AbstractEventLoop = loop
+        self.timeout: float | None = None
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(self.timeout)
+
+    @property
+    def codec(self) -> str:
+        return getattr(self.channel, 'codec', JSON_CODEC)
+
+    @property
+    def compressions(self) -> tuple[str, ...]:
+        return getattr(self.channel, 'compressions', ())
+
+    @property
+    def peer_addr(self) -> tuple[str, int] | None:
+        return getattr(self.channel, 'peer_addr', None) or getattr(self.channel, 'addr', None)
+
+    @property
+    def bytes_received(self) -> int:
+        return getattr(self.channel, 'bytes_received', 0)
+
+    @property
+    def bytes_sent(self) -> int:
+        return getattr(self.channel, 'bytes_sent', 0)
+
+    def settimeout(self, timeout: float | None):
+        self.timeout = timeout
+
+    def gettimeout(self) -> float | None:
+        return self.timeout
+
+    def recv(self, size: int) -> bytes:
+        return self.run(self.channel.recv(size))
+
+    def recv_into(self, buffer, size: int = 0) -> int:
+        view: memoryview = memoryview(buffer)
+        data: bytes = self.recv(size or len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        # The data has to stay untouched until the loop has taken it, which is guaranteed by waiting for the result
+        self.run(self.channel.sendall(data))
+
+    def send(self, data) -> int:
+        self.sendall(data)
+        return len(data)
+
+    def sendfile(self, file, offset: int = 0, count: int | None = None) -> int:
+        return self.run(self.channel.sendfile(file, offset, count))
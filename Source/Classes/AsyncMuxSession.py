@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+from .AsyncChannel import AsyncChannel
+from .MuxSession import MuxSession
+
+# noinspection PyUnresolvedReferences
+from Constants import (MUX_MAX_FRAME,
+                       MUX_STREAM_WINDOW,
+                       JSON_CODEC)
+
+from collections import deque
+import asyncio
+
+
+class AsyncMuxSession:
+    """
+    The server side of a MuxSession for the AsyncServer. It reads the same frames as MuxSession and hands every new
+    stream to on_new_stream, which is expected to start a task serving it.
+    """
+
+    def __init__(self, channel: AsyncChannel, on_new_stream):
+        self.channel: AsyncChannel = channel
+        self.on_new_stream = on_new_stream
+        self.streams: dict[int, AsyncMuxStream] = {}
+        self.alive: bool = True
+        self.codec: str = JSON_CODEC  # The payload encoding agreed on with a Codecs request
+        self.compressions: tuple[str, ...] = ()  # What both peers can decompress, agreed on with a Compressions request
+
+    async def run(self):
+        """
+        Reads frames until the connection closes and passes them to their stream
+        :return:
+        """
+        try:
+            while True:
+                header: bytes = await self.channel.recv_exactly(MuxSession.HEADER_LENGTH)
+
+                stream_id: int = int.from_bytes(header[0:4], 'big')
+                frame_type: int = header[4]
+                length: int = int.from_bytes(header[5:9], 'big')
+                payload: bytes = await self.channel.recv_exactly(length) if length else b''
+
+                self.handle_frame(stream_id, frame_type, payload)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.close()
+
+    def handle_frame(self, stream_id: int, frame_type: int, payload: bytes):
+        stream: AsyncMuxStream | None = self.streams.get(stream_id)
+        new_stream: bool = stream is None and frame_type == MuxSession.DATA
+        if new_stream:
+            stream = AsyncMuxStream(self, stream_id)
+            self.streams[stream_id] = stream
+
+        if stream is None:
+            return
+
+        if frame_type == MuxSession.DATA:
+            stream.feed(payload)
+        elif frame_type == MuxSession.WINDOW:
+            stream.add_credit(int.from_bytes(payload, 'big'))
+        elif frame_type == MuxSession.FIN:
+            stream.remote_close()
+
+        if new_stream:
+            self.on_new_stream(stream)
+
+    def write_frame(self, stream_id: int, frame_type: int, payload: bytes | memoryview = b''):
+        """
+        Queues a frame on the connection. Frames are written whole, so frames of different streams never mix
+        """
+        if not self.alive:
+            raise ConnectionResetError("The peer connection has closed")
+        header: bytes = (stream_id.to_bytes(4, 'big') + bytes([frame_type])
+                         + len(payload).to_bytes(4, 'big'))
+        self.channel.writer.write(header + payload)
+
+    def remove_stream(self, stream_id: int):
+        self.streams.pop(stream_id, None)
+
+    def close(self):
+        if not self.alive:
+            return
+        self.alive = False
+
+        for stream in list(self.streams.values()):
+            stream.remote_close()
+        self.streams.clear()
+
+
+class AsyncMuxStream:
+    """
+    One request on an AsyncMuxSession, with the same awaitable calls as AsyncChannel
+    """
+
+    def __init__(self, session: AsyncMuxSession, stream_id: int):
+        self.session: AsyncMuxSession = session
+        self.stream_id: int = stream_id
+
+        self.changed: asyncio.Event = asyncio.Event()  # Set whenever data, credit or a FIN arrives
+        self.chunks: deque[bytes] = deque()
+        self.chunk_offset: int = 0
+        self.credit: int = MUX_STREAM_WINDOW
+        self.unacknowledged: int = 0
+        self.local_closed: bool = False
+        self.remote_closed: bool = False
+        self.bytes_received: int = 0
+        self.bytes_sent: int = 0
+
+    # Called by the session
+
+    def feed(self, payload: bytes):
+        if self.local_closed:
+            # Nobody will read this anymore, give the window straight back so the sender isn't stuck
+            self.send_credit(len(payload))
+            return
+        self.chunks.append(payload)
+        self.changed.set()
+
+    def add_credit(self, amount: int):
+        self.credit += amount
+        self.changed.set()
+
+    def remote_close(self):
+        self.remote_closed = True
+        self.changed.set()
+        if self.local_closed:
+            self.session.remove_stream(self.stream_id)
+
+    def send_credit(self, amount: int):
+        try:
+            self.session.write_frame(self.stream_id, MuxSession.WINDOW, amount.to_bytes(4, 'big'))
+        except OSError:
+            pass
+
+    async def wait_for_change(self):
+        self.changed.clear()
+        await self.changed.wait()
+
+    # Channel interface
+
+    @property
+    def codec(self) -> str:
+        return self.session.codec
+
+    @property
+    def compressions(self) -> tuple[str, ...]:
+        return self.session.compressions
+
+    @property
+    def peer_addr(self) -> tuple[str, int] | None:
+        return self.session.channel.addr
+
+    async def recv(self, size: int) -> bytes:
+        while not self.chunks and not self.remote_closed:
+            await self.wait_for_change()
+
+        parts: list[bytes] = []
+        remaining: int = size
+        while self.chunks and remaining:
+            chunk: bytes = self.chunks[0]
+            end: int = min(len(chunk), self.chunk_offset + remaining)
+            parts.append(chunk[self.chunk_offset:end] if self.chunk_offset or end < len(chunk) else chunk)
+            remaining -= end - self.chunk_offset
+
+            if end == len(chunk):
+                self.chunks.popleft()
+                self.chunk_offset = 0
+            else:
+                self.chunk_offset = end
+        data: bytes = parts[0] if len(parts) == 1 else b''.join(parts)
+        self.bytes_received += len(data)
+
+        # Let the other side send more once half of the window has been read
+        self.unacknowledged += len(data)
+        if self.unacknowledged >= MUX_STREAM_WINDOW // 2 and not self.remote_closed:
+            self.send_credit(self.unacknowledged)
+            self.unacknowledged = 0
+        return data
+
+    async def recv_exactly(self, size: int) -> bytes:
+        data: bytearray = bytearray()
+        while len(data) < size:
+            chunk: bytes = await self.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError(f"Stream closed after {len(data)} of {size} bytes")
+            data.extend(chunk)
+        return bytes(data)
+
+    async def sendall(self, data):
+        view: memoryview = memoryview(data).cast('B')
+
+        while view:
+            frame_length: int = min(MUX_MAX_FRAME, len(view))
+            while self.credit < frame_length and not self.remote_closed and self.session.alive:
+                await self.wait_for_change()
+            if self.remote_closed or not self.session.alive:
+                raise ConnectionResetError("The stream was closed by the peer")
+            self.credit -= frame_length
+
+            self.session.write_frame(self.stream_id, MuxSession.DATA, view[:frame_length])
+            self.bytes_sent += frame_length
+            view = view[frame_length:]
+            await self.session.channel.writer.drain()
+
+    async def sendfile(self, file, offset: int = 0, count: int | None = None) -> int:
+        """
+        Frames can't be filled by the kernel, so the file is read and sent in MUX_MAX_FRAME sized pieces
+        """
+        file.seek(offset)
+        sent_size: int = 0
+        while count is None or sent_size < count:
+            data: bytes = file.read(MUX_MAX_FRAME if count is None else min(MUX_MAX_FRAME, count - sent_size))
+            if not data:
+                break
+            await self.sendall(data)
+            sent_size += len(data)
+        return sent_size
+
+    async def close(self):
+        if self.local_closed:
+            return
+        self.local_closed = True
+        self.chunks.clear()
+
+        try:
+            self.session.write_frame(self.stream_id, MuxSession.FIN)
+        except OSError:
+            pass
+
+        if self.remote_closed:
+            self.session.remove_stream(self.stream_id)
@@ -0,0 +1,399 @@
+from __future__ import annotations
+
+from .AsyncChannel import AsyncChannel, BlockingChannel
+from .AsyncMuxSession import AsyncMuxSession, AsyncMuxStream
+from .Catalog import Catalog
+from .CRequest import CRequest
+from .File import File
+from .Peer import Peer
+from .Server import Server
+from .SRequest import SRequest
+from .SyncFile import SyncFile
+from .UploadScheduler import UploadScheduler
+
+# noinspection PyUnresolvedReferences
+from Constants import (FIXED_LENGTH_HEADER,
+                       C_REQUEST_BYTE_LENGTH,
+                       S_REQUEST_BYTE_LENGTH,
+                       JSON_CODEC)
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Compression_Functions as CP
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Metrics_Functions as MT
+
+import asyncio
+import contextlib
+import itertools
+import socket
+import threading
+
+
+@contextlib.asynccontextmanager
+async def hold_lock(lock: threading.Lock):
+    """
+    Takes one of the program's threading locks without blocking the event loop when another thread holds it
+    :param lock:
+    :return:
+    """
+    if not lock.acquire(blocking=False):
+        await asyncio.to_thread(lock.acquire)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+class AsyncServer(Server):
+    """
+    Serves the same requests as Server, but every connection is a task on one event loop instead of a thread of its
+    own, so thousands of connections can be open at once without a thread (and its stack) for each.
+
+    The shared lists are still protected by the program's threading locks, since the peer side of the program uses
+    them from other threads. The locks are only held while the lists are read or changed, never while waiting on the
+    network. The requests that do a lot of blocking work (SubscribeFile, SyncFileUpdate, and telling other peers
+    about a new user) run the handlers of Server on a worker thread.
+    """
+
+    def serve_forever(self, listening_socket: socket.socket, request_args: tuple):
+        """
+        Runs the event loop until the program ends
+        :param listening_socket: the bound and listening socket from create_TCP_socket
+        :param request_args: the arguments client_request is called with, after the connection
+        :return:
+        """
+        asyncio.run(self.serve(listening_socket, request_args))
+
+    async def serve(self, listening_socket: socket.socket, request_args: tuple):
+        async def on_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            # The listening socket is a MeteredSocket, which asyncio doesn't recognise as TCP, so it doesn't turn off
+            # Nagle for the connections it accepts. Answers are small and followed by a read, waiting to batch them
+            # only adds delay (about 40 ms a request with delayed ACKs), like in MuxSession
+            connection_socket = writer.get_extra_info('socket')
+            if connection_socket is not None and connection_socket.family in (socket.AF_INET, socket.AF_INET6):
+                connection_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            await self.serve_connection(AsyncChannel(reader, writer), request_args)
+
+        # The event loop accepts connections as fast as they come, so let the kernel queue as many as it allows
+        async with await asyncio.start_server(on_connection, sock=listening_socket,
+                                              backlog=socket.SOMAXCONN) as async_server:
+            await async_server.serve_forever()
+
+    async def serve_connection(self, channel, request_args: tuple):
+        try:
+            await self.client_request_async(channel, *request_args)
+        except Exception as e:
+            print(f"[Error] A request could not be served: {e}")
+        finally:
+            await channel.close()
+
+    async def client_request_async(self,
+                                   channel: AsyncChannel | AsyncMuxStream,
+                                   peer_list: list[Peer],
+                                   subscribed_sync_files: Catalog,
+                                   available_sync_files: Catalog,
+                                   available_files: Catalog,
+                                   file_lock: threading.Lock,
+                                   sync_file_lock: threading.Lock,
+                                   peer_list_lock: threading.Lock,
+                                   ):
+        try:
+            request_type_bytes: bytes = await channel.recv_exactly(C_REQUEST_BYTE_LENGTH)
+        except ConnectionError:
+            # The client left without making a request
+            return
+        request_type: str = request_type_bytes.rstrip(b'\x00').decode('utf-8')
+
+        upload_class: int = UploadScheduler.request_class(request_type)
+        with self.request_slot(request_type) as admitted, \
+                FF.UPLOAD_SCHEDULER.transfer(FF.connection_peer_host(channel), upload_class), \
+                MT.measure(MT.SERVER, request_type, channel) as measurement:
+            if not admitted:
+                measurement['outcome'] = MT.BUSY
+                await self.send_Busy_async(channel)
+                return
+
+            match request_type:
+                case CRequest.AddMe.name:
+                    await self.send_Ok_async(channel)
+                    await self.add_client_async(channel, peer_list, peer_list_lock)
+
+                case CRequest.UserJoined.name:
+                    await self.send_Ok_async(channel)
+                    await self.receive_new_user_async(channel, peer_list, peer_list_lock)
+
+                case CRequest.RequestPeerList.name:
+                    async with hold_lock(peer_list_lock):
+                        modified_peer_list: list[Peer] = list(peer_list)
+                    modified_peer_list.append(Peer(self.addr, self.username))
+
+                    payload: bytes = FF.encode_object_list(modified_peer_list, FF.connection_codec(channel))
+
+                    await self.send_Ok_async(channel)
+                    await self.send_payload(channel, CP.compress_payload(channel, payload))
+
+                case CRequest.SendFiles.name:
+                    await self.send_Ok_async(channel)
+                    client_file_list: list[File] = FF.decode_object_list(await self.receive_payload(channel), File)
+                    if client_file_list:
+                        async with hold_lock(file_lock):
+                            FF.merge_files(client_file_list, available_files)
+
+                case CRequest.RequestFiles.name:
+                    async with hold_lock(file_lock):
+                        snapshots: tuple[tuple, ...] = (available_files.snapshot(), self.initial_files.snapshot())
+                    payload: bytes = FF.encode_object_list(itertools.chain(*snapshots), FF.connection_codec(channel))
+
+                    await self.send_Ok_async(channel)
+                    await self.send_payload(channel, CP.compress_payload(channel, payload))
+
+                case CRequest.SendSyncFiles.name:
+                    await self.send_Ok_async(channel)
+                    client_sync_file_list: list[SyncFile] = FF.decode_object_list(await self.receive_payload(channel),
+                                                                                  SyncFile)
+                    if not client_sync_file_list:
+                        print("An empty list of sync files were sent")
+                        return
+                    async with hold_lock(sync_file_lock):
+                        FF.merge_sync_files(client_sync_file_list, available_sync_files)
+
+                case CRequest.RequestSyncFiles.name:
+                    async with hold_lock(sync_file_lock):
+                        snapshots = (available_sync_files.snapshot(), subscribed_sync_files.snapshot())
+                    payload: bytes = FF.encode_object_list(itertools.chain(*snapshots), FF.connection_codec(channel))
+
+                    await self.send_Ok_async(channel)
+                    await self.send_payload(channel, CP.compress_payload(channel, payload))
+
+                case CRequest.DownloadFile.name:
+                    await self.send_Ok_async(channel)
+                    if CP.connection_compressions(channel):
+                        # Compressing is CPU work, it is done on a worker thread instead of with sendfile
+                        await self.run_blocking(channel, None, self.send_file_for_download)
+                    else:
+                        await self.send_file_for_download_async(channel)
+
+                case CRequest.DownloadFileRange.name:
+                    await self.send_Ok_async(channel)
+                    await self.send_file_for_download_async(channel, ranged=True)
+
+                case CRequest.DownloadFileChunks.name:
+                    await self.send_Ok_async(channel)
+                    await self.run_blocking(channel, None, self.send_file_chunks)
+
+                case CRequest.SubscribeFile.name:
+                    await self.send_Ok_async(channel)
+                    await self.run_blocking(channel, None, self.add_user_send_sync_file, subscribed_sync_files,
+                                            sync_file_lock)
+
+                case CRequest.UserSubscribed.name:
+                    await self.send_Ok_async(channel)
+                    subscribed_peer: Peer = await self.receive_object(channel, Peer)
+                    await self.send_Ok_async(channel)
+                    new_user_sync_file: SyncFile = await self.receive_object(channel, SyncFile)
+
+                    async with hold_lock(sync_file_lock):
+                        self.add_subscriber(subscribed_sync_files, new_user_sync_file.filename, subscribed_peer)
+
+                case CRequest.SyncFileUpdate.name:
+                    await self.send_Ok_async(channel)
+                    await self.run_blocking(channel, None, self.receive_sync_file_update,
+                                            subscribed_sync_files)
+
+                case CRequest.SyncFileUpdateChunks.name:
+                    await self.send_Ok_async(channel)
+                    await self.run_blocking(channel, None, self.receive_sync_file_chunks,
+                                            subscribed_sync_files)
+
+                case CRequest.Multiplex.name:
+                    await self.send_Ok_async(channel)
+                    await self.serve_multiplexed_async(channel,
+                                                       (peer_list,
+                                                        subscribed_sync_files,
+                                                        available_sync_files,
+                                                        available_files,
+                                                        file_lock,
+                                                        sync_file_lock,
+                                                        peer_list_lock,))
+
+                case CRequest.RequestFilesSince.name:
+                    await self.send_Ok_async(channel)
+                    await self.send_catalog_changes_async(channel, (available_files, self.initial_files), file_lock)
+
+                case CRequest.RequestSyncFilesSince.name:
+                    await self.send_Ok_async(channel)
+                    await self.send_catalog_changes_async(channel, (available_sync_files, subscribed_sync_files),
+                                                          sync_file_lock)
+
+                case CRequest.Codecs.name:
+                    await self.send_Ok_async(channel)
+                    offer: bytes = await self.receive_payload(channel)
+
+                    session: AsyncMuxSession | None = getattr(channel, 'session', None)
+                    codec: str = self.pick_codec(offer) if session is not None else JSON_CODEC
+                    if session is not None:
+                        session.codec = codec
+                    await self.send_payload(channel, codec.encode('utf-8'))
+
+                case CRequest.Compressions.name:
+                    await self.send_Ok_async(channel)
+                    offer = await self.receive_payload(channel)
+
+                    session = getattr(channel, 'session', None)
+                    compressions: tuple[str, ...] = CP.pick_compressions(offer) if session is not None else ()
+                    if session is not None:
+                        session.compressions = compressions
+                    await self.send_payload(channel, ','.join(compressions).encode('utf-8'))
+
+                case CRequest.Stats.name:
+                    await self.send_Ok_async(channel)
+                    await self.send_payload(channel, CP.compress_payload(channel, FF.encode_stats(MT.node_stats())))
+
+    async def serve_multiplexed_async(self, channel: AsyncChannel, request_args: tuple):
+        """
+        Every stream the client opens on the session is served by its own task
+        :param channel:
+        :param request_args:
+        :return:
+        """
+        tasks: set[asyncio.Task] = set()
+
+        def serve_stream(stream: AsyncMuxStream):
+            task: asyncio.Task = asyncio.create_task(self.serve_connection(stream, request_args))
+            # The loop only keeps weak references to tasks
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        session: AsyncMuxSession = AsyncMuxSession(channel, on_new_stream=serve_stream)
+        await session.run()
+
+    @staticmethod
+    async def run_blocking(channel, lock: threading.Lock | None, handler, *args):
+        """
+        Runs one of Server's request handlers on a worker thread while holding lock, with the channel made to look
+        like a socket
+        :param channel:
+        :param lock: None for handlers that don't need one
+        :param handler: called as handler(connection_socket, *args)
+        :param args:
+        :return:
+        """
+        blocking_channel: BlockingChannel = BlockingChannel(channel, asyncio.get_running_loop())
+
+        def run_handler():
+            with lock or contextlib.nullcontext():
+                handler(blocking_channel, *args)
+
+        await asyncio.to_thread(run_handler)
+
+    @staticmethod
+    async def send_Ok_async(channel):
+        response: str = SRequest.Ok.name
+        await channel.sendall(response.encode('utf-8').ljust(S_REQUEST_BYTE_LENGTH, b'\x00'))
+
+    @staticmethod
+    async def send_Busy_async(channel):
+        response: str = SRequest.Busy.name
+        await channel.sendall(response.encode('utf-8').ljust(S_REQUEST_BYTE_LENGTH, b'\x00'))
+
+    @staticmethod
+    async def send_payload(channel, payload: bytes):
+        await UploadScheduler.pace_async(FIXED_LENGTH_HEADER + len(payload))
+        await channel.sendall(len(payload).to_bytes(FIXED_LENGTH_HEADER, 'big') + payload)
+
+    @staticmethod
+    async def receive_payload(channel) -> bytes:
+        length: int = int.from_bytes(await channel.recv_exactly(FIXED_LENGTH_HEADER), 'big')
+        return await channel.recv_exactly(length)
+
+    @classmethod
+    async def receive_object(cls, channel, object_class):
+        return FF.decode_object(await cls.receive_payload(channel), object_class)
+
+    async def send_catalog_changes_async(self, channel, catalogs: tuple[Catalog, ...], lock: threading.Lock):
+        """
+        Same as send_catalog_changes
+        :param channel:
+        :param catalogs:
+        :param lock:
+        :return:
+        """
+        (epoch, version), _ = FF.decode_catalog_cursor(await self.receive_payload(channel))
+
+        async with hold_lock(lock):
+            cursor, full, added, removed = Catalog.changes_since(catalogs, epoch, version)
+
+        await self.send_payload(channel, FF.encode_catalog_cursor(cursor, full))
+        payload: bytes = FF.encode_object_list(added, FF.connection_codec(channel))
+        await self.send_payload(channel, CP.compress_payload(channel, payload))
+        await self.send_payload(channel, FF.encode_catalog_keys(removed))
+
+    async def add_client_async(self, channel, peer_list: list[Peer], peer_list_lock: threading.Lock):
+        """
+        Same as add_client. The news is gossiped from a worker thread
+        :param channel:
+        :param peer_list:
+        :param peer_list_lock:
+        :return:
+        """
+        user_as_peer: Peer = await self.receive_object(channel, Peer)
+
+        async with hold_lock(peer_list_lock):
+            if user_as_peer in peer_list:
+                return
+            targets: list[Peer] = self.gossip_targets(user_as_peer, peer_list)
+            ttl: int = self.gossip_ttl(len(peer_list) + 1)
+            peer_list.append(user_as_peer)
+
+        await asyncio.to_thread(self.send_new_user_to_peers, user_as_peer, targets, ttl)
+
+    async def receive_new_user_async(self, channel, peer_list: list[Peer], peer_list_lock: threading.Lock):
+        """
+        Same as receive_new_user
+        :param channel:
+        :param peer_list:
+        :param peer_list_lock:
+        :return:
+        """
+        user_as_peer: Peer = await self.receive_object(channel, Peer)
+        ttl_bytes: bytes = await channel.recv(1)
+        ttl: int = ttl_bytes[0] if ttl_bytes else 0
+
+        async with hold_lock(peer_list_lock):
+            if user_as_peer in peer_list or user_as_peer == Peer(self.addr, self.username):
+                return
+            targets: list[Peer] = self.gossip_targets(user_as_peer, peer_list) if ttl > 1 else []
+            peer_list.append(user_as_peer)
+
+        if targets:
+            await asyncio.to_thread(self.send_new_user_to_peers, user_as_peer, targets, ttl - 1)
+
+    async def send_file_for_download_async(self, channel, ranged: bool = False):
+        """
+        Same steps as send_file_for_download
+        :param channel:
+        :param ranged: True for DownloadFileRange requests
+        :return:
+        """
+        requested_file: File = await self.receive_object(channel, File)
+
+        if ranged:
+            offset: int = int.from_bytes(await channel.recv_exactly(FIXED_LENGTH_HEADER), 'big')
+            length: int = int.from_bytes(await channel.recv_exactly(FIXED_LENGTH_HEADER), 'big')
+
+        await self.send_Ok_async(channel)
+
+        file_size: int = FF.FILE_STORAGE.size(requested_file.filename)
+
+        if ranged:
+            offset = min(offset, file_size)
+            length = min(length, file_size - offset)
+            await channel.sendall(file_size.to_bytes(FIXED_LENGTH_HEADER, 'big')
+                                  + length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+        else:
+            offset, length = 0, file_size
+            await channel.sendall(file_size.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+
+        await FF.FILE_STORAGE.send_range_async(channel, requested_file.filename, offset, length)
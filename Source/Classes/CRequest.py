@@ -13,7 +13,8 @@ class CRequest(Enum):
     RequestPeerList: The client asks the server to send the list of peers in the P2P network
 
     UserJoined: The client (which is actually a request from another peer server) sends a message indicating that
-                another peer has joined the server
+                another peer has joined the server. The news is gossiped, the Peer is followed by one byte with the
+                amount of times the receiver should pass it on to GOSSIP_FANOUT random peers
 
     SendFiles: The client is requesting to send files to this server
 
@@ -30,7 +31,44 @@ class CRequest(Enum):
     UserSubscribed: A server has received a client who has subscribed to a syncFile, so this server is now sending an
                     updated syncFile object for users also subscribed to the network
 
-    SyncFileUpdate: A user has updated a sync file and is sending the update to this server
+    SyncFileUpdate: A user has updated a sync file and is sending the update to this server. This server sends back
+                    the block signatures of its copy and only the changed parts of the file are sent
+
+    DownloadFileRange: The client is requesting a single piece (offset + length) of a file. Used by swarm downloads to
+                       pull different pieces of the same file from every peer that has it, and to resume downloads
+                       that were interrupted
+
+    Multiplex: The client wants to keep this connection open and send many requests over it at once. After the Ok
+               both sides switch to MuxSession frames, and every stream opened on the session starts with its own
+               request
+
+    Codecs: The client offers the payload encodings it understands (comma separated names, preferred first) and the
+            server answers with the one to use. Sent as the first request on a multiplexed connection, the answer holds
+            for every stream of that connection. Peers that don't know this request use JSON
+
+    RequestFilesSince: Like RequestFiles, but the client sends the (epoch, version) the last answer ended at and only
+                       gets the files added or removed since. A client the server has no changes for (a new client,
+                       another epoch after a restart, or changes too old to remember) gets every file instead
+
+    RequestSyncFilesSince: Like RequestFilesSince, for the SyncFiles of RequestSyncFiles
+
+    DownloadFileChunks: Like DownloadFile, but the server first sends the list of content-defined chunks of the file
+                        (see Chunk_Functions), the client answers with the chunks it doesn't already have in any of
+                        its files, and only those are sent
+
+    SyncFileUpdateChunks: Like SyncFileUpdate, but the sender sends the chunk list of its new copy and only the chunks
+                          the receiver can't find in any of its files are sent. Peers that don't answer it are sent a
+                          SyncFileUpdate instead
+
+    Compressions: The client offers the compression algorithms it can decompress (comma separated names) and the
+                  server answers with the ones it can decompress too. Sent after Codecs, every payload and file sent
+                  on the connection may then be compressed with one of them (see Compression_Functions). Peers that
+                  don't know this request send everything as it is
+
+    Stats: The server sends what it has measured (see Metrics_Functions) as JSON: how many requests of each type it
+           served and made, how they ended, their bytes and latency percentiles, how long the peer list and catalog
+           locks were waited for and held, the SyncFile updates waiting to be sent to each subscriber, and the
+           compression and upload limit numbers
     """
     AddMe = 1
     RequestPeerList = 2
@@ -43,5 +81,14 @@ class CRequest(Enum):
     SubscribeFile = 9
     UserSubscribed = 10
     SyncFileUpdate = 11
+    DownloadFileRange = 12
+    Multiplex = 13
+    Codecs = 14
+    RequestFilesSince = 15
+    RequestSyncFilesSince = 16
+    DownloadFileChunks = 17
+    SyncFileUpdateChunks = 18
+    Compressions = 19
+    Stats = 20
 
 
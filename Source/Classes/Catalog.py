@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+from .ChangeLog import ChangeLog
+
+from typing import Iterable, Iterator
+
+
+class Catalog:
+    """
+    The Files (or SyncFiles) known to this peer, keyed by (filename, owner address) so adding, finding and removing an
+    entry doesn't need to look through every other entry. Entries are also indexed by filename, for listing every
+    owner of the same file.
+
+    SyncFiles don't have a single owner, their owner is None, so there is one SyncFile per filename.
+
+    Iterating goes through the entries in the order they were added.
+
+    Every change is recorded in change_log when there is one. Catalogs that are sent together (like the files this
+    user shares and the files it knows of) share a change log, so one version covers all of them.
+
+    snapshot is a tuple of the entries that is shared by every reader until the catalog changes, so a request can take
+    it under the catalog's lock, let go of the lock and take its time sending it.
+    """
+
+    def __init__(self, entries: Iterable = (), change_log: ChangeLog | None = None):
+        self.entries: dict[tuple[str, tuple[str, int] | None], object] = {}
+        self.by_filename: dict[str, dict[tuple[str, tuple[str, int] | None], object]] = {}
+        self.change_log: ChangeLog | None = change_log
+        self.snapshot_entries: tuple | None = None  # The last snapshot, until the next change
+
+        for entry in entries:
+            self.add(entry)
+
+    @staticmethod
+    def key(entry) -> tuple[str, tuple[str, int] | None]:
+        addr = getattr(entry, 'addr', None)
+        return entry.filename, tuple(addr) if addr is not None else None
+
+    def add(self, entry) -> bool:
+        """
+        :param entry:
+        :return: False if an entry with the same filename and owner is already in the catalog
+        """
+        key: tuple[str, tuple[str, int] | None] = self.key(entry)
+        if key in self.entries:
+            return False
+
+        self.entries[key] = entry
+        self.by_filename.setdefault(entry.filename, {})[key] = entry
+        self.changed(key)
+        return True
+
+    def replace(self, entry):
+        """
+        Puts entry in place of the entry with the same filename and owner, or adds it if there is none
+        :param entry:
+        :return:
+        """
+        key: tuple[str, tuple[str, int] | None] = self.key(entry)
+        self.entries[key] = entry
+        self.by_filename.setdefault(entry.filename, {})[key] = entry
+        self.changed(key)
+
+    def remove(self, entry):
+        """
+        Removes the entry with the same filename and owner as entry
+        :param entry:
+        :return:
+        """
+        self.remove_key(self.key(entry))
+
+    def remove_key(self, key: tuple[str, tuple[str, int] | None]):
+        del self.entries[key]
+
+        filename: str = key[0]
+        owners: dict = self.by_filename[filename]
+        del owners[key]
+        if not owners:
+            del self.by_filename[filename]
+        self.changed(key)
+
+    def changed(self, key: tuple[str, tuple[str, int] | None]):
+        self.snapshot_entries = None
+        if self.change_log is not None:
+            self.change_log.record(key)
+
+    def snapshot(self) -> tuple:
+        """
+        Copy on write: the entries are only copied on the first call after a change, every reader until the next
+        change gets the same tuple. Entries can't be changed (they are replaced), so the tuple never changes either.
+        The catalog must be locked by the caller, only while snapshot is called
+        :return: the entries in the order they were added
+        """
+        snapshot_entries: tuple | None = self.snapshot_entries
+        if snapshot_entries is None:
+            snapshot_entries = self.snapshot_entries = tuple(self.entries.values())
+        return snapshot_entries
+
+    def discard(self, entry):
+        if entry in self:
+            self.remove(entry)
+
+    def discard_key(self, key: tuple[str, tuple[str, int] | None]):
+        if key in self.entries:
+            self.remove_key(key)
+
+    def get(self, filename: str, owner: tuple[str, int] | None = None):
+        return self.entries.get((filename, tuple(owner) if owner is not None else None))
+
+    def get_by_key(self, key: tuple[str, tuple[str, int] | None]):
+        return self.entries.get(key)
+
+    def with_filename(self, filename: str) -> list:
+        """
+        :param filename:
+        :return: the entries of every owner of filename
+        """
+        return list(self.by_filename.get(filename, {}).values())
+
+    def filenames(self) -> list[str]:
+        return list(self.by_filename)
+
+    def keys_owned_by(self, owner: tuple[str, int]) -> list[tuple[str, tuple[str, int]]]:
+        """
+        :param owner: the address of a peer
+        :return: the keys of every entry owner owns
+        """
+        owner = tuple(owner)
+        return [key for key in self.entries if key[1] == owner]
+
+    def merge(self, entries: Iterable, skip_filenames: set[str] | frozenset[str] = frozenset(),
+              replace: bool = False) -> list:
+        """
+        Adds the entries that aren't in the catalog yet
+        :param entries:
+        :param skip_filenames: filenames that aren't added, like files this user already has
+        :param replace: also put every entry in place of the entry with the same filename and owner when they differ
+                        (a SyncFile with other subscribers), for entries that are newer than the catalog's
+        :return: the entries that were added or replaced
+        """
+        added: list = []
+        for entry in entries:
+            if entry.filename in skip_filenames:
+                continue
+            if self.add(entry):
+                added.append(entry)
+            elif replace:
+                # Entries compare by filename and owner only, so what they hold is compared to tell a change apart
+                current = self.get_by_key(self.key(entry))
+                if current.__dict__() != entry.__dict__():
+                    self.replace(entry)
+                    added.append(entry)
+        return added
+
+    @staticmethod
+    def changes_since(catalogs: tuple[Catalog, ...], epoch: int, version: int) -> tuple:
+        """
+        What a client that has seen the catalogs up to (epoch, version) is missing. The catalogs must share one change
+        log, and be locked by the caller
+        :param catalogs:
+        :param epoch:
+        :param version:
+        :return: (the version the client is at after applying the changes, whether every entry is sent instead of the
+                  changes, the entries added or replaced, the keys of the entries removed)
+        """
+        change_log: ChangeLog | None = catalogs[0].change_log
+        if change_log is None:
+            return (0, 0), True, [entry for catalog in catalogs for entry in catalog], []
+
+        # The cursor is read first, a change made in between is sent now and again next time, which does no harm
+        cursor: tuple[int, int] = change_log.cursor()
+        changed_keys: set[tuple] | None = change_log.changed_since(epoch, version)
+        if changed_keys is None:
+            return cursor, True, [entry for catalog in catalogs for entry in catalog], []
+
+        added: list = []
+        removed: list[tuple] = []
+        for key in changed_keys:
+            entry = next((catalog.get_by_key(key) for catalog in catalogs if key in catalog.entries), None)
+            if entry is None:
+                removed.append(key)
+            else:
+                added.append(entry)
+        return cursor, False, added, removed
+
+    def __contains__(self, entry) -> bool:
+        return self.key(entry) in self.entries
+
+    def __iter__(self) -> Iterator:
+        # Copying the values is a single step for the interpreter, so the menu can go through a catalog while the
+        # server thread adds to it without "dictionary changed size during iteration"
+        return iter(list(self.entries.values()))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __bool__(self) -> bool:
+        return bool(self.entries)
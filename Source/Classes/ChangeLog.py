@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import CATALOG_CHANGE_LOG_LENGTH
+
+from collections import deque
+import random
+import threading
+
+
+class ChangeLog:
+    """
+    Counts the changes made to one or more Catalogs and remembers the keys of the last CATALOG_CHANGE_LOG_LENGTH of
+    them, so a peer that has seen the catalogs up to some version can be sent only what changed since.
+
+    The epoch is picked at random when the log is made. Versions start over when the program restarts, a client
+    holding a version of an older epoch gets everything again instead of the changes of an unrelated history.
+    """
+
+    def __init__(self, length: int = CATALOG_CHANGE_LOG_LENGTH):
+        self.epoch: int = random.getrandbits(63) + 1  # Never 0, which clients send when they have seen nothing yet
+        self.version: int = 0
+        self.changes: deque[tuple[int, tuple]] = deque(maxlen=length)  # (version, key of the changed entry)
+        self.lock: threading.Lock = threading.Lock()
+
+    def record(self, key: tuple):
+        with self.lock:
+            self.version += 1
+            self.changes.append((self.version, key))
+
+    def cursor(self) -> tuple[int, int]:
+        """
+        :return: (epoch, version), what a client sends back to get the changes after this point
+        """
+        with self.lock:
+            return self.epoch, self.version
+
+    def changed_since(self, epoch: int, version: int) -> set[tuple] | None:
+        """
+        :param epoch:
+        :param version:
+        :return: the keys of the entries changed after version, or None if the log can't tell (another epoch, or
+                 the changes have already been dropped from the log)
+        """
+        with self.lock:
+            if epoch != self.epoch or version > self.version:
+                return None
+            if version == self.version:
+                return set()
+            if not self.changes or self.changes[0][0] > version + 1:
+                return None
+
+            keys: set[tuple] = set()
+            for change_version, key in reversed(self.changes):
+                if change_version <= version:
+                    break
+                keys.add(key)
+            return keys
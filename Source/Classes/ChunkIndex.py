@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Chunk_Functions as CH
+
+from contextlib import contextmanager
+from pathlib import Path
+import os
+import threading
+
+
+class ChunkIndex:
+    """
+    Knows where every chunk (see Chunk_Functions) of the files in some directories can be found, so a file being
+    received can be put together from data that is already on disk, whichever file it is in.
+
+    The files themselves stay where they are, the index only points in to them. A file is chunked again when its
+    size, modification time or inode changes, and a chunk is checked against its hash whenever it is read, so a file
+    changing after it was indexed is never a problem.
+    """
+
+    def __init__(self, directories: list[Path], ignore=None):
+        """
+        :param directories:
+        :param ignore: called with a file name, files it returns True for are never indexed
+        """
+        self.directories: list[Path] = directories
+        self.ignore = ignore or (lambda name: False)
+        self.lock: threading.Lock = threading.Lock()
+        self.refresh_lock: threading.Lock = threading.Lock()
+
+        # path -> ((inode, size, modification time), size, hex hash of the file, [(chunk hash, length), ...])
+        self.files: dict[Path, tuple[tuple[int, int, int], int, str, list[tuple[bytes, int]]]] = {}
+        self.locations: dict[bytes, dict[Path, int]] = {}  # chunk hash -> {path: offset of the chunk in the file}
+
+    @staticmethod
+    def signature(stat_result: os.stat_result) -> tuple[int, int, int]:
+        return stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+    def add(self, file_path: Path, stat_result: os.stat_result, file_size: int, file_hash: str,
+            chunks: list[tuple[bytes, int]]):
+        """
+        Records the chunks of a file, replacing what was known about it
+        :param file_path:
+        :param stat_result: the stat of the file the chunks were read from
+        :param file_size:
+        :param file_hash:
+        :param chunks:
+        :return:
+        """
+        with self.lock:
+            self.forget(file_path)
+            self.files[file_path] = (self.signature(stat_result), file_size, file_hash, chunks)
+
+            offset: int = 0
+            for chunk_hash, length in chunks:
+                self.locations.setdefault(chunk_hash, {}).setdefault(file_path, offset)
+                offset += length
+
+    def forget(self, file_path: Path):
+        """
+        Drops a file from the index, the caller holds the lock
+        :param file_path:
+        :return:
+        """
+        entry = self.files.pop(file_path, None)
+        if entry is None:
+            return
+
+        for chunk_hash, _ in entry[3]:
+            paths: dict[Path, int] | None = self.locations.get(chunk_hash)
+            if paths is not None:
+                paths.pop(file_path, None)
+                if not paths:
+                    del self.locations[chunk_hash]
+
+    def recipe(self, file_path: Path) -> tuple[int, str, list[tuple[bytes, int]]]:
+        """
+        :param file_path:
+        :return: (file size, hex hash of the file, [(chunk hash, length), ...]), the file is only read if it changed
+                 since it was last chunked
+        """
+        stat_result: os.stat_result = os.stat(file_path)
+        with self.lock:
+            entry = self.files.get(file_path)
+        if entry is not None and entry[0] == self.signature(stat_result):
+            return entry[1], entry[2], entry[3]
+
+        file_hash, chunks = CH.chunk_file(file_path)
+        file_size: int = sum(length for _, length in chunks)
+        self.add(file_path, stat_result, file_size, file_hash, chunks)
+        return file_size, file_hash, chunks
+
+    def refresh(self):
+        """
+        Chunks the files that were added or changed since the last refresh and forgets the ones that are gone
+        :return:
+        """
+        with self.refresh_lock:
+            present: set[Path] = set()
+            for directory in self.directories:
+                try:
+                    with os.scandir(directory) as entries:
+                        names: list[str] = [entry.name for entry in entries
+                                            if not self.ignore(entry.name) and entry.is_file()]
+                except FileNotFoundError:
+                    continue
+
+                for name in names:
+                    file_path: Path = directory / name
+                    try:
+                        self.recipe(file_path)
+                    except FileNotFoundError:
+                        continue
+                    present.add(file_path)
+
+            with self.lock:
+                for file_path in [file_path for file_path in self.files if file_path not in present]:
+                    self.forget(file_path)
+
+    @contextmanager
+    def reader(self):
+        """
+        Reads chunks from wherever the index found them, keeping the files open until the block ends
+        :return: a function called with (chunk hash, length) that returns the chunk, or None if no file has it anymore
+        """
+        open_files: dict[Path, object] = {}
+
+        def read_chunk(chunk_hash: bytes, length: int) -> bytes | None:
+            with self.lock:
+                places: list[tuple[Path, int]] = list(self.locations.get(chunk_hash, {}).items())
+
+            for file_path, offset in places:
+                try:
+                    f = open_files.get(file_path)
+                    if f is None:
+                        f = open_files[file_path] = open(file_path, 'rb')
+                    f.seek(offset)
+                    data: bytes = f.read(length)
+                except OSError:
+                    continue
+                if len(data) == length and CH.chunk_hash(data) == chunk_hash:
+                    return data
+            return None
+
+        try:
+            yield read_chunk
+        finally:
+            for f in open_files.values():
+                f.close()
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+from .MeteredSocket import MeteredSocket
+from .MuxSession import MuxSession, MuxStream
+from .ServerBusyError import ServerBusyError
+
+# noinspection PyUnresolvedReferences
+from Classes.CRequest import CRequest
+# noinspection PyUnresolvedReferences
+from Classes.SRequest import SRequest
+
+# noinspection PyUnresolvedReferences
+from Constants import (C_REQUEST_BYTE_LENGTH,
+                       S_REQUEST_BYTE_LENGTH,
+                       FIXED_LENGTH_HEADER,
+                       JSON_CODEC,
+                       WIRE_CODECS,
+                       WIRE_COMPRESSIONS)
+
+import socket
+import threading
+
+
+class ConnectionPool:
+    """
+    Keeps one MuxSession open to every peer this user talks to, so requests reuse an established connection instead
+    of paying for a new TCP handshake (and slow start) each time.
+
+    Peers that don't understand the Multiplex request are remembered and get a plain connection per request instead.
+    The payload encoding of a session is agreed on with a Codecs request right after connecting, and the compression
+    both peers can decompress with a Compressions request.
+    """
+
+    def __init__(self):
+        self.lock: threading.Lock = threading.Lock()
+        self.sessions: dict[tuple[str, int], MuxSession] = {}
+        self.plain_peers: set[tuple[str, int]] = set()
+
+    def open_stream(self, addr: tuple[str, int], timeout: float | None) -> MuxStream | socket.socket:
+        """
+        :param addr: the server address of the peer
+        :param timeout: used for connecting and for every operation on the returned stream
+        :return: a connected stream ready for a request
+        """
+        addr = tuple(addr)
+
+        with self.lock:
+            session: MuxSession | None = self.sessions.get(addr)
+            plain: bool = addr in self.plain_peers
+
+        if plain:
+            return self.open_plain_socket(addr, timeout)
+
+        if session is None or not session.alive:
+            session = self.connect(addr, timeout)
+            if session is None:
+                return self.open_plain_socket(addr, timeout)
+
+        stream: MuxStream = session.open_stream()
+        stream.settimeout(timeout)
+        return stream
+
+    def connect(self, addr: tuple[str, int], timeout: float | None) -> MuxSession | None:
+        """
+        Opens a new session to addr
+        :return: None if the peer doesn't support multiplexing
+        """
+        connection_socket: socket.socket = self.open_plain_socket(addr, timeout)
+        try:
+            request_bytes: bytes = CRequest.Multiplex.name.encode('utf-8').ljust(C_REQUEST_BYTE_LENGTH, b'\x00')
+            connection_socket.sendall(request_bytes)
+
+            response: str = connection_socket.recv(S_REQUEST_BYTE_LENGTH).rstrip(b'\x00').decode('utf-8')
+        except ConnectionError:
+            response = ''
+        except OSError:
+            connection_socket.close()
+            raise
+
+        if response == SRequest.Busy.name:
+            connection_socket.close()
+            raise ServerBusyError(f"{addr} is busy, try again later")
+
+        if response != SRequest.Ok.name:
+            connection_socket.close()
+            with self.lock:
+                self.plain_peers.add(addr)
+            return None
+
+        # The session's reader blocks until frames arrive, timeouts are handled per stream
+        connection_socket.settimeout(None)
+        session: MuxSession = MuxSession(connection_socket, is_client=True)
+        session.addr = addr
+        session.start()
+        session.codec = self.negotiate_codec(session, timeout)
+        session.compressions = self.negotiate_compressions(session, timeout)
+
+        with self.lock:
+            current: MuxSession | None = self.sessions.get(addr)
+            if current is not None and current.alive:
+                # Another thread connected at the same time, keep theirs
+                session.close()
+                return current
+            self.sessions[addr] = session
+
+        return session
+
+    @classmethod
+    def negotiate_codec(cls, session: MuxSession, timeout: float | None) -> str:
+        """
+        Offers WIRE_CODECS to the peer on the first stream of the session
+        :param session:
+        :param timeout:
+        :return: the encoding the peer chose, JSON_CODEC if it doesn't know the Codecs request
+        """
+        codec: str | None = cls.negotiate(session, timeout, CRequest.Codecs, ','.join(WIRE_CODECS))
+        return codec if codec in WIRE_CODECS else JSON_CODEC
+
+    @classmethod
+    def negotiate_compressions(cls, session: MuxSession, timeout: float | None) -> tuple[str, ...]:
+        """
+        Offers WIRE_COMPRESSIONS to the peer
+        :param session:
+        :param timeout:
+        :return: the algorithms both peers can decompress, none if the peer doesn't know the Compressions request
+        """
+        answer: str | None = cls.negotiate(session, timeout, CRequest.Compressions, ','.join(WIRE_COMPRESSIONS))
+        if not answer:
+            return ()
+        return tuple(algorithm for algorithm in answer.split(',') if algorithm in WIRE_COMPRESSIONS)
+
+    @classmethod
+    def negotiate(cls, session: MuxSession, timeout: float | None, request: CRequest, offer: str) -> str | None:
+        """
+        Sends request with offer as its payload on a new stream of the session
+        :param session:
+        :param timeout:
+        :param request:
+        :param offer:
+        :return: the peer's answer, None if it doesn't know the request
+        """
+        offer_bytes: bytes = offer.encode('utf-8')
+        try:
+            with session.open_stream() as stream:
+                stream.settimeout(timeout)
+                stream.sendall(request.name.encode('utf-8').ljust(C_REQUEST_BYTE_LENGTH, b'\x00'))
+
+                response: str = cls.receive_exact(stream, S_REQUEST_BYTE_LENGTH).rstrip(b'\x00').decode('utf-8')
+                if response != SRequest.Ok.name:
+                    return None
+
+                stream.sendall(len(offer_bytes).to_bytes(FIXED_LENGTH_HEADER, 'big') + offer_bytes)
+                length: int = int.from_bytes(cls.receive_exact(stream, FIXED_LENGTH_HEADER), 'big')
+                return cls.receive_exact(stream, length).decode('utf-8')
+        except (OSError, ValueError):
+            # Older peers close the stream without answering
+            return None
+
+    @staticmethod
+    def receive_exact(stream: MuxStream, size: int) -> bytes:
+        data: bytearray = bytearray()
+        while len(data) < size:
+            chunk: bytes = stream.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError(f"Stream closed after {len(data)} of {size} bytes")
+            data.extend(chunk)
+        return bytes(data)
+
+    @staticmethod
+    def open_plain_socket(addr: tuple[str, int], timeout: float | None) -> socket.socket:
+        connection_socket: socket.socket = MeteredSocket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            connection_socket.settimeout(timeout)
+            connection_socket.connect(addr)
+        except OSError:
+            connection_socket.close()
+            raise
+        return connection_socket
+
+    def close_all(self):
+        with self.lock:
+            sessions: list[MuxSession] = list(self.sessions.values())
+            self.sessions.clear()
+
+        for session in sessions:
+            session.close()
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import SYNC_WATCH_POLL_INTERVAL
+
+from pathlib import Path
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+
+class DirectoryWatcher:
+    """
+    Reports the names of the files in a directory that were created, written, moved or deleted.
+
+    On Linux the kernel reports the changes (inotify, called through ctypes so nothing has to be installed). Anywhere
+    else, or when inotify can't be used, the directory is listed every SYNC_WATCH_POLL_INTERVAL seconds and the size,
+    modification time and inode of every file are compared with the last listing. Neither way reads the files.
+    """
+    IN_MODIFY: int = 0x2
+    IN_CLOSE_WRITE: int = 0x8
+    IN_MOVED_FROM: int = 0x40
+    IN_MOVED_TO: int = 0x80
+    IN_CREATE: int = 0x100
+    IN_DELETE: int = 0x200
+    IN_Q_OVERFLOW: int = 0x4000
+    IN_NONBLOCK: int = 0o4000
+    IN_CLOEXEC: int = 0o2000000
+
+    EVENT_HEADER: struct.Struct = struct.Struct('iIII')  # watch descriptor, mask, cookie, name length
+
+    def __init__(self, directory: Path, ignore=None, poll_interval: float = SYNC_WATCH_POLL_INTERVAL):
+        """
+        :param directory:
+        :param ignore: called with a file name, files it returns True for are never reported
+        :param poll_interval: seconds between listings when inotify isn't used
+        """
+        self.directory: Path = directory
+        self.ignore = ignore or (lambda name: False)
+        self.poll_interval: float = poll_interval
+
+        self.inotify_fd: int | None = self.start_inotify()
+        # The last listing, only kept when polling: name -> (size, modification time, inode)
+        self.listing: dict[str, tuple[int, int, int]] = {} if self.inotify_fd is not None else self.list_directory()
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self.inotify_fd is not None
+
+    def start_inotify(self) -> int | None:
+        """
+        :return: the inotify file descriptor, or None if inotify isn't available
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+            inotify_fd: int = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if inotify_fd < 0:
+            return None
+
+        mask: int = (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE
+                     | self.IN_DELETE)
+        if libc.inotify_add_watch(inotify_fd, os.fsencode(self.directory), mask) < 0:
+            os.close(inotify_fd)
+            return None
+        return inotify_fd
+
+    def list_directory(self) -> dict[str, tuple[int, int, int]]:
+        listing: dict[str, tuple[int, int, int]] = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if self.ignore(entry.name) or not entry.is_file():
+                        continue
+                    try:
+                        stat_result: os.stat_result = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    listing[entry.name] = (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino)
+        except FileNotFoundError:
+            pass
+        return listing
+
+    def wait_for_changes(self, timeout: float | None) -> set[str]:
+        """
+        Waits until something changes in the directory or timeout seconds have passed
+        :param timeout:
+        :return: the names of the files that changed, which may have been deleted since
+        """
+        if self.inotify_fd is not None:
+            return self.read_events(timeout)
+        return self.poll(timeout)
+
+    def read_events(self, timeout: float | None) -> set[str]:
+        readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed: set[str] = set()
+        while True:
+            try:
+                data: bytes = os.read(self.inotify_fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset: int = 0
+            while offset < len(data):
+                _, mask, _, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name: str = os.fsdecode(data[offset:offset + name_length].rstrip(b'\x00'))
+                offset += name_length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    # Events were dropped, every file may have changed
+                    changed.update(self.list_directory())
+                elif name and not self.ignore(name):
+                    changed.add(name)
+        return changed
+
+    def poll(self, timeout: float | None) -> set[str]:
+        deadline: float | None = None if timeout is None else time.monotonic() + timeout
+        while True:
+            listing: dict[str, tuple[int, int, int]] = self.list_directory()
+            changed: set[str] = {name for name, signature in listing.items() if self.listing.get(name) != signature}
+            changed.update(name for name in self.listing if name not in listing)
+            self.listing = listing
+            if changed:
+                return changed
+
+            remaining: float = self.poll_interval if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                return set()
+            time.sleep(min(self.poll_interval, remaining))
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+from .AsyncChannel import AsyncChannel
+from .Storage import Storage
+from .UploadScheduler import UploadScheduler
+
+# noinspection PyUnresolvedReferences
+from Constants import (BUFFER_SIZE,
+                       STORAGE_VIEW_SIZE)
+
+from contextlib import contextmanager
+from pathlib import Path
+import os
+import socket
+import stat
+
+
+class DiskStorage(Storage):
+    """
+    Keeps the files in a folder on disk. Files sent on a connection of their own are handed to the kernel with
+    sendfile, and never pass through Python at all. Otherwise they are read a piece at a time in to one buffer that is
+    reused for every piece, so sending a large file doesn't mean holding it in memory or making a new bytes object for
+    every piece.
+
+    Files aren't mapped in to memory: the user can edit SyncFiles (and anything else in the folders) in place while
+    they are being sent, and reading a mapping past the new end of a file that got shorter kills the process. A file
+    that gets shorter while it is read here only ends early.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory: Path = directory
+
+    def size(self, name: str) -> int:
+        return os.stat(self.path(name)).st_size
+
+    def path(self, name: str) -> Path:
+        return self.directory / name
+
+    def pieces(self, name: str, offset: int = 0, length: int | None = None, piece_size: int = STORAGE_VIEW_SIZE):
+        with open(self.path(name), 'rb') as f:
+            if stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                f.seek(offset)
+            else:
+                # Pipes and devices can't seek, so skip ahead by reading
+                while offset > 0:
+                    skipped: bytes = f.read(min(BUFFER_SIZE, offset))
+                    if not skipped:
+                        break
+                    offset -= len(skipped)
+
+            with memoryview(bytearray(piece_size)) as buffer:
+                remaining: int | None = length
+                while remaining is None or remaining > 0:
+                    wanted: int = piece_size if remaining is None else min(piece_size, remaining)
+                    read_size: int = f.readinto(buffer[:wanted])
+                    if not read_size:
+                        break
+                    with buffer[:read_size] as piece:
+                        yield piece
+                    if remaining is not None:
+                        remaining -= read_size
+
+    @contextmanager
+    def open_write(self, name: str):
+        file_path: Path = self.path(name)
+        temporary_path: Path = file_path.with_name(file_path.name + '.write~')
+        try:
+            with open(temporary_path, 'wb') as f:
+                yield f
+        except BaseException:
+            temporary_path.unlink(missing_ok=True)
+            raise
+        os.replace(temporary_path, file_path)
+
+    def send_range(self, connection_socket, name: str, offset: int, length: int) -> int:
+        if not isinstance(connection_socket, socket.socket):
+            return super().send_range(connection_socket, name, offset, length)
+
+        with open(self.path(name), 'rb') as f:
+            if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                return super().send_range(connection_socket, name, offset, length)
+            piece_size: int = UploadScheduler.piece_size(length)
+            sent: int = 0
+            while sent < length:
+                piece: int = min(piece_size, length - sent)
+                UploadScheduler.pace(piece)
+                piece_sent: int = connection_socket.sendfile(f, offset + sent, piece)
+                if not piece_sent:
+                    # The file got shorter
+                    break
+                sent += piece_sent
+            return sent
+
+    async def send_range_async(self, channel, name: str, offset: int, length: int) -> int:
+        if not isinstance(channel, AsyncChannel):
+            return await super().send_range_async(channel, name, offset, length)
+
+        with open(self.path(name), 'rb') as f:
+            if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                return await super().send_range_async(channel, name, offset, length)
+
+            piece_size: int = UploadScheduler.piece_size(length)
+            sent: int = 0
+            while sent < length:
+                piece: int = min(piece_size, length - sent)
+                await UploadScheduler.pace_async(piece)
+                piece_sent: int = await channel.sendfile(f, offset + sent, piece)
+                if not piece_sent:
+                    break
+                sent += piece_sent
+            return sent
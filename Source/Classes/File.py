@@ -1,18 +1,29 @@
 from __future__ import annotations
+from .Immutable import Immutable
 
 
-class File:
+class File(Immutable):
+    """
+    A file shared by a user. Files can't be changed once made, so they can be kept in sets and used as dict keys
+    """
+    __slots__ = ('filename', 'username', 'addr')
+
     def __init__(self, filename: str, username: str, addr: tuple[str, int] = None):
-        self.filename: str = filename
-        self.username: str = username
-        self.addr: tuple[str, int] = addr
+        object.__setattr__(self, 'filename', filename)
+        object.__setattr__(self, 'username', username)
+        object.__setattr__(self, 'addr', tuple(addr) if addr is not None else None)
 
     def __dict__(self):
         return {'filename': self.filename, 'username': self.username, 'addr': self.addr}
 
     def __eq__(self, other: File):
+        if not isinstance(other, File):
+            return NotImplemented
         return (self.filename, self.username, self.addr) == (other.filename, other.username, other.addr)
 
+    def __hash__(self):
+        return hash((self.filename, self.username, self.addr))
+
     @classmethod
     def from_dict(cls, data: dict):
-        return File(data['filename'], data['username'], tuple(data['addr']))
\ No newline at end of file
+        return File(data['filename'], data['username'], tuple(data['addr']))
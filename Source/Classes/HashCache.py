@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import (HASH_READ_SIZE,
+                       HASH_THREADS)
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class HashCache:
+    """
+    Remembers the content hash of files by (path, inode, size, modification time), and keeps what it knows in a file
+    so files that haven't changed are never read again, not even after a restart.
+
+    Files are hashed with BLAKE2b, read HASH_READ_SIZE bytes at a time. hashlib lets go of the GIL while hashing, so
+    hash_files reads and hashes many files at once on a pool of threads.
+
+    Like git's index, an entry is only trusted when the file's modification time is older than the moment it was
+    hashed by more than the clock granularity of common file systems. Otherwise a change in the same tick, that
+    leaves the size the same, would go unnoticed.
+    """
+    ALGORITHM: str = 'blake2b'
+    FORMAT_VERSION: int = 1
+    RACY_WINDOW_NS: int = 2_000_000_000  # FAT file systems keep modification times in 2 second steps
+
+    def __init__(self, cache_path: Path):
+        """
+        :param cache_path: where the cache is kept, relative paths are taken from the folder the program runs in
+        """
+        self.cache_path: Path = cache_path
+        self.lock: threading.Lock = threading.Lock()
+        # path -> (inode, size, modification time, when it was hashed, hex digest)
+        self.entries: dict[str, tuple[int, int, int, int, str]] | None = None
+        self.dirty: bool = False
+
+    @classmethod
+    def new_hasher(cls):
+        return hashlib.blake2b()
+
+    @staticmethod
+    def entry_key(file_path: Path) -> str:
+        return os.path.abspath(file_path)
+
+    def load(self):
+        """
+        Reads the cache file the first time the cache is used. A missing or unreadable file is an empty cache
+        :return:
+        """
+        with self.lock:
+            if self.entries is not None:
+                return
+            self.entries = {}
+            try:
+                with open(self.cache_path, 'r') as f:
+                    saved: dict = json.load(f)
+            except (OSError, ValueError):
+                return
+            if saved.get('version') != self.FORMAT_VERSION or saved.get('algorithm') != self.ALGORITHM:
+                return
+            self.entries = {path: tuple(entry) for path, entry in saved.get('entries', {}).items()}
+
+    def save(self):
+        """
+        Writes the cache file if anything changed since the last save. It is written next to the old one and then
+        moved over it, so a crash never leaves half a cache behind
+        :return:
+        """
+        with self.lock:
+            if not self.dirty or self.entries is None:
+                return
+            saved: dict = {'version': self.FORMAT_VERSION, 'algorithm': self.ALGORITHM, 'entries': self.entries}
+            self.dirty = False
+
+        temporary_path: Path = self.cache_path.with_name(self.cache_path.name + '~')
+        try:
+            with open(temporary_path, 'w') as f:
+                json.dump(saved, f)
+            os.replace(temporary_path, self.cache_path)
+        except OSError as e:
+            print(f"[Error] The hash cache could not be saved: {e}")
+
+    def lookup(self, file_path: Path, stat_result: os.stat_result) -> str | None:
+        """
+        :return: the cached hash, or None if the file may have changed since it was hashed
+        """
+        self.load()
+        with self.lock:
+            entry: tuple[int, int, int, int, str] | None = self.entries.get(self.entry_key(file_path))
+        if entry is None:
+            return None
+
+        inode, size, modified, hashed_at, digest = entry
+        if (inode, size, modified) != (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns):
+            return None
+        if modified >= hashed_at - self.RACY_WINDOW_NS:
+            return None
+        return digest
+
+    def put(self, file_path: Path, stat_result: os.stat_result, digest: str, hashed_at: int | None = None):
+        """
+        Records the hash of a file, for files whose contents were hashed while writing them
+        :param file_path:
+        :param stat_result: the stat of the file once it was written
+        :param digest: the hex digest of a hasher from new_hasher
+        :param hashed_at: when the contents were hashed (time.time_ns()), now if None
+        :return:
+        """
+        self.load()
+        entry: tuple[int, int, int, int, str] = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns,
+                                                 hashed_at if hashed_at is not None else time.time_ns(), digest)
+        with self.lock:
+            self.entries[self.entry_key(file_path)] = entry
+            self.dirty = True
+
+    def hash_file(self, file_path: Path) -> str:
+        """
+        :param file_path:
+        :return: the hex digest of the file's contents, read from the cache when the file hasn't changed
+        """
+        stat_result: os.stat_result = os.stat(file_path)
+        digest: str | None = self.lookup(file_path, stat_result)
+        if digest is not None:
+            return digest
+
+        hashed_at: int = time.time_ns()
+        digest, stat_result = self.read_digest(file_path)
+        self.put(file_path, stat_result, digest, hashed_at)
+        return digest
+
+    @classmethod
+    def read_digest(cls, file_path: Path) -> tuple[str, os.stat_result]:
+        """
+        Hashes the file without looking at the cache
+        :param file_path:
+        :return: (hex digest, stat of the file when it was opened)
+        """
+        hasher = cls.new_hasher()
+        with open(file_path, 'rb', buffering=0) as f:
+            stat_result: os.stat_result = os.fstat(f.fileno())
+            # Small files are read in one go without setting aside a whole HASH_READ_SIZE buffer for them
+            buffer: bytearray = bytearray(min(HASH_READ_SIZE, stat_result.st_size + 1))
+            view: memoryview = memoryview(buffer)
+            while True:
+                read_size: int = f.readinto(buffer)
+                if not read_size:
+                    break
+                hasher.update(view[:read_size])
+
+        return hasher.hexdigest(), stat_result
+
+    def hash_files(self, file_paths: list[Path], threads: int = HASH_THREADS) -> dict[Path, str]:
+        """
+        Hashes every file, the ones that aren't cached on a pool of threads
+        :param file_paths:
+        :param threads:
+        :return: file path -> hex digest, files that disappeared in the meantime are left out
+        """
+        def hash_or_none(file_path: Path) -> str | None:
+            try:
+                return self.hash_file(file_path)
+            except FileNotFoundError:
+                return None
+
+        if len(file_paths) <= 1 or threads <= 1:
+            digests = [hash_or_none(file_path) for file_path in file_paths]
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                digests = list(executor.map(hash_or_none, file_paths))
+
+        return {file_path: digest for file_path, digest in zip(file_paths, digests) if digest is not None}
+
+    def forget_missing(self, directory: Path, file_names: set[str]):
+        """
+        Drops the entries of files in directory that aren't in file_names anymore
+        :param directory:
+        :param file_names: the files still in directory
+        :return:
+        """
+        self.load()
+        prefix: str = self.entry_key(directory) + os.sep
+        kept: set[str] = {prefix + name for name in file_names}
+        with self.lock:
+            missing: list[str] = [path for path in self.entries if path.startswith(prefix) and path not in kept]
+            for path in missing:
+                del self.entries[path]
+            self.dirty = self.dirty or bool(missing)
@@ -0,0 +1,15 @@
+from __future__ import annotations
+
+
+class Immutable:
+    """
+    Base of the classes whose objects can't be changed once made. Subclasses set their attributes in __init__ with
+    object.__setattr__ and keep __slots__ of their own
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} objects can't be changed, make a new one")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} objects can't be changed, make a new one")
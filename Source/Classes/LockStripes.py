@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+from .MeteredLock import MeteredLock
+
+import zlib
+
+
+class LockStripes:
+    """
+    A fixed table of MeteredLocks that keys (filenames) are spread over, so work on different keys can be done at the
+    same time while work on the same key takes turns. Keys share the table instead of getting a lock each, so nothing
+    has to be made or cleaned up as files come and go; two keys on the same stripe only take turns when they needn't.
+
+    A stripe is taken before any other lock, never while holding one, so stripes and the other locks can't wait on
+    each other.
+    """
+
+    def __init__(self, name: str, stripes: int):
+        self.name: str = name
+        self.locks: tuple[MeteredLock, ...] = tuple(MeteredLock(f"{name}[{i}]") for i in range(max(stripes, 1)))
+
+    def lock(self, key: str) -> MeteredLock:
+        """
+        :param key:
+        :return: the stripe of key. crc32 rather than hash, which changes between runs, so a key keeps its stripe
+        """
+        return self.locks[zlib.crc32(key.encode('utf-8')) % len(self.locks)]
+
+    def to_dict(self) -> dict:
+        """
+        :return: the numbers of every stripe added up, like MeteredLock.to_dict
+        """
+        total: MeteredLock = MeteredLock(self.name)
+        for lock in self.locks:
+            total.add(lock)
+        return total.to_dict() | {'stripes': len(self.locks)}
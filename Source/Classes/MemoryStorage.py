@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from .Storage import Storage
+
+# noinspection PyUnresolvedReferences
+from Constants import STORAGE_VIEW_SIZE
+
+from contextlib import contextmanager
+import io
+import threading
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps the files in memory, for tests and benchmarks that shouldn't depend on the disk. What needs a file on disk
+    (see Storage) isn't available.
+    """
+
+    def __init__(self, files: dict[str, bytes] | None = None):
+        """
+        :param files: filename -> contents to start with
+        """
+        self.lock: threading.Lock = threading.Lock()
+        self.files: dict[str, bytes] = dict(files or {})
+
+    def size(self, name: str) -> int:
+        return len(self.contents(name))
+
+    def contents(self, name: str) -> bytes:
+        with self.lock:
+            data: bytes | None = self.files.get(name)
+        if data is None:
+            raise FileNotFoundError(f"No file named {name}")
+        return data
+
+    def pieces(self, name: str, offset: int = 0, length: int | None = None, piece_size: int = STORAGE_VIEW_SIZE):
+        data: bytes = self.contents(name)
+        offset = min(offset, len(data))
+        end: int = len(data) if length is None else min(offset + length, len(data))
+        with memoryview(data) as whole:
+            for start in range(offset, end, piece_size):
+                with whole[start:min(start + piece_size, end)] as piece:
+                    yield piece
+
+    @contextmanager
+    def open_write(self, name: str):
+        buffer: io.BytesIO = io.BytesIO()
+        yield buffer
+        with self.lock:
+            self.files[name] = buffer.getvalue()
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from .RequestMetrics import RequestMetrics
+
+# noinspection PyUnresolvedReferences
+from Constants import METRICS_LATENCY_BUCKETS
+
+import bisect
+import threading
+import time
+
+
+class MeteredLock:
+    """
+    A threading.Lock that measures how long it is waited for and how long it is held, so the metrics (see
+    Metrics_Functions) show when one request holds a shared list for long enough to hold up the others. Hold times are
+    counted in the buckets of METRICS_LATENCY_BUCKETS, like request latencies.
+
+    The counters are only changed by the thread holding the lock, so they need no lock of their own. A lock taken on
+    one thread may be released on another (the AsyncServer takes locks on worker threads), like a threading.Lock.
+    """
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.lock: threading.Lock = threading.Lock()
+        self.acquired_at: float = 0.0
+
+        self.acquisitions: int = 0
+        self.contended: int = 0  # Acquisitions that had to wait for another holder
+        self.total_wait_seconds: float = 0.0
+        self.max_wait_seconds: float = 0.0
+        self.total_hold_seconds: float = 0.0
+        self.max_hold_seconds: float = 0.0
+        self.hold_buckets: list[int] = [0] * (len(METRICS_LATENCY_BUCKETS) + 1)
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        waited: float = 0.0
+        if not self.lock.acquire(blocking=False):
+            if not blocking:
+                return False
+            start: float = time.perf_counter()
+            if not self.lock.acquire(timeout=timeout):
+                return False
+            waited = time.perf_counter() - start
+            self.contended += 1
+
+        self.acquisitions += 1
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.acquired_at = time.perf_counter()
+        return True
+
+    def release(self):
+        held: float = time.perf_counter() - self.acquired_at
+        self.total_hold_seconds += held
+        self.max_hold_seconds = max(self.max_hold_seconds, held)
+        self.hold_buckets[bisect.bisect_left(METRICS_LATENCY_BUCKETS, held)] += 1
+        self.lock.release()
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def add(self, other: MeteredLock):
+        """
+        Adds the numbers of other to these, to report several locks as one
+        :param other:
+        :return:
+        """
+        self.acquisitions += other.acquisitions
+        self.contended += other.contended
+        self.total_wait_seconds += other.total_wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, other.max_wait_seconds)
+        self.total_hold_seconds += other.total_hold_seconds
+        self.max_hold_seconds = max(self.max_hold_seconds, other.max_hold_seconds)
+        self.hold_buckets = [count + other_count for count, other_count in zip(self.hold_buckets, other.hold_buckets)]
+
+    def to_dict(self) -> dict:
+        hold_buckets: list[int] = list(self.hold_buckets)
+        return {'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'total_wait_seconds': self.total_wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'total_hold_seconds': self.total_hold_seconds,
+                'max_hold_seconds': self.max_hold_seconds,
+                'p50_hold_seconds': RequestMetrics.bucket_percentile(hold_buckets, self.max_hold_seconds, 0.5),
+                'p99_hold_seconds': RequestMetrics.bucket_percentile(hold_buckets, self.max_hold_seconds, 0.99),
+                'hold_buckets': hold_buckets}
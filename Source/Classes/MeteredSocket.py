@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import socket
+
+
+class MeteredSocket(socket.socket):
+    """
+    A socket that counts the bytes received and sent on it, like the streams of a MuxSession and the channels of the
+    AsyncServer do, so the request metrics (see Metrics_Functions) can tell how much every request moved. Connections
+    accepted by a MeteredSocket are MeteredSockets too.
+
+    Nagle is turned off on every TCP MeteredSocket: requests and answers are small and each is followed by a read, so
+    waiting to batch them only adds delay (about 40 ms a round trip with delayed ACKs), like in MuxSession.
+    """
+    __slots__ = ('bytes_received', 'bytes_sent')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_received: int = 0
+        self.bytes_sent: int = 0
+
+        if self.family in (socket.AF_INET, socket.AF_INET6) and self.type == socket.SOCK_STREAM:
+            self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def accept(self):
+        fd, addr = self._accept()
+        connection_socket: MeteredSocket = MeteredSocket(self.family, self.type, self.proto, fileno=fd)
+        # Same as socket.accept, a listening socket with a timeout doesn't make the connection non-blocking
+        if socket.getdefaulttimeout() is None and self.gettimeout():
+            connection_socket.setblocking(True)
+        return connection_socket, addr
+
+    def recv(self, size: int, *args) -> bytes:
+        data: bytes = super().recv(size, *args)
+        self.bytes_received += len(data)
+        return data
+
+    def recv_into(self, buffer, size: int = 0, *args) -> int:
+        received: int = super().recv_into(buffer, size, *args)
+        self.bytes_received += received
+        return received
+
+    def send(self, data, *args) -> int:
+        sent: int = super().send(data, *args)
+        self.bytes_sent += sent
+        return sent
+
+    def sendall(self, data, *args):
+        super().sendall(data, *args)
+        self.bytes_sent += memoryview(data).nbytes
+
+    def sendfile(self, file, offset: int = 0, count: int | None = None) -> int:
+        # Where the kernel can't send the file, socket.sendfile falls back to send, which already counts
+        bytes_sent: int = self.bytes_sent
+        sent: int = super().sendfile(file, offset, count)
+        self.bytes_sent = bytes_sent + sent
+        return sent
@@ -0,0 +1,345 @@
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import (MUX_MAX_FRAME,
+                       MUX_STREAM_WINDOW,
+                       JSON_CODEC)
+
+from collections import deque
+import socket
+import threading
+import time
+
+
+class MuxSession:
+    """
+    A long-lived TCP connection between two peers that carries many requests at the same time.
+
+    Every request gets its own stream. Data is sent in frames of at most MUX_MAX_FRAME bytes:
+        stream id (4 bytes) | frame type (1 byte) | payload length (4 bytes) | payload
+    so a large transfer on one stream never holds up a small request on another. Each stream may only have
+    MUX_STREAM_WINDOW bytes in flight that the other side hasn't read yet, the reader hands out more with WINDOW
+    frames as it reads, so one slow stream can't make the session buffer without bound.
+
+    Only the side that opened the connection (the client) opens streams. The server side hands every new stream to
+    on_new_stream, which is expected to serve it on another thread.
+    """
+    HEADER_LENGTH: int = 9
+
+    DATA: int = 0
+    FIN: int = 1  # This side is done with the stream
+    WINDOW: int = 2  # The payload is the amount of bytes the other side may send on top of what it already could
+
+    def __init__(self, connection_socket: socket.socket, is_client: bool, on_new_stream=None):
+        self.socket: socket.socket = connection_socket
+        self.is_client: bool = is_client
+        self.on_new_stream = on_new_stream
+        self.addr: tuple[str, int] | None = None
+        self.codec: str = JSON_CODEC  # The payload encoding agreed on with a Codecs request
+        self.compressions: tuple[str, ...] = ()  # What both peers can decompress, agreed on with a Compressions request
+        try:
+            self.peer_addr: tuple[str, int] | None = connection_socket.getpeername()
+        except OSError:
+            self.peer_addr = None
+
+        self.lock: threading.Lock = threading.Lock()
+        self.send_lock: threading.Lock = threading.Lock()
+        self.streams: dict[int, MuxStream] = {}
+        self.next_stream_id: int = 1
+        self.alive: bool = True
+
+        # Frames and window updates are small, waiting to batch them (Nagle) only adds delay
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def start(self):
+        """
+        Reads frames on a background thread (client side)
+        :return:
+        """
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """
+        Reads frames until the connection closes and passes them to their stream
+        :return:
+        """
+        try:
+            while True:
+                header: bytes = self.receive_exact(self.HEADER_LENGTH)
+                if not header:
+                    break
+
+                stream_id: int = int.from_bytes(header[0:4], 'big')
+                frame_type: int = header[4]
+                length: int = int.from_bytes(header[5:9], 'big')
+                payload: bytes = self.receive_exact(length) if length else b''
+                if length and not payload:
+                    break
+
+                self.handle_frame(stream_id, frame_type, payload)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def handle_frame(self, stream_id: int, frame_type: int, payload: bytes):
+        with self.lock:
+            stream: MuxStream | None = self.streams.get(stream_id)
+            new_stream: bool = stream is None and not self.is_client and frame_type == self.DATA
+            if new_stream:
+                stream = MuxStream(self, stream_id)
+                self.streams[stream_id] = stream
+
+        if stream is None:
+            return
+
+        if frame_type == self.DATA:
+            stream.feed(payload)
+        elif frame_type == self.WINDOW:
+            stream.add_credit(int.from_bytes(payload, 'big'))
+        elif frame_type == self.FIN:
+            stream.remote_close()
+
+        if new_stream:
+            self.on_new_stream(stream)
+
+    def receive_exact(self, length: int) -> bytes:
+        data: bytearray = bytearray()
+        while len(data) < length:
+            chunk = self.socket.recv(length - len(data))
+            if not chunk:
+                return b''
+            data.extend(chunk)
+        return bytes(data)
+
+    def send_frame(self, stream_id: int, frame_type: int, payload: bytes | memoryview = b''):
+        header: bytes = (stream_id.to_bytes(4, 'big') + bytes([frame_type])
+                         + len(payload).to_bytes(4, 'big'))
+        with self.send_lock:
+            if not self.alive:
+                raise ConnectionResetError("The peer connection has closed")
+            # One write per frame, frames are small enough that copying them is cheaper than a second send
+            self.socket.sendall(header + payload)
+
+    def open_stream(self) -> MuxStream:
+        with self.lock:
+            if not self.alive:
+                raise ConnectionResetError("The peer connection has closed")
+            stream: MuxStream = MuxStream(self, self.next_stream_id)
+            self.streams[stream.stream_id] = stream
+            self.next_stream_id += 2
+            return stream
+
+    def remove_stream(self, stream_id: int):
+        with self.lock:
+            self.streams.pop(stream_id, None)
+
+    def close(self):
+        with self.lock:
+            if not self.alive:
+                return
+            self.alive = False
+            streams: list[MuxStream] = list(self.streams.values())
+            self.streams.clear()
+
+        for stream in streams:
+            stream.remote_close()
+
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class MuxStream:
+    """
+    One request on a MuxSession. It behaves like a connected socket (recv, sendall, sendfile, settimeout, close) so
+    the request handlers in Server and File_Functions work on it unchanged.
+    """
+
+    def __init__(self, session: MuxSession, stream_id: int):
+        self.session: MuxSession = session
+        self.stream_id: int = stream_id
+        self.timeout: float | None = None
+
+        self.condition: threading.Condition = threading.Condition()
+        self.chunks: deque[bytes] = deque()  # Received payloads that haven't been read yet
+        self.chunk_offset: int = 0  # How much of the first chunk has already been read
+        self.credit: int = MUX_STREAM_WINDOW  # How much more this side may send
+        self.unacknowledged: int = 0  # Bytes read that the other side hasn't been told about yet
+        self.local_closed: bool = False
+        self.remote_closed: bool = False
+        self.bytes_received: int = 0
+        self.bytes_sent: int = 0
+
+    # Called by the session's reader thread
+
+    def feed(self, payload: bytes):
+        with self.condition:
+            discarded: bool = self.local_closed
+            if not discarded:
+                self.chunks.append(payload)
+                self.condition.notify_all()
+
+        if discarded:
+            # Nobody will read this anymore, give the window straight back so the sender isn't stuck
+            self.send_credit(len(payload))
+
+    def add_credit(self, amount: int):
+        with self.condition:
+            self.credit += amount
+            self.condition.notify_all()
+
+    def remote_close(self):
+        with self.condition:
+            self.remote_closed = True
+            self.condition.notify_all()
+            finished: bool = self.local_closed
+
+        if finished:
+            self.session.remove_stream(self.stream_id)
+
+    def send_credit(self, amount: int):
+        try:
+            self.session.send_frame(self.stream_id, MuxSession.WINDOW, amount.to_bytes(4, 'big'))
+        except OSError:
+            pass
+
+    # Socket interface
+
+    @property
+    def codec(self) -> str:
+        return self.session.codec
+
+    @property
+    def compressions(self) -> tuple[str, ...]:
+        return self.session.compressions
+
+    @property
+    def peer_addr(self) -> tuple[str, int] | None:
+        return self.session.peer_addr
+
+    def settimeout(self, timeout: float | None):
+        self.timeout = timeout
+
+    def gettimeout(self) -> float | None:
+        return self.timeout
+
+    def deadline(self) -> float | None:
+        return None if self.timeout is None else time.monotonic() + self.timeout
+
+    def wait(self, deadline: float | None):
+        """
+        Waits on the condition (which must be held) until notified or the timeout runs out
+        """
+        if deadline is None:
+            self.condition.wait()
+            return
+        remaining: float = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("timed out")
+        self.condition.wait(remaining)
+
+    def recv(self, size: int) -> bytes:
+        deadline: float | None = self.deadline()
+        with self.condition:
+            while not self.chunks and not self.remote_closed:
+                self.wait(deadline)
+
+            data: bytes = self.read_chunks(size)
+            self.bytes_received += len(data)
+
+            # Let the other side send more once half of the window has been read
+            self.unacknowledged += len(data)
+            acknowledged: int = 0
+            if self.unacknowledged >= MUX_STREAM_WINDOW // 2 and not self.remote_closed:
+                acknowledged, self.unacknowledged = self.unacknowledged, 0
+
+        if acknowledged:
+            self.send_credit(acknowledged)
+        return data
+
+    def read_chunks(self, size: int) -> bytes:
+        """
+        Takes up to size bytes off the front of the received chunks (the condition must be held)
+        """
+        parts: list[bytes] = []
+        remaining: int = size
+        while self.chunks and remaining:
+            chunk: bytes = self.chunks[0]
+            end: int = min(len(chunk), self.chunk_offset + remaining)
+            parts.append(chunk[self.chunk_offset:end] if self.chunk_offset or end < len(chunk) else chunk)
+            remaining -= end - self.chunk_offset
+
+            if end == len(chunk):
+                self.chunks.popleft()
+                self.chunk_offset = 0
+            else:
+                self.chunk_offset = end
+
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def recv_into(self, buffer, size: int = 0) -> int:
+        view: memoryview = memoryview(buffer)
+        data: bytes = self.recv(size or len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        view: memoryview = memoryview(data).cast('B')
+        deadline: float | None = self.deadline()
+
+        while view:
+            frame_length: int = min(MUX_MAX_FRAME, len(view))
+            with self.condition:
+                while self.credit < frame_length and not self.remote_closed and self.session.alive:
+                    self.wait(deadline)
+                if self.remote_closed or not self.session.alive:
+                    raise ConnectionResetError("The stream was closed by the peer")
+                self.credit -= frame_length
+
+            self.session.send_frame(self.stream_id, MuxSession.DATA, view[:frame_length])
+            self.bytes_sent += frame_length
+            view = view[frame_length:]
+
+    def send(self, data) -> int:
+        self.sendall(data)
+        return len(data)
+
+    def sendfile(self, file, offset: int = 0, count: int | None = None) -> int:
+        """
+        Frames can't be filled by the kernel, so the file is read and sent in MUX_MAX_FRAME sized pieces
+        """
+        file.seek(offset)
+        sent_size: int = 0
+        while count is None or sent_size < count:
+            read_size: int = MUX_MAX_FRAME if count is None else min(MUX_MAX_FRAME, count - sent_size)
+            data: bytes = file.read(read_size)
+            if not data:
+                break
+            self.sendall(data)
+            sent_size += len(data)
+        return sent_size
+
+    def close(self):
+        with self.condition:
+            if self.local_closed:
+                return
+            self.local_closed = True
+            self.chunks.clear()
+            finished: bool = self.remote_closed
+
+        try:
+            self.session.send_frame(self.stream_id, MuxSession.FIN)
+        except OSError:
+            pass
+
+        if finished:
+            self.session.remove_stream(self.stream_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+from .HashCache import HashCache
+
+# noinspection PyUnresolvedReferences
+from Constants import (SWARM_PIECE_SIZE,
+                       PARTIAL_FILE_SUFFIX,
+                       PARTIAL_STATE_SUFFIX)
+
+import json
+import os
+from pathlib import Path
+
+
+class PartialDownload:
+    """
+    Keeps track of a download that hasn't finished yet so it can be resumed instead of starting again from zero.
+
+    The data is written to Files/<filename>.part which is created at the full size of the file up front, and the
+    pieces (SWARM_PIECE_SIZE bytes each) that have been fully written are recorded in Files/<filename>.part.json.
+    Single peer downloads fill the pieces in order while swarm downloads fill them in any order, both use the same
+    record so a download that fails part way through is resumed whichever way it was started.
+    Once every piece is there the .part file is renamed to the real file name.
+
+    The owner can change a file without changing its size, so the record also keeps the BLAKE2b hash of the copy being
+    downloaded when the peer has sent it (in the recipe of a DownloadFileChunks request). Pieces from an earlier
+    download are only kept if the peer sends the same hash again, without it there is no telling them apart from
+    pieces of another copy of the same size.
+    """
+
+    def __init__(self, filename: str, files_directory: Path, piece_size: int = SWARM_PIECE_SIZE):
+        """
+        :param filename:
+        :param files_directory: the folder the file is downloaded to (FILES_DIRECTORY in File_Functions)
+        :param piece_size:
+        """
+        self.filename: str = filename
+        self.piece_size: int = piece_size
+        self.file_path: Path = files_directory / filename
+        self.part_path: Path = files_directory / (filename + PARTIAL_FILE_SUFFIX)
+        self.state_path: Path = files_directory / (filename + PARTIAL_STATE_SUFFIX)
+
+        self.file_size: int | None = None
+        self.file_hash: str | None = None  # The hash of the copy being downloaded, None if it isn't known
+        self.completed: set[int] = set()
+        self.checked: bool = False  # True once the pieces are known to be of the copy the peer has now
+        self.load()
+
+    @property
+    def piece_count(self) -> int:
+        return -(-self.file_size // self.piece_size) if self.file_size else 0
+
+    def load(self):
+        """
+        Reads the record of a previous attempt. A record that doesn't match the piece size or has lost its .part file
+        is ignored
+        :return:
+        """
+        try:
+            with open(self.state_path, 'r') as f:
+                state: dict = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+
+        if state.get('piece_size') != self.piece_size or not self.part_path.exists():
+            return
+
+        self.file_size = state['file_size']
+        self.file_hash = state.get('file_hash')
+        self.completed = set(state['completed'])
+
+    def resume_or_start(self, file_size: int, file_hash: str | None = None) -> bool:
+        """
+        Keeps the pieces already downloaded if they are of the copy the peer is offering, otherwise starts over.
+        Pieces written since this record was loaded are kept as long as the size is the same, pieces from an earlier
+        download only if file_hash is the hash they were recorded with
+        :param file_size: the size of the file the peer is offering
+        :param file_hash: the hash of the peer's copy, None if the peer hasn't sent it
+        :return: True if the pieces were kept
+        """
+        if self.file_size == file_size and (self.checked or file_hash is not None) and \
+                (file_hash is None or self.file_hash == file_hash):
+            self.checked = True
+            return True
+
+        self.start(file_size, file_hash)
+        return False
+
+    def start(self, file_size: int, file_hash: str | None = None):
+        """
+        Throws away any previous attempt and creates an empty .part file of file_size bytes
+        :param file_size:
+        :param file_hash: the hash of the copy that will be downloaded, if it is known
+        :return:
+        """
+        self.file_size = file_size
+        self.file_hash = file_hash
+        self.completed = set()
+        self.checked = True
+
+        with open(self.part_path, 'wb') as f:
+            f.truncate(file_size)
+        self.save()
+
+    def resume_offset(self) -> int:
+        """
+        :return: the amount of bytes at the start of the file that are already downloaded
+        """
+        if self.file_size is None:
+            return 0
+
+        piece: int = 0
+        while piece in self.completed:
+            piece += 1
+        return min(piece * self.piece_size, self.file_size)
+
+    def missing_pieces(self) -> list[int]:
+        return [piece for piece in range(self.piece_count) if piece not in self.completed]
+
+    def mark_piece(self, piece: int):
+        self.completed.add(piece)
+
+    def mark_range(self, offset: int, length: int):
+        """
+        Marks every piece that lies completely inside [offset, offset + length) as downloaded. The last piece of the
+        file counts as complete when the range reaches the end of the file
+        :param offset:
+        :param length:
+        :return:
+        """
+        end: int = offset + length
+        piece: int = -(-offset // self.piece_size)
+        while piece < self.piece_count and min((piece + 1) * self.piece_size, self.file_size) <= end:
+            self.completed.add(piece)
+            piece += 1
+
+    def mark_ranges(self, ranges: list[tuple[int, int]]):
+        """
+        Like mark_range for many (offset, length) ranges in any order, pieces covered by several ranges next to each
+        other count as well
+        :param ranges:
+        :return:
+        """
+        run_start: int = 0
+        run_end: int = 0
+        for offset, length in sorted(ranges):
+            if offset > run_end:
+                self.mark_range(run_start, run_end - run_start)
+                run_start = offset
+            run_end = max(run_end, offset + length)
+        self.mark_range(run_start, run_end - run_start)
+
+    def has_range(self, offset: int, length: int) -> bool:
+        """
+        :param offset:
+        :param length:
+        :return: True if every piece [offset, offset + length) touches is downloaded
+        """
+        return all(piece in self.completed
+                   for piece in range(offset // self.piece_size, -(-(offset + length) // self.piece_size)))
+
+    def is_complete(self) -> bool:
+        return self.file_size is not None and len(self.completed) == self.piece_count
+
+    def save(self):
+        """
+        Writes the record next to the .part file. It is written to a temporary file first so being stopped half way
+        through never leaves a broken record behind
+        :return:
+        """
+        temporary_path: Path = self.state_path.with_name(self.state_path.name + '~')
+        with open(temporary_path, 'w') as f:
+            json.dump({'file_size': self.file_size,
+                       'file_hash': self.file_hash,
+                       'piece_size': self.piece_size,
+                       'completed': sorted(self.completed)}, f)
+        os.replace(temporary_path, self.state_path)
+
+    def matches_hash(self) -> bool:
+        """
+        Hashes the complete .part file
+        :return: False if it isn't the copy whose hash was recorded (the owner changed the file while it was being
+                 downloaded), True if it is or no hash was recorded
+        """
+        if self.file_hash is None:
+            return True
+        return HashCache.read_digest(self.part_path)[0] == self.file_hash
+
+    def finish(self):
+        """
+        Moves the finished .part file to its real name and removes the record
+        :return:
+        """
+        os.replace(self.part_path, self.file_path)
+        self.state_path.unlink(missing_ok=True)
@@ -1,11 +1,16 @@
 from __future__ import annotations
+from .Immutable import Immutable
 
 
-class Peer:
+class Peer(Immutable):
+    """
+    A user on the network. Peers can't be changed once made, so they can be kept in sets and used as dict keys
+    """
+    __slots__ = ('addr', 'username')
 
     def __init__(self, addr: tuple[str, int], username: str):
-        self.addr: tuple[str, int] = addr
-        self.username: str = username
+        object.__setattr__(self, 'addr', tuple(addr))
+        object.__setattr__(self, 'username', username)
 
     def __dict__(self):
         return {'addr': self.addr, 'username': self.username}
@@ -14,8 +19,13 @@ class Peer:
         return f"{{{self.addr}, {self.username}}}"
 
     def __eq__(self, other: Peer):
+        if not isinstance(other, Peer):
+            return NotImplemented
         return (self.addr, self.username) == (other.addr, other.username)
 
+    def __hash__(self):
+        return hash((self.addr, self.username))
+
     @classmethod
     def from_dict(cls, data: dict):
         return Peer(tuple(data["addr"]), data["username"])
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import METRICS_LATENCY_BUCKETS
+
+import bisect
+
+
+class RequestMetrics:
+    """
+    What happened to one kind of request (a CRequest) on one side of the connection: how many there were and how they
+    ended, the bytes received and sent for them, and how long they took, counted in the buckets of
+    METRICS_LATENCY_BUCKETS (a histogram) so percentiles can be read off without keeping every latency.
+
+    Not thread safe on its own, Metrics_Functions holds a lock while recording and reading.
+    """
+
+    def __init__(self):
+        self.outcomes: dict[str, int] = {}  # 'ok', 'busy', 'timeout' or 'error' -> requests
+        self.bytes_received: int = 0
+        self.bytes_sent: int = 0
+        self.total_seconds: float = 0.0
+        self.max_seconds: float = 0.0
+        self.buckets: list[int] = [0] * (len(METRICS_LATENCY_BUCKETS) + 1)
+
+    @property
+    def count(self) -> int:
+        return sum(self.buckets)
+
+    def record(self, seconds: float, bytes_received: int, bytes_sent: int, outcome: str):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        self.bytes_received += bytes_received
+        self.bytes_sent += bytes_sent
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect.bisect_left(METRICS_LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        return self.bucket_percentile(self.buckets, self.max_seconds, fraction)
+
+    @staticmethod
+    def bucket_percentile(buckets: list[int], max_seconds: float, fraction: float) -> float:
+        """
+        :param buckets: counts in the buckets of METRICS_LATENCY_BUCKETS, and one more for anything slower
+        :param max_seconds: the slowest time counted
+        :param fraction: 0.99 for the 99th percentile
+        :return: the upper bound of the bucket the percentile falls in (the slowest time seen for the last bucket),
+                 so the real value is at most this
+        """
+        rank: float = fraction * sum(buckets)
+        seen: int = 0
+        for index, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if bucket_count and seen >= rank:
+                if index == len(METRICS_LATENCY_BUCKETS):
+                    return max_seconds
+                return min(METRICS_LATENCY_BUCKETS[index], max_seconds)
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {'count': self.count,
+                'outcomes': dict(self.outcomes),
+                'bytes_received': self.bytes_received,
+                'bytes_sent': self.bytes_sent,
+                'total_seconds': self.total_seconds,
+                'max_seconds': self.max_seconds,
+                'p50_seconds': self.percentile(0.5),
+                'p90_seconds': self.percentile(0.9),
+                'p99_seconds': self.percentile(0.99),
+                'bytes_per_second': (self.bytes_received + self.bytes_sent) / self.total_seconds
+                if self.total_seconds else 0.0,
+                'buckets': list(self.buckets)}
@@ -4,5 +4,9 @@ from enum import Enum
 class SRequest(Enum):
     """
     Ok: The server is done
+
+    Busy: The server is serving as many requests as it can (or as many of this type of request) and didn't take this
+          one. The client should try again later or ask another peer
     """
-    Ok = 1
\ No newline at end of file
+    Ok = 1
+    Busy = 2
@@ -5,9 +5,14 @@ from Classes.CRequest import CRequest
 # noinspection PyUnresolvedReferences
 from Classes.SRequest import SRequest
 
+from .Catalog import Catalog
 from .File import File
+from .MeteredSocket import MeteredSocket
+from .MuxSession import MuxSession, MuxStream
 from .Peer import Peer
 from .SyncFile import SyncFile
+from .UploadScheduler import UploadScheduler
+from .WorkerPool import WorkerPool
 
 # This error is ok because we are running relative from the run.py folder
 
@@ -15,12 +20,30 @@ from .SyncFile import SyncFile
 from Constants import (FIXED_LENGTH_HEADER,
                        C_REQUEST_BYTE_LENGTH,
                        S_REQUEST_BYTE_LENGTH,
-                       BUFFER_SIZE)
+                       BUFFER_SIZE,
+                       SERVER_BUSY_READ_TIMEOUT,
+                       GOSSIP_FANOUT,
+                       GOSSIP_EXTRA_ROUNDS,
+                       JSON_CODEC,
+                       WIRE_CODECS)
 
 # noinspection PyUnresolvedReferences
 from Helper_Functions import File_Functions as FF
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Chunk_Functions as CH
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Compression_Functions as CP
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Delta_Functions as DF
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Fan_Out_Functions as FO
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Metrics_Functions as MT
 
-import json
+import contextlib
+import itertools
+import math
+import random
 import socket
 import threading
 from pathlib import Path
@@ -35,19 +58,53 @@ class Server:
         self.addr: tuple[str, int] = addr
         self.socket: socket.socket | None = None
         self.username: str | None = None
-        self.initial_files: list[File] | None = []
+        self.initial_files: Catalog = Catalog()
+
+        # Requests on multiplexed connections are handed to this pool, a thread is started for each when it is None
+        self.worker_pool: WorkerPool | None = None
+        # The most requests of a type served at once, request types that aren't in here have no limit of their own
+        self.request_limits: dict[str, threading.BoundedSemaphore] = {}
 
     def create_TCP_socket(self) -> socket.socket:
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Connections accepted by it count their bytes for the request metrics
+        self.socket = MeteredSocket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.bind(self.addr)
         return self.socket
 
+    def set_request_limits(self, limits: dict[str, int]):
+        """
+        :param limits: the most requests of each type (CRequest name) to serve at the same time
+        :return:
+        """
+        self.request_limits = {request_type: threading.BoundedSemaphore(limit)
+                               for request_type, limit in limits.items()}
+
+    @contextlib.contextmanager
+    def request_slot(self, request_type: str):
+        """
+        Takes one of the slots of request_type for as long as the request is being served
+        :param request_type:
+        :return: yields False if every slot is taken and the request should be turned away
+        """
+        limit: threading.BoundedSemaphore | None = self.request_limits.get(request_type)
+        if limit is None:
+            yield True
+            return
+
+        if not limit.acquire(blocking=False):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            limit.release()
+
     def client_request(self,
                        connection_socket: socket,
                        peer_list: list[Peer],
-                       subscribed_sync_files: list[SyncFile],
-                       available_sync_files: list[SyncFile],
-                       available_files: list[File],
+                       subscribed_sync_files: Catalog,
+                       available_sync_files: Catalog,
+                       available_files: Catalog,
                        file_lock: threading.Lock,
                        sync_file_lock: threading.Lock,
                        peer_list_lock: threading.Lock,
@@ -57,77 +114,208 @@ class Server:
         request_type_bytes: bytes = connection_socket.recv(C_REQUEST_BYTE_LENGTH)
         request_type: str = request_type_bytes.rstrip(b'\x00').decode('utf-8')
 
-        with connection_socket:
+        upload_class: int = UploadScheduler.request_class(request_type)
+        with connection_socket, self.request_slot(request_type) as admitted, \
+                FF.UPLOAD_SCHEDULER.transfer(FF.connection_peer_host(connection_socket), upload_class), \
+                MT.measure(MT.SERVER, request_type, connection_socket) as measurement:
+            if not admitted:
+                measurement['outcome'] = MT.BUSY
+                self.send_Busy(connection_socket)
+                return
+
             # The request the client made
             """
             DO NOT FORGET ".name" AT THE END
             """
             match request_type:
                 case CRequest.AddMe.name:
-                    with peer_list_lock:
-                        self.send_Ok(connection_socket)
-                        self.add_client(connection_socket, peer_list)
+                    self.send_Ok(connection_socket)
+                    self.add_client(connection_socket, peer_list, peer_list_lock)
 
                 case CRequest.UserJoined.name:
-                    with peer_list_lock:
-                        self.send_Ok(connection_socket)
-                        self.receive_new_user(connection_socket, peer_list)
+                    self.send_Ok(connection_socket)
+                    self.receive_new_user(connection_socket, peer_list, peer_list_lock)
 
+                # The shared lists are only locked while they are copied (or a snapshot is taken) and while what a
+                # client sent is merged in, never while waiting on the client, so a slow client holds up nobody else
                 case CRequest.RequestPeerList.name:
                     """
                     The peer list is a fixed size which can overflow and include the ok if fast enough
                     When sending objects or anything for that matter, we will send the ok first
                     """
                     with peer_list_lock:
-                        self.send_Ok(connection_socket)
-                        self.send_peer_list(connection_socket, peer_list)
+                        current_peers: list[Peer] = list(peer_list)
+                    self.send_Ok(connection_socket)
+                    self.send_peer_list(connection_socket, current_peers)
 
                 case CRequest.SendFiles.name:
-                    with file_lock:
-                        self.send_Ok(connection_socket)
-                        """
-                        Todo: Add attribute called initial files to check for the case of when the server starts
-                        and a client requests a list of available files
-                        The available files does not include files the user already has before starting the program
-                        """
-                        FF.receive_files(connection_socket, available_files)
+                    self.send_Ok(connection_socket)
+                    """
+                    Todo: Add attribute called initial files to check for the case of when the server starts
+                    and a client requests a list of available files
+                    The available files does not include files the user already has before starting the program
+                    """
+                    FF.receive_files(connection_socket, available_files, file_lock)
 
                 case CRequest.RequestFiles.name:
                     with file_lock:
-                        self.send_Ok(connection_socket)
-                        FF.send_file_list(connection_socket, available_files + self.initial_files)
+                        snapshots: tuple[tuple, ...] = (available_files.snapshot(), self.initial_files.snapshot())
+                    self.send_Ok(connection_socket)
+                    FF.send_file_list(connection_socket, itertools.chain(*snapshots))
 
                 case CRequest.SendSyncFiles.name:
-                    with sync_file_lock:
-                        self.send_Ok(connection_socket)
-                        FF.receive_sync_files(connection_socket, available_sync_files)
+                    self.send_Ok(connection_socket)
+                    FF.receive_sync_files(connection_socket, available_sync_files, sync_file_lock)
 
                 case CRequest.RequestSyncFiles.name:
                     with sync_file_lock:
-                        self.send_Ok(connection_socket)
-                        # This sends all available SyncFiles to the client
-                        FF.send_sync_file_list(connection_socket, available_sync_files + subscribed_sync_files)
+                        snapshots = (available_sync_files.snapshot(), subscribed_sync_files.snapshot())
+                    self.send_Ok(connection_socket)
+                    # This sends all available SyncFiles to the client
+                    FF.send_sync_file_list(connection_socket, itertools.chain(*snapshots))
 
                 case CRequest.DownloadFile.name:
                     self.send_Ok(connection_socket)
                     self.send_file_for_download(connection_socket)
 
+                case CRequest.DownloadFileRange.name:
+                    self.send_Ok(connection_socket)
+                    self.send_file_for_download(connection_socket, ranged=True)
+
+                case CRequest.DownloadFileChunks.name:
+                    self.send_Ok(connection_socket)
+                    self.send_file_chunks(connection_socket)
+
                 case CRequest.SubscribeFile.name:
-                    with sync_file_lock:
-                        self.send_Ok(connection_socket)
-                        self.add_user_send_sync_file(connection_socket, subscribed_sync_files)
+                    self.send_Ok(connection_socket)
+                    self.add_user_send_sync_file(connection_socket, subscribed_sync_files, sync_file_lock)
 
                 case CRequest.UserSubscribed.name:
-                    with sync_file_lock:
-                        self.send_Ok(connection_socket)
-                        self.receive_new_subscribed_user(connection_socket, subscribed_sync_files)
+                    self.send_Ok(connection_socket)
+                    self.receive_new_subscribed_user(connection_socket, subscribed_sync_files, sync_file_lock)
 
                 case CRequest.SyncFileUpdate.name:
-                    with sync_file_lock:
-                        self.send_Ok(connection_socket)
-                        self.receive_sync_file_update(connection_socket, subscribed_sync_files)
+                    self.send_Ok(connection_socket)
+                    self.receive_sync_file_update(connection_socket, subscribed_sync_files)
+
+                case CRequest.SyncFileUpdateChunks.name:
+                    self.send_Ok(connection_socket)
+                    self.receive_sync_file_chunks(connection_socket, subscribed_sync_files)
+
+                case CRequest.Multiplex.name:
+                    self.send_Ok(connection_socket)
+                    self.serve_multiplexed(connection_socket,
+                                           (peer_list,
+                                            subscribed_sync_files,
+                                            available_sync_files,
+                                            available_files,
+                                            file_lock,
+                                            sync_file_lock,
+                                            peer_list_lock,))
+
+                case CRequest.Codecs.name:
+                    self.send_Ok(connection_socket)
+                    self.choose_codec(connection_socket)
+
+                case CRequest.Compressions.name:
+                    self.send_Ok(connection_socket)
+                    self.choose_compressions(connection_socket)
+
+                case CRequest.Stats.name:
+                    self.send_Ok(connection_socket)
+                    FF.send_stats(connection_socket, MT.node_stats())
 
+                case CRequest.RequestFilesSince.name:
+                    self.send_Ok(connection_socket)
+                    self.send_catalog_changes(connection_socket, (available_files, self.initial_files), file_lock)
+
+                case CRequest.RequestSyncFilesSince.name:
+                    self.send_Ok(connection_socket)
+                    self.send_catalog_changes(connection_socket, (available_sync_files, subscribed_sync_files),
+                                              sync_file_lock)
+
+    def serve_multiplexed(self, connection_socket: socket.socket, request_args: tuple):
+        """
+        Keeps the connection open as a MuxSession until the client closes it. Every stream the client opens is a
+        request of its own and is served by client_request on a new thread, so a large transfer on one stream
+        doesn't hold up the others
+        :param connection_socket:
+        :param request_args: the arguments client_request was called with, after the connection
+        :return:
+        """
+        def serve_stream(stream: MuxStream):
+            if self.worker_pool is None:
+                threading.Thread(target=self.client_request, args=(stream, *request_args), daemon=True).start()
+            elif not self.worker_pool.submit(self.client_request, stream, *request_args):
+                self.turn_away(stream)
 
+        # Requests on the session can take as long as they need, like requests on their own connection
+        connection_socket.settimeout(None)
+
+        # The session lasts for as long as the peer stays connected, so it gets a thread of its own instead of holding
+        # on to the worker (or connection thread) that received the Multiplex request, which closes its socket after
+        session_socket: socket.socket = connection_socket.dup()
+        session: MuxSession = MuxSession(session_socket, is_client=False, on_new_stream=serve_stream)
+        threading.Thread(target=session.run, daemon=True).start()
+
+    @staticmethod
+    def send_catalog_changes(connection_socket, catalogs: tuple[Catalog, ...], lock: threading.Lock):
+        """
+        Receives the (epoch, version) the client's last answer ended at and sends what changed in catalogs since.
+        The lock is only held while the changes are collected
+        :param connection_socket:
+        :param catalogs: catalogs sharing one change log
+        :param lock: the lock of catalogs
+        :return:
+        """
+        (epoch, version), _ = FF.decode_catalog_cursor(FF.receive_payload(connection_socket))
+
+        with lock:
+            cursor, full, added, removed = Catalog.changes_since(catalogs, epoch, version)
+
+        FF.send_catalog_changes(connection_socket, cursor, full, added, removed)
+
+    def choose_codec(self, connection_socket):
+        """
+        Answers a Codecs request. The chosen encoding is used for every stream of the multiplexed connection the
+        request came on, any other connection keeps using JSON
+        :param connection_socket:
+        :return:
+        """
+        offer: bytes = FF.receive_payload(connection_socket)
+
+        session = getattr(connection_socket, 'session', None)
+        codec: str = self.pick_codec(offer) if session is not None else JSON_CODEC
+        if session is not None:
+            session.codec = codec
+
+        FF.send_payload(connection_socket, codec.encode('utf-8'))
+
+    @staticmethod
+    def choose_compressions(connection_socket):
+        """
+        Answers a Compressions request. Like the codec, the answer holds for every stream of the multiplexed connection
+        the request came on, any other connection isn't compressed
+        :param connection_socket:
+        :return:
+        """
+        offer: bytes = FF.receive_payload(connection_socket)
+
+        session = getattr(connection_socket, 'session', None)
+        compressions: tuple[str, ...] = CP.pick_compressions(offer) if session is not None else ()
+        if session is not None:
+            session.compressions = compressions
+
+        FF.send_payload(connection_socket, ','.join(compressions).encode('utf-8'))
+
+    @staticmethod
+    def pick_codec(offer: bytes) -> str:
+        """
+        :param offer: the comma separated encodings the client understands, preferred first
+        :return: the first one this peer understands too
+        """
+        offered: list[str] = offer.decode('utf-8').split(',')
+        return next((codec for codec in offered if codec in WIRE_CODECS), JSON_CODEC)
 
     @classmethod
     def send_Ok(cls, connection_socket):
@@ -136,102 +324,179 @@ class Server:
 
         connection_socket.sendall(response_bytes)
 
-    def add_client(self, connection_socket: socket, peer_list: list[Peer]):
+    @classmethod
+    def send_Busy(cls, connection_socket):
+        response: str = SRequest.Busy.name
+        response_bytes: bytes = response.encode('utf-8').ljust(S_REQUEST_BYTE_LENGTH, b'\x00')
+
+        connection_socket.sendall(response_bytes)
+
+    @classmethod
+    def turn_away(cls, connection_socket):
+        """
+        Answers a connection that can't be served right now with Busy and closes it. The request is read first,
+        closing a socket with unread data resets the connection and the client could lose the answer
+        :param connection_socket:
+        :return:
+        """
+        with connection_socket:
+            try:
+                connection_socket.settimeout(SERVER_BUSY_READ_TIMEOUT)
+                connection_socket.recv(C_REQUEST_BYTE_LENGTH)
+                cls.send_Busy(connection_socket)
+            except OSError:
+                pass
+
+    def add_client(self, connection_socket: socket, peer_list: list[Peer], peer_list_lock: threading.Lock):
         """
-        This function receives a Peer Object from the connection_socket, adds modifies the given list by adding it
+        This function receives a Peer Object from the connection_socket, adds modifies the given list by adding it.
+        The news is then gossiped to a few random peers, which pass it on, instead of this server telling every peer
+        itself. The lock is released first, so a slow peer doesn't hold up requests for the peer list
         :param connection_socket:
         :param peer_list:
+        :param peer_list_lock:
         :return:
         """
         user_as_peer: Peer = FF.receive_Peer(connection_socket)
 
-        #If the user is already in the network, move on. Think about the first two connections
-        if user_as_peer in peer_list:
-            return
+        with peer_list_lock:
+            #If the user is already in the network, move on. Think about the first two connections
+            if user_as_peer in peer_list:
+                return
 
-        self.send_new_user_to_peers(user_as_peer, peer_list)
+            targets: list[Peer] = self.gossip_targets(user_as_peer, peer_list)
+            ttl: int = self.gossip_ttl(len(peer_list) + 1)
+            peer_list.append(user_as_peer)
 
-        peer_list.append(user_as_peer)
+        self.send_new_user_to_peers(user_as_peer, targets, ttl)
+
+    def gossip_targets(self, new_user: Peer, peer_list: list[Peer]) -> list[Peer]:
+        """
+        :param new_user:
+        :param peer_list:
+        :return: up to GOSSIP_FANOUT random peers to pass news of new_user on to
+        """
+        excluded: set[Peer] = {new_user, Peer(self.addr, self.username)}
+        candidates: list[Peer] = [peer for peer in peer_list if peer not in excluded]
+        return random.sample(candidates, min(GOSSIP_FANOUT, len(candidates)))
+
+    @staticmethod
+    def gossip_ttl(network_size: int) -> int:
+        """
+        The amount of times news of a new user is passed on. Every round reaches GOSSIP_FANOUT times as many peers, so
+        about log(network_size) rounds reach everyone, plus a few in case some peers already knew
+        :param network_size:
+        :return:
+        """
+        rounds: int = math.ceil(math.log(max(network_size, 2), GOSSIP_FANOUT)) + GOSSIP_EXTRA_ROUNDS
+        return min(rounds, 255)
 
     @staticmethod
-    def send_new_user_to_peers(new_user: Peer, peer_list: list[Peer]):
+    def send_new_user_to_peers(new_user: Peer, peer_list: list[Peer], ttl: int = 0):
         """
         This method sends new users to peers and informs them using the CRequest of UserJoined that they only need to
-        update their peer list
+        update their peer list. All peers are told at the same time.
+        The Peer is followed by one byte, the amount of times the receiver should pass the news on
         :param new_user:
         :param peer_list:
+        :param ttl:
         :return:
         """
+        def send_new_user(peer: Peer):
+            with FF.open_peer_stream(peer.addr, 20) as server_socket:
+                # automatically OK's
+                FF.send_peer_with_request(server_socket, new_user, CRequest.UserJoined)
 
-        for peer in peer_list:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-                try:
-                    server_socket.settimeout(20)
-                    server_socket.connect(peer.addr)
-
-                    # automatically OK's
-                    FF.send_peer_with_request(server_socket, new_user, CRequest.UserJoined)
+                server_socket.sendall(bytes([ttl]))
 
-                except TimeoutError:
-                    pass
-                except Exception as e:
-                    print(f"[Error] Failed to send to {peer.addr}: {e}")
+        results: dict[tuple[str, int], object] = FO.fan_out(peer_list, send_new_user, 20)
+        FO.report_failures(results, "send the new user to")
 
-    @staticmethod
-    def receive_new_user(connection_socket: socket.socket, peer_list: list[Peer]):
+    def receive_new_user(self, connection_socket: socket.socket, peer_list: list[Peer],
+                         peer_list_lock: threading.Lock):
         """
-        Todo: If the peer is already in the peer list, then what?
+        Adds the new user and, if this peer didn't know about them yet, passes the news on to GOSSIP_FANOUT random
+        peers. Senders that don't send the amount of rounds left are treated as if none were left
         :param connection_socket:
         :param peer_list:
+        :param peer_list_lock:
         :return:
         """
 
         user_as_peer: Peer = FF.receive_Peer(connection_socket)
+        ttl_bytes: bytes = connection_socket.recv(1)
+        ttl: int = ttl_bytes[0] if ttl_bytes else 0
 
-        # If the user is already in the network, move on.
-        if user_as_peer in peer_list:
-            return
+        with peer_list_lock:
+            # If the user is already in the network, move on. The news has reached this peer before, so it has
+            # already been passed on from here
+            if user_as_peer in peer_list or user_as_peer == Peer(self.addr, self.username):
+                return
+
+            targets: list[Peer] = self.gossip_targets(user_as_peer, peer_list) if ttl > 1 else []
+            peer_list.append(user_as_peer)
 
-        peer_list.append(user_as_peer)
+        if targets:
+            self.send_new_user_to_peers(user_as_peer, targets, ttl - 1)
 
     def send_peer_list(self, connection_socket: socket.socket, peer_list: list[Peer]):
         # Always make sure to handle empty case
         modified_peer_list: list[Peer] = list(peer_list)
         modified_peer_list.append(Peer(self.addr, self.username))
 
-        """
-        Checking for empty is unnecessary but just in case I forget how to in the future
-        """
-        json_peer_list: str = json.dumps([peer.__dict__() for peer in modified_peer_list])  # if peer_list else '[]'
-        bytes_peer_list: bytes = json_peer_list.encode('utf-8')
+        payload: bytes = FF.encode_object_list(modified_peer_list, FF.connection_codec(connection_socket))
+        FF.send_payload(connection_socket, CP.compress_payload(connection_socket, payload))
 
-        data_length: int = len(bytes_peer_list)
-        connection_socket.sendall(data_length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
-
-        connection_socket.sendall(bytes_peer_list)
-
-    def send_file_for_download(self, connection_socket: socket.socket):
+    def send_file_for_download(self, connection_socket: socket.socket, ranged: bool = False):
         """
-         1. Receive File Object (Send Ok after)
-         2. Get Size of File with the File Object's name
-         3. Send Length of file
-         4. Send File
+         1. Receive File Object
+         2. If ranged, receive the offset and length of the wanted piece (Send Ok after)
+         3. Send Length of file (and for ranged requests, the length of the piece)
+         4. Send File (or the piece)
          :param connection_socket:
+         :param ranged: True for DownloadFileRange requests
          :return:
          """
         requested_file: File = FF.receive_File(connection_socket)
 
+        if ranged:
+            offset: int = int.from_bytes(connection_socket.recv(FIXED_LENGTH_HEADER), 'big')
+            length: int = int.from_bytes(connection_socket.recv(FIXED_LENGTH_HEADER), 'big')
+
         # [DEBUG] Send ok is working
         self.send_Ok(connection_socket)
 
-        FF.send_full_file(connection_socket, requested_file)
+        if ranged:
+            FF.send_file_range(connection_socket, requested_file, offset, length)
+        else:
+            FF.send_full_file(connection_socket, requested_file)
+
+    @staticmethod
+    def send_file_chunks(connection_socket: socket.socket):
+        """
+        1. Receive File Object (Send Ok after)
+        2. Send the chunk list of the file and receive the chunks the client wants
+        3. Send those chunks
+        :param connection_socket:
+        :return:
+        """
+        requested_file: File = FF.receive_File(connection_socket)
+
+        Server.send_Ok(connection_socket)
 
-    def add_user_send_sync_file(self, connection_socket: socket.socket, subscribed_sync_files: list[SyncFile]):
+        CH.send_chunks(connection_socket, FF.FILES_DIRECTORY / requested_file.filename)
+
+    def add_user_send_sync_file(self, connection_socket: socket.socket, subscribed_sync_files: Catalog,
+                                sync_file_lock: threading.Lock):
         """
         Todo: The server should then send this user to other peers to let them know an update occurred
         Todo: The subscribe list should be passed so this method can this user to subscribed users
+        The file's lock (see File_Functions.SYNC_FILE_LOCKS) is held from sending the file until the new subscriber is
+        added, so no update of the file is sent or received in between, and let go of before the other subscribers are
+        told. sync_file_lock is only held to look at and change subscribed_sync_files, so other files aren't held up
         :param connection_socket:
         :param subscribed_sync_files:
+        :param sync_file_lock: the lock of subscribed_sync_files
         :return:
         """
         new_user: Peer = FF.receive_Peer(connection_socket)
@@ -242,65 +507,115 @@ class Server:
 
         self.send_Ok(connection_socket)
 
+        with FF.SYNC_FILE_LOCKS.lock(requested_sync_file.filename):
+            with sync_file_lock:
+                subscribed: bool = requested_sync_file in subscribed_sync_files
+            """
+            Todo: In future implementation, this case should be handled
+            """
+            if not subscribed:
+                return
 
+            FF.send_full_sync_file(connection_socket, requested_sync_file)
 
-        """
-        Todo: In future implementation, this case should be handled
-        """
-        if requested_sync_file not in subscribed_sync_files:
+            # Add user to user list. The subscribers this user knows of can be more up to date than the requester's copy
+            with sync_file_lock:
+                requested_sync_file = self.add_subscriber(subscribed_sync_files, requested_sync_file.filename,
+                                                          new_user)
+        if requested_sync_file is None:
             return
 
-        FF.send_full_sync_file(connection_socket, requested_sync_file)
-
-        # Add user to user list
-        for sync_file in subscribed_sync_files:
-            if sync_file == requested_sync_file:
-                sync_file.users_subbed.append(new_user)
-                break
-
         # Send this sync_file to users who are subbed to the file (excluding user who just joined)
         this_user_as_peer: Peer = Peer(self.addr, self.username)
 
-        for index, peer in enumerate(requested_sync_file.users_subbed):
-            if peer != new_user and peer != this_user_as_peer:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-                    try:
-                        server_socket.settimeout(20)
-                        server_socket.connect(peer.addr)
+        def send_subscribed_user(peer: Peer):
+            with FF.open_peer_stream(peer.addr, 20) as server_socket, \
+                    MT.measure(MT.CLIENT, CRequest.UserSubscribed, server_socket):
+                FF.send_request(server_socket, CRequest.UserSubscribed)
 
-                        FF.send_request(server_socket, CRequest.UserSubscribed)
+                FF.receive_Ok(server_socket)
 
-                        FF.receive_Ok(connection_socket)
+                FF.send_Peer(server_socket, new_user)
 
-                        FF.send_Peer(connection_socket, new_user)
+                FF.receive_Ok(server_socket)
 
-                        FF.receive_Ok(connection_socket)
+                FF.send_sync_file(server_socket, requested_sync_file)
 
-                        FF.send_sync_file(connection_socket, requested_sync_file)
-
-                    except TimeoutError:
-                        pass
-                    except Exception as e:
-                        print(f"[Error] Failed to send to {peer.addr}: {e}")
+        excluded: set[Peer] = {new_user, this_user_as_peer}
+        other_subscribers: list[Peer] = [peer for peer in requested_sync_file.users_subbed if peer not in excluded]
+        results: dict[tuple[str, int], object] = FO.fan_out(other_subscribers, send_subscribed_user, 20)
+        FO.report_failures(results, "send the new subscriber to")
 
     @staticmethod
-    def receive_new_subscribed_user(connection_socket: socket.socket, subscribed_sync_files):
+    def receive_new_subscribed_user(connection_socket: socket.socket, subscribed_sync_files,
+                                    sync_file_lock: threading.Lock):
         subscribed_peer = FF.receive_Peer(connection_socket)
 
         Server.send_Ok(connection_socket)
 
         new_user_sync_file = FF.receive_SyncFile(connection_socket)
 
-        for sync_file in subscribed_sync_files:
-            if new_user_sync_file.filename == sync_file.filename:
-                sync_file.users_subbed.append(subscribed_peer)
+        with sync_file_lock:
+            Server.add_subscriber(subscribed_sync_files, new_user_sync_file.filename, subscribed_peer)
+
+    @staticmethod
+    def add_subscriber(subscribed_sync_files: Catalog, filename: str, peer: Peer) -> SyncFile | None:
+        """
+        SyncFiles can't be changed, so the SyncFile named filename is replaced by a copy with peer subscribed
+        :param subscribed_sync_files: must be locked by the caller
+        :param filename:
+        :param peer:
+        :return: the new SyncFile, or None if this user isn't subscribed to filename
+        """
+        sync_file: SyncFile | None = subscribed_sync_files.get(filename)
+        if sync_file is None:
+            return None
+
+        updated_sync_file: SyncFile = sync_file.with_user(peer)
+        if updated_sync_file is not sync_file:
+            subscribed_sync_files.replace(updated_sync_file)
+        return updated_sync_file
 
     @staticmethod
     def receive_sync_file_update(connection_socket, subscribed_sync_files):
+        """
+        1. Receive the SyncFile object (Send Ok after)
+        2. Send the block signatures of this server's copy of the file
+        3. Receive the delta and rebuild the file from it (Send Ok after)
+        Steps 2 and 3 hold the file's lock, so updates of the same file are applied one at a time
+        :param connection_socket:
+        :param subscribed_sync_files:
+        :return:
+        """
         updated_sync_file: SyncFile = FF.receive_SyncFile(connection_socket)
 
+        with FF.SYNC_FILE_LOCKS.lock(updated_sync_file.filename):
+            Server.send_Ok(connection_socket)
+
+            file_path: Path = FF.SYNC_FILES_DIRECTORY / updated_sync_file.filename
+
+            block_size: int = DF.send_signatures(connection_socket, file_path)
+
+            DF.receive_delta(connection_socket, file_path, block_size)
+
         Server.send_Ok(connection_socket)
 
-        FF.download_sync_file(connection_socket, updated_sync_file)
+    @staticmethod
+    def receive_sync_file_chunks(connection_socket, subscribed_sync_files):
+        """
+        1. Receive the SyncFile object (Send Ok after)
+        2. Receive the chunk list of the sender's copy and send back which chunks aren't found locally
+        3. Receive those chunks and rebuild the file from them (Send Ok after)
+        Steps 2 and 3 hold the file's lock, so updates of the same file are applied one at a time
+        :param connection_socket:
+        :param subscribed_sync_files:
+        :return:
+        """
+        updated_sync_file: SyncFile = FF.receive_SyncFile(connection_socket)
+
+        with FF.SYNC_FILE_LOCKS.lock(updated_sync_file.filename):
+            Server.send_Ok(connection_socket)
+
+            CH.receive_file(connection_socket, FF.SYNC_FILES_DIRECTORY / updated_sync_file.filename)
 
         Server.send_Ok(connection_socket)
@@ -0,0 +1,5 @@
+class ServerBusyError(ValueError):
+    """
+    Raised on the client side when a server answers a request with SRequest.Busy instead of Ok. It is a ValueError
+    like any other unexpected answer, so code that doesn't care why a request failed handles it the same way
+    """
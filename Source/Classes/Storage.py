@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from .UploadScheduler import UploadScheduler
+
+# noinspection PyUnresolvedReferences
+from Constants import STORAGE_VIEW_SIZE
+
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class Storage:
+    """
+    Where the files of one folder (Files or SyncFiles) are kept, and how they are read, sent and written. Server and
+    File_Functions go through a Storage instead of opening files themselves, so the same code serves files from disk
+    (DiskStorage) or from memory (MemoryStorage, for tests and benchmarks).
+
+    Files are named by their filename, the name File and SyncFile objects carry. What only works on a file on disk
+    (resumable downloads, the chunk index, SyncFile hashes and deltas) uses path(), which is None when there isn't one.
+    """
+
+    def size(self, name: str) -> int:
+        """
+        :param name:
+        :return: the size of the file, raises FileNotFoundError if there is no such file
+        """
+        raise NotImplementedError
+
+    def path(self, name: str) -> Path | None:
+        """
+        :param name:
+        :return: where the file is on disk, None if this storage doesn't keep files on disk
+        """
+        return None
+
+    def exists(self, name: str) -> bool:
+        try:
+            self.size(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def pieces(self, name: str, offset: int = 0, length: int | None = None, piece_size: int = STORAGE_VIEW_SIZE):
+        """
+        Reads part of the file a piece at a time. The range is cut short at the end of the file
+        :param name:
+        :param offset:
+        :param length: None for the rest of the file
+        :param piece_size: the most bytes in a piece
+        :return: yields read-only memoryviews of the pieces, each only valid until the next one is asked for
+        """
+        raise NotImplementedError
+
+    def read(self, name: str, offset: int, length: int) -> bytes:
+        """
+        :param name:
+        :param offset:
+        :param length:
+        :return: part of the file, for small ranges. The range is cut short at the end of the file
+        """
+        return b''.join([bytes(piece) for piece in self.pieces(name, offset, length)])
+
+    @contextmanager
+    def open_write(self, name: str):
+        """
+        A binary file to write a new copy of the file to. The copy replaces the file when the block ends, and is thrown
+        away if the block raises
+        :param name:
+        :return:
+        """
+        raise NotImplementedError
+
+    def send_range(self, connection_socket, name: str, offset: int, length: int) -> int:
+        """
+        Sends length bytes of the file, starting at offset, paced by the UploadScheduler
+        :param connection_socket:
+        :param name:
+        :param offset:
+        :param length: the amount of bytes the receiver was told to expect
+        :return: the amount of bytes sent
+        """
+        sent: int = 0
+        for piece in self.pieces(name, offset, length, min(STORAGE_VIEW_SIZE, UploadScheduler.piece_size(length))):
+            UploadScheduler.pace(len(piece))
+            connection_socket.sendall(piece)
+            sent += len(piece)
+        return sent
+
+    async def send_range_async(self, channel, name: str, offset: int, length: int) -> int:
+        """
+        Same as send_range, for the channels of the AsyncServer
+        :param channel:
+        :param name:
+        :param offset:
+        :param length:
+        :return:
+        """
+        sent: int = 0
+        for piece in self.pieces(name, offset, length, min(STORAGE_VIEW_SIZE, UploadScheduler.piece_size(length))):
+            await UploadScheduler.pace_async(len(piece))
+            await channel.sendall(piece)
+            sent += len(piece)
+        return sent
@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+from .CRequest import CRequest
+from .File import File
+from .MeteredSocket import MeteredSocket
+from .PartialDownload import PartialDownload
+from .ServerBusyError import ServerBusyError
+
+# noinspection PyUnresolvedReferences
+from Constants import (SWARM_PIECE_SIZE,
+                       SWARM_PIECE_TIMEOUT,
+                       SWARM_MAX_PEER_FAILURES,
+                       SWARM_SLOW_PEER_RATIO,
+                       SERVER_BUSY_RETRY_DELAY)
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Metrics_Functions as MT
+
+from collections import deque
+import socket
+import threading
+import time
+from pathlib import Path
+
+
+class SwarmDownload:
+    """
+    Downloads a single file from every peer that has it at the same time.
+
+    The file is split in to fixed size pieces. Each source peer gets its own thread which keeps asking for the next
+    piece that nobody has downloaded yet (DownloadFileRange), so fast peers end up serving more pieces than slow ones.
+    A peer that is SWARM_SLOW_PEER_RATIO times slower than the fastest peer stops taking new pieces while faster
+    peers are still around, and a peer is dropped after SWARM_MAX_PEER_FAILURES failed pieces (its pieces go back in
+    to the queue). Once every piece has been handed out, idle fast peers also request pieces still in flight on
+    other peers so one slow peer can't hold up the end of the download.
+
+    Pieces are written in to a PartialDownload. The sources don't send the hash of their copy, so the pieces can't be
+    checked against a later copy and a swarm download that fails part way starts over the next time.
+    """
+
+    def __init__(self, sources: list[File], piece_size: int = SWARM_PIECE_SIZE):
+        self.sources: list[File] = list(sources)
+        self.piece_size: int = piece_size
+        self.file_size: int = 0
+        self.piece_count: int = 0
+
+        self.condition: threading.Condition = threading.Condition()
+        self.pending: deque[int] = deque()
+        self.fetching: dict[int, set[tuple[str, int]]] = {}  # piece -> addresses currently downloading it
+        self.completed: set[int] = set()
+
+        self.active: set[tuple[str, int]] = set()
+        self.rates: dict[tuple[str, int], float] = {}  # bytes per second, averaged over the pieces of each peer
+        self.failures: dict[tuple[str, int], int] = {}
+        self.pieces_served: dict[tuple[str, int], int] = {}
+
+        self.partial: PartialDownload | None = None
+        self.last_save: float = 0.0
+
+    @property
+    def filename(self) -> str:
+        return self.sources[0].filename
+
+    def run(self) -> bool:
+        """
+        Downloads the file in to the Files directory
+        :return: True if every piece was downloaded
+        """
+        if not self.probe_sources():
+            print(f"None of the peers were able to send {self.filename}")
+            return False
+
+        self.partial = PartialDownload(self.filename, FF.FILES_DIRECTORY, self.piece_size)
+        # The sources don't send the hash of their copy, so pieces from an earlier download can't be kept
+        self.partial.resume_or_start(self.file_size)
+        file_path: Path = self.partial.part_path
+
+        self.piece_count = self.partial.piece_count
+        self.completed = set(self.partial.completed)
+        self.pending = deque(self.partial.missing_pieces())
+        self.active = {source.addr for source in self.sources}
+
+        workers: list[threading.Thread] = [threading.Thread(target=self.worker, args=(source, file_path), daemon=True)
+                                           for source in self.sources]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        finally:
+            with self.condition:
+                self.partial.save()
+
+        if len(self.completed) != self.piece_count:
+            print(f"Only {len(self.completed)} of {self.piece_count} pieces of {self.filename} could be downloaded")
+            return False
+
+        self.partial.finish()
+
+        for addr, served in self.pieces_served.items():
+            print(f"|   {served} pieces from {addr}")
+        return True
+
+    def probe_sources(self) -> bool:
+        """
+        Asks every source for the size of the file. Sources that disagree with the most common size have a different
+        file under the same name and are not used.
+        :return: False if no source answered
+        """
+        sizes: dict[tuple[str, int], int] = {}
+
+        def probe(source: File):
+            try:
+                with MeteredSocket(socket.AF_INET, socket.SOCK_STREAM) as user_socket, \
+                        MT.measure(MT.CLIENT, CRequest.DownloadFileRange, user_socket):
+                    user_socket.settimeout(SWARM_PIECE_TIMEOUT)
+                    user_socket.connect(source.addr)
+                    file_size, _ = FF.request_file_range(user_socket, source, 0, 0)
+                    sizes[source.addr] = file_size
+            except (OSError, ValueError) as e:
+                print(f"[Error] {source.addr} could not be used for {source.filename}: {e}")
+
+        probes: list[threading.Thread] = [threading.Thread(target=probe, args=(source,), daemon=True)
+                                          for source in self.sources]
+        for thread in probes:
+            thread.start()
+        for thread in probes:
+            thread.join()
+
+        if not sizes:
+            return False
+
+        size_counts: dict[int, int] = {}
+        for file_size in sizes.values():
+            size_counts[file_size] = size_counts.get(file_size, 0) + 1
+        self.file_size = max(size_counts, key=size_counts.get)
+
+        self.sources = [source for source in self.sources if sizes.get(source.addr) == self.file_size]
+        return True
+
+    def worker(self, source: File, file_path: Path):
+        buffer: bytearray = bytearray(self.piece_size)
+
+        try:
+            with open(file_path, 'r+b') as f:
+                while (piece := self.next_piece(source.addr)) is not None:
+                    try:
+                        start: float = time.perf_counter()
+                        length: int = self.fetch_piece(source, piece, f, buffer)
+                        elapsed: float = max(time.perf_counter() - start, 1e-6)
+                    except ServerBusyError:
+                        # The other peers take the piece while this one waits. When no other peer is left, being
+                        # busy counts as a failure so the download doesn't wait forever
+                        if self.has_other_peer(source.addr):
+                            self.piece_returned(source.addr, piece)
+                        else:
+                            self.piece_failed(source.addr, piece)
+                        time.sleep(SERVER_BUSY_RETRY_DELAY)
+                        continue
+                    except (OSError, ValueError) as e:
+                        print(f"[Error] Piece {piece} from {source.addr} failed: {e}")
+                        self.piece_failed(source.addr, piece)
+                        continue
+
+                    self.piece_done(source.addr, piece, length / elapsed)
+        finally:
+            with self.condition:
+                self.active.discard(source.addr)
+                self.condition.notify_all()
+
+    def next_piece(self, addr: tuple[str, int]) -> int | None:
+        """
+        Blocks until there is a piece for this peer to download
+        :param addr:
+        :return: the index of the piece or None when this peer has nothing left to do
+        """
+        with self.condition:
+            while len(self.completed) < self.piece_count and addr in self.active:
+                slow: bool = self.is_slow(addr)
+
+                if self.pending and not (slow and self.has_faster_peer(addr)):
+                    piece: int = self.pending.popleft()
+                    self.fetching.setdefault(piece, set()).add(addr)
+                    return piece
+
+                # End game, every piece has been handed out. Help with pieces still in flight on other peers
+                if not self.pending and not slow:
+                    for piece, fetchers in self.fetching.items():
+                        if addr not in fetchers:
+                            fetchers.add(addr)
+                            return piece
+
+                self.condition.wait(0.5)
+
+            return None
+
+    def fetch_piece(self, source: File, piece: int, f, buffer: bytearray) -> int:
+        """
+        Downloads one piece and writes it to its place in the file
+        :return: the amount of bytes received
+        """
+        offset: int = piece * self.piece_size
+        expected_length: int = min(self.piece_size, self.file_size - offset)
+
+        with MeteredSocket(socket.AF_INET, socket.SOCK_STREAM) as user_socket, \
+                MT.measure(MT.CLIENT, CRequest.DownloadFileRange, user_socket):
+            user_socket.settimeout(SWARM_PIECE_TIMEOUT)
+            user_socket.connect(source.addr)
+
+            file_size, length = FF.request_file_range(user_socket, source, offset, expected_length)
+            if file_size != self.file_size or length != expected_length:
+                raise ValueError(f"Expected {expected_length} of {self.file_size} bytes, got {length} of {file_size}")
+
+            view: memoryview = memoryview(buffer)[:length]
+            received_size: int = 0
+            while received_size < length:
+                received = user_socket.recv_into(view[received_size:])
+                if not received:
+                    raise ConnectionError("Connection closed before full piece received")
+                received_size += received
+
+                # Another peer finished this piece first during the end game
+                if piece in self.completed:
+                    return received_size
+
+        f.seek(offset)
+        f.write(view)
+        return length
+
+    def piece_done(self, addr: tuple[str, int], piece: int, rate: float):
+        with self.condition:
+            previous_rate: float | None = self.rates.get(addr)
+            self.rates[addr] = rate if previous_rate is None else (previous_rate + rate) / 2
+
+            if piece not in self.completed:
+                self.completed.add(piece)
+                self.fetching.pop(piece, None)
+                self.pieces_served[addr] = self.pieces_served.get(addr, 0) + 1
+
+                # Record progress every so often so an interrupted download can be resumed
+                self.partial.mark_piece(piece)
+                if time.monotonic() - self.last_save > 1:
+                    self.partial.save()
+                    self.last_save = time.monotonic()
+
+            self.condition.notify_all()
+
+    def piece_returned(self, addr: tuple[str, int], piece: int):
+        """
+        Puts a piece this peer didn't download back in the queue, unless another peer is still working on it
+        """
+        with self.condition:
+            fetchers: set[tuple[str, int]] = self.fetching.get(piece, set())
+            fetchers.discard(addr)
+            if piece not in self.completed and not fetchers:
+                self.fetching.pop(piece, None)
+                self.pending.appendleft(piece)
+
+            self.condition.notify_all()
+
+    def piece_failed(self, addr: tuple[str, int], piece: int):
+        self.piece_returned(addr, piece)
+
+        with self.condition:
+            self.failures[addr] = self.failures.get(addr, 0) + 1
+            if self.failures[addr] >= SWARM_MAX_PEER_FAILURES:
+                print(f"Dropping {addr} from the download of {self.filename}")
+                self.active.discard(addr)
+
+            self.condition.notify_all()
+
+    def is_slow(self, addr: tuple[str, int]) -> bool:
+        rate: float | None = self.rates.get(addr)
+        if rate is None:
+            return False
+        best_rate: float = max(self.rates[a] for a in self.active if a in self.rates)
+        return rate * SWARM_SLOW_PEER_RATIO < best_rate
+
+    def has_faster_peer(self, addr: tuple[str, int]) -> bool:
+        return any(a != addr and not self.is_slow(a) for a in self.active)
+
+    def has_other_peer(self, addr: tuple[str, int]) -> bool:
+        with self.condition:
+            return any(a != addr for a in self.active)
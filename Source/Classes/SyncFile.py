@@ -1,31 +1,50 @@
 from __future__ import annotations
+from .Immutable import Immutable
 from .Peer import Peer
 
 
-class SyncFile:
+class SyncFile(Immutable):
+    """
+    A file kept the same on every subscribed user. There is one SyncFile per filename on the network, so SyncFiles
+    are equal (and hash the same) when their filenames are, whatever subscribers each copy knows about.
+
+    SyncFiles can't be changed once made. A subscriber is added or removed by replacing the SyncFile with the copy
+    with_user or without_user returns, so a thread still working with the old SyncFile never sees it change.
+    """
+    __slots__ = ('filename', 'users_subbed')
+
     def __init__(self, filename: str, users_subbed: list[Peer]):
-        self.filename: str = filename
-        if users_subbed is None:
-            self.users_subbed: list[Peer] = []
-        else:
-            self.users_subbed: list[Peer] = list(users_subbed)  # Create copy to avoid modification of original array
+        object.__setattr__(self, 'filename', filename)
+        object.__setattr__(self, 'users_subbed', tuple(users_subbed) if users_subbed is not None else ())
+
+    def with_user(self, peer: Peer) -> SyncFile:
+        """
+        :param peer: the peer to be added
+        :return: this SyncFile with peer subscribed
+        """
+        if peer in self.users_subbed:
+            return self
+        return SyncFile(self.filename, self.users_subbed + (peer,))
 
-    def remove_user(self, peer: Peer) -> None:
+    def without_user(self, peer: Peer) -> SyncFile:
         """
-        This method will remove the user from the syncFile
         :param peer: the peer to be removed
-        :return:
+        :return: this SyncFile without peer
         """
-        try:
-            self.users_subbed.remove(peer)
-        except ValueError:
-            pass
+        if peer not in self.users_subbed:
+            return self
+        return SyncFile(self.filename, [user for user in self.users_subbed if user != peer])
 
     def __dict__(self):
         return {'filename': self.filename, 'users_subbed': [us.__dict__() for us in self.users_subbed]}
 
     def __eq__(self, other: SyncFile):
-        return (self.filename, self.users_subbed) == (other.filename, other.users_subbed)
+        if not isinstance(other, SyncFile):
+            return NotImplemented
+        return self.filename == other.filename
+
+    def __hash__(self):
+        return hash(self.filename)
 
     @classmethod
     def from_dict(cls, data: dict):
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import (SYNC_UPDATE_RETRY_ATTEMPTS,
+                       SYNC_UPDATE_RETRY_DELAY,
+                       SYNC_UPDATE_RETRY_MAX_DELAY)
+
+import threading
+import time
+
+
+class SyncUpdateQueue:
+    """
+    Sends the updates of SyncFiles in the background, every subscriber from a queue and thread of its own, so a slow or
+    unreachable subscriber doesn't hold up the others, and whoever queued the update can go on looking for changes.
+    (send may still make the subscribers of one file take turns, File_Functions holds the file's lock while sending.)
+
+    A subscriber's queue holds at most one update of each file. The file is read when the update is sent, so when it
+    changes again before then the update already queued sends the newest copy, and the copies in between are never
+    sent (they are counted as coalesced). An update that fails is sent again after SYNC_UPDATE_RETRY_DELAY seconds,
+    twice as long after every failure (at most SYNC_UPDATE_RETRY_MAX_DELAY), until it has been tried
+    SYNC_UPDATE_RETRY_ATTEMPTS times. A subscriber's other files are sent while one waits to be tried again.
+
+    A subscriber's thread is started when an update is queued for it and ends once its queue is empty.
+    """
+
+    def __init__(self, send):
+        """
+        :param send: called as send(sync_file, peer) on the subscriber's thread to send one update, raises if it fails
+        """
+        self.send = send
+        self.condition: threading.Condition = threading.Condition()
+        # subscriber address -> filename -> [SyncFile, failed attempts, monotonic time it may be sent at], oldest first
+        self.pending: dict[tuple[str, int], dict[str, list]] = {}
+        self.peers: dict[tuple[str, int], object] = {}  # The subscribers with a thread, by address
+        self.sending: dict[tuple[str, int], str] = {}  # subscriber address -> the file being sent to it
+
+        self.sent: int = 0
+        self.coalesced: int = 0  # Updates replaced by a newer one of the same file before they were sent
+        self.retried: int = 0
+        self.failed: int = 0  # Updates given up on after SYNC_UPDATE_RETRY_ATTEMPTS attempts
+
+    def put(self, sync_file, peers):
+        """
+        Queues the update of sync_file for every peer, replacing the update of the same file if one is waiting. An
+        update waiting to be tried again keeps waiting, so a subscriber that is down isn't asked again sooner, but the
+        newer copy gets SYNC_UPDATE_RETRY_ATTEMPTS attempts of its own
+        :param sync_file:
+        :param peers: Peer objects (or anything with an addr)
+        :return:
+        """
+        with self.condition:
+            for peer in peers:
+                addr: tuple[str, int] = tuple(peer.addr)
+                queued: dict[str, list] = self.pending.setdefault(addr, {})
+                update: list | None = queued.get(sync_file.filename)
+                if update is None:
+                    queued[sync_file.filename] = [sync_file, 0, 0.0]
+                else:
+                    update[0], update[1] = sync_file, 0
+                    self.coalesced += 1
+
+                if addr not in self.peers:
+                    self.peers[addr] = peer
+                    threading.Thread(target=self.work, args=(addr,), daemon=True).start()
+            self.condition.notify_all()
+
+    def next_update(self, addr: tuple[str, int]) -> tuple[str, list] | None:
+        """
+        Waits until one of the subscriber's updates may be sent, must be called holding condition
+        :param addr:
+        :return: (filename, update) taken off the queue, None once the queue is empty
+        """
+        queued: dict[str, list] = self.pending[addr]
+        while queued:
+            now: float = time.monotonic()
+            for filename, update in queued.items():
+                if update[2] <= now:
+                    del queued[filename]
+                    return filename, update
+            self.condition.wait(min(update[2] for update in queued.values()) - now)
+        return None
+
+    def work(self, addr: tuple[str, int]):
+        while True:
+            with self.condition:
+                taken: tuple[str, list] | None = self.next_update(addr)
+                if taken is None:
+                    del self.pending[addr]
+                    del self.peers[addr]
+                    return
+                filename, (sync_file, attempts, _) = taken
+                peer = self.peers[addr]
+                self.sending[addr] = filename
+
+            try:
+                self.send(sync_file, peer)
+                error: Exception | None = None
+            except Exception as e:
+                error = e
+
+            with self.condition:
+                del self.sending[addr]
+                if error is None:
+                    self.sent += 1
+                    continue
+
+                attempts += 1
+                if attempts >= SYNC_UPDATE_RETRY_ATTEMPTS:
+                    self.failed += 1
+                else:
+                    self.retried += 1
+                    retry_at: float = time.monotonic() + min(SYNC_UPDATE_RETRY_DELAY * 2 ** (attempts - 1),
+                                                             SYNC_UPDATE_RETRY_MAX_DELAY)
+                    newer: list | None = self.pending[addr].get(filename)
+                    if newer is None:
+                        self.pending[addr][filename] = [sync_file, attempts, retry_at]
+                    else:
+                        # A newer update of the file was queued while this one was sent, it goes in its place with
+                        # attempts of its own but still waits before the subscriber is asked again
+                        newer[2] = max(newer[2], retry_at)
+
+            if attempts >= SYNC_UPDATE_RETRY_ATTEMPTS:
+                print(f"[Error] Failed to send the update of {filename} to {addr} after {attempts} attempts: {error}")
+
+    def stats(self) -> dict:
+        """
+        :return: the updates waiting for every subscriber ("host:port" -> amount), the ones being sent, and how many
+                 were sent, coalesced, tried again and given up on so far
+        """
+        with self.condition:
+            return {'queue_depth': {f"{host}:{port}": len(queued) for (host, port), queued in self.pending.items()},
+                    'sending': len(self.sending),
+                    'sent': self.sent,
+                    'coalesced': self.coalesced,
+                    'retried': self.retried,
+                    'failed': self.failed}
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import UPLOAD_QUANTUM
+
+import time
+
+
+class TokenBucket:
+    """
+    Lets rate bytes a second through on average, in bursts of up to a second's worth (never less than UPLOAD_QUANTUM,
+    so a whole piece always fits). A send larger than the bucket holds goes through once the bucket is full and leaves
+    it in debt, so the average still holds. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate: float = 0):
+        self.rate: float = rate
+        self.tokens: float = self.capacity
+        self.updated_at: float = time.monotonic()
+
+    @property
+    def capacity(self) -> float:
+        return max(self.rate, UPLOAD_QUANTUM)
+
+    def set_rate(self, rate: float):
+        self.refill(time.monotonic())
+        self.rate = rate
+        self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self, now: float):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, size: int, now: float) -> float:
+        """
+        :param size:
+        :param now: time.monotonic()
+        :return: seconds until size bytes may go through, 0 if they may now
+        """
+        if not self.rate:
+            return 0.0
+
+        self.refill(now)
+        missing: float = min(size, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, size: int):
+        if self.rate:
+            self.tokens -= size
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+from .CRequest import CRequest
+from .TokenBucket import TokenBucket
+
+# noinspection PyUnresolvedReferences
+from Constants import UPLOAD_QUANTUM
+
+from collections import deque
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import threading
+import time
+
+
+class UploadScheduler:
+    """
+    Decides when the data this peer uploads may be sent, so a few large downloads can't take the whole uplink from
+    everything else. Every piece of an upload waits until:
+        - The overall token bucket and the bucket of the peer it goes to have enough tokens (see TokenBucket).
+        - No upload of a more important class is waiting for the overall bucket. CONTROL (peer lists, catalogs and
+          every other small answer) goes before SYNC (SyncFile updates and subscriptions), which goes before BULK
+          (downloads of shared files).
+        - It is the peer's turn in its class. Each peer's uploads are counted in bytes divided by its weight, and the
+          peer that is furthest behind goes next (weighted fair queueing), so a peer gets its share however many
+          downloads it runs at once. A peer that was idle starts level with the others instead of catching up.
+
+    The server runs every request inside transfer(), and the functions that send files and payloads call pace (or
+    pace_async) with the size of every piece. Sends outside of a transfer aren't held back, and with no rate limits
+    nothing is, since without a limit there is nothing to share out. Limits can be changed at any time with configure.
+    """
+    CONTROL: int = 0
+    SYNC: int = 1
+    BULK: int = 2
+
+    # (scheduler, peer, class) of the upload the current thread or task is sending
+    current: contextvars.ContextVar = contextvars.ContextVar('upload', default=None)
+
+    # The requests whose answer isn't CONTROL, by CRequest name
+    REQUEST_CLASSES: dict[str, int] = {CRequest.DownloadFile.name: BULK,
+                                       CRequest.DownloadFileRange.name: BULK,
+                                       CRequest.DownloadFileChunks.name: BULK,
+                                       CRequest.SubscribeFile.name: SYNC,
+                                       CRequest.SyncFileUpdate.name: SYNC,
+                                       CRequest.SyncFileUpdateChunks.name: SYNC}
+
+    def __init__(self, upload_rate: float = 0, peer_upload_rate: float = 0, peer_weights: dict[str, int] | None = None):
+        self.condition: threading.Condition = threading.Condition()
+        self.bucket: TokenBucket = TokenBucket()
+        self.peer_buckets: dict[str, TokenBucket] = {}
+        self.peer_upload_rate: float = 0
+        self.peer_weights: dict[str, int] = {}
+
+        # class -> peer -> the sizes of the pieces waiting, as [size, granted]
+        self.waiting: list[dict[str, deque[list]]] = [{}, {}, {}]
+        # (class, peer) -> bytes sent divided by the peer's weight, and where that count stood for the last piece sent
+        # in each class
+        self.served: dict[tuple[int, str], float] = {}
+        self.virtual_times: list[float] = [0.0, 0.0, 0.0]
+
+        self.configure(upload_rate, peer_upload_rate, peer_weights)
+
+    def configure(self, upload_rate: float | None = None, peer_upload_rate: float | None = None,
+                  peer_weights: dict[str, int] | None = None):
+        """
+        Changes the limits, uploads already running follow the new ones from their next piece
+        :param upload_rate: bytes a second for all uploads together, 0 for no limit, None to keep the current one
+        :param peer_upload_rate: bytes a second for the uploads to each peer, 0 for no limit, None to keep it
+        :param peer_weights: peer host -> its share compared to other peers (1 when left out), None to keep them
+        :return:
+        """
+        with self.condition:
+            if upload_rate is not None:
+                self.bucket.set_rate(upload_rate)
+            if peer_upload_rate is not None:
+                self.peer_upload_rate = peer_upload_rate
+                for bucket in self.peer_buckets.values():
+                    bucket.set_rate(peer_upload_rate)
+            if peer_weights is not None:
+                self.peer_weights = dict(peer_weights)
+            self.condition.notify_all()
+
+    @property
+    def limited(self) -> bool:
+        return bool(self.bucket.rate or self.peer_upload_rate)
+
+    def limits(self) -> dict:
+        with self.condition:
+            return {'upload_rate': self.bucket.rate,
+                    'peer_upload_rate': self.peer_upload_rate,
+                    'peer_weights': dict(self.peer_weights)}
+
+    @contextmanager
+    def transfer(self, peer: str | None, upload_class: int):
+        """
+        Everything sent by this thread (or task) until the block ends is an upload of upload_class to peer
+        :param peer: the host of the peer, uploads to an unknown peer share one turn
+        :param upload_class: CONTROL, SYNC or BULK
+        :return:
+        """
+        token: contextvars.Token = self.current.set((self, peer or '', upload_class))
+        try:
+            yield
+        finally:
+            self.current.reset(token)
+
+    @classmethod
+    def request_class(cls, request_type: str) -> int:
+        """
+        :param request_type: CRequest name
+        :return: the class of what the server sends back for the request
+        """
+        return cls.REQUEST_CLASSES.get(request_type, cls.CONTROL)
+
+    @classmethod
+    def piece_size(cls, size: int) -> int:
+        """
+        :param size: the amount of bytes about to be sent
+        :return: how much of it to send at a time, all of it when uploads aren't being paced
+        """
+        upload = cls.current.get()
+        return UPLOAD_QUANTUM if upload is not None and upload[0].limited else max(size, 1)
+
+    @classmethod
+    def pace(cls, size: int):
+        """
+        Blocks until size bytes of the current upload may be sent
+        :param size:
+        :return:
+        """
+        upload = cls.current.get()
+        if upload is None or not upload[0].limited:
+            return
+        scheduler, peer, upload_class = upload
+        scheduler.wait(peer, upload_class, size)
+
+    @classmethod
+    async def pace_async(cls, size: int):
+        """
+        Same as pace, the waiting is done on a worker thread so the event loop carries on
+        :param size:
+        :return:
+        """
+        upload = cls.current.get()
+        if upload is None or not upload[0].limited:
+            return
+        scheduler, peer, upload_class = upload
+        if not scheduler.wait(peer, upload_class, size, blocking=False):
+            await asyncio.to_thread(scheduler.wait, peer, upload_class, size)
+
+    def wait(self, peer: str, upload_class: int, size: int, blocking: bool = True) -> bool:
+        """
+        :param peer:
+        :param upload_class:
+        :param size:
+        :param blocking: False to give up instead of waiting when the piece can't be sent right away
+        :return: True once the piece may be sent, False if it can't yet and blocking is False
+        """
+        with self.condition:
+            piece: list = [size, False]
+            self.waiting[upload_class].setdefault(peer, deque()).append(piece)
+            key: tuple[int, str] = (upload_class, peer)
+            self.served[key] = max(self.served.get(key, 0.0), self.virtual_times[upload_class])
+
+            while True:
+                delay: float | None = self.dispatch(time.monotonic())
+                if piece[1]:
+                    return True
+                if not blocking:
+                    self.withdraw(peer, upload_class, piece)
+                    return False
+                self.condition.wait(delay)
+
+    def withdraw(self, peer: str, upload_class: int, piece: list):
+        """
+        Takes a piece that wasn't granted out of the queue, the caller holds the lock
+        """
+        pieces: deque[list] = self.waiting[upload_class][peer]
+        pieces.remove(piece)
+        if not pieces:
+            del self.waiting[upload_class][peer]
+
+    def peer_bucket(self, peer: str) -> TokenBucket:
+        bucket: TokenBucket | None = self.peer_buckets.get(peer)
+        if bucket is None:
+            bucket = self.peer_buckets[peer] = TokenBucket(self.peer_upload_rate)
+        return bucket
+
+    def dispatch(self, now: float) -> float | None:
+        """
+        Grants every waiting piece that may be sent now, the caller holds the lock
+        :param now:
+        :return: seconds until another piece may be granted, None if nothing is waiting on the buckets
+        """
+        next_delay: float | None = None
+        granted: bool = False
+
+        for upload_class, peers in enumerate(self.waiting):
+            blocked: set[str] = set()
+            while len(blocked) < len(peers):
+                # The peer furthest behind that isn't waiting on its own bucket, the first to ask on a tie
+                peer: str = min((peer for peer in peers if peer not in blocked),
+                                key=lambda waiting_peer: self.served[(upload_class, waiting_peer)])
+                pieces: deque[list] = peers[peer]
+                size: int = pieces[0][0]
+
+                peer_delay: float = self.peer_bucket(peer).delay(size, now)
+                if peer_delay:
+                    # Only this peer has to wait, the others in its class can use the turn
+                    blocked.add(peer)
+                    next_delay = peer_delay if next_delay is None else min(next_delay, peer_delay)
+                    continue
+
+                overall_delay: float = self.bucket.delay(size, now)
+                if overall_delay:
+                    # Less important classes don't get the tokens this one is waiting for
+                    if granted:
+                        self.condition.notify_all()
+                    return overall_delay if next_delay is None else min(next_delay, overall_delay)
+
+                key: tuple[int, str] = (upload_class, peer)
+                self.virtual_times[upload_class] = self.served[key]
+                self.served[key] += size / max(1, self.peer_weights.get(peer, 1))
+                self.bucket.take(size)
+                self.peer_bucket(peer).take(size)
+                pieces.popleft()[1] = True
+                granted = True
+                if not pieces:
+                    del peers[peer]
+
+        if granted:
+            # Idle peers behind the rest would be brought level with them anyway
+            for key, served in list(self.served.items()):
+                if served <= self.virtual_times[key[0]] and key[1] not in self.waiting[key[0]]:
+                    del self.served[key]
+            self.condition.notify_all()
+        return next_delay
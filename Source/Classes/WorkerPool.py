@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import queue
+import threading
+
+
+class WorkerPool:
+    """
+    A fixed amount of threads serving requests from a bounded queue.
+
+    submit never blocks, when the queue is full it returns False right away so the caller can tell the client the
+    server is busy instead of letting requests pile up.
+    """
+
+    def __init__(self, worker_count: int, queue_limit: int):
+        self.worker_count: int = worker_count
+        self.tasks: queue.Queue = queue.Queue(queue_limit)
+        self.workers: list[threading.Thread] = []
+
+    def start(self):
+        for _ in range(self.worker_count):
+            worker: threading.Thread = threading.Thread(target=self.work, daemon=True)
+            self.workers.append(worker)
+            worker.start()
+
+    def submit(self, function, *args) -> bool:
+        """
+        :param function: called as function(*args) on one of the workers
+        :param args:
+        :return: False if the queue is full and the task was not taken
+        """
+        try:
+            self.tasks.put_nowait((function, args))
+        except queue.Full:
+            return False
+        return True
+
+    def work(self):
+        while True:
+            function, args = self.tasks.get()
+            if function is None:
+                break
+
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"[Error] A request could not be served: {e}")
+
+    def shutdown(self):
+        """
+        Lets the workers finish the requests already queued, then stops them
+        :return:
+        """
+        for _ in self.workers:
+            self.tasks.put((None, ()))
+        for worker in self.workers:
+            worker.join()
+        self.workers.clear()
@@ -1,6 +1,31 @@
+from .AsyncChannel import AsyncChannel, BlockingChannel
+from .AsyncMuxSession import AsyncMuxSession, AsyncMuxStream
+from .AsyncServer import AsyncServer
+from .Catalog import Catalog
+from .ChangeLog import ChangeLog
+from .ChunkIndex import ChunkIndex
+from .ConnectionPool import ConnectionPool
 from .CRequest import CRequest
+from .DirectoryWatcher import DirectoryWatcher
+from .DiskStorage import DiskStorage
 from .File import File
+from .HashCache import HashCache
+from .Immutable import Immutable
+from .LockStripes import LockStripes
+from .MemoryStorage import MemoryStorage
+from .MeteredLock import MeteredLock
+from .MeteredSocket import MeteredSocket
+from .MuxSession import MuxSession, MuxStream
+from .PartialDownload import PartialDownload
 from .Peer import Peer
+from .RequestMetrics import RequestMetrics
 from .Server import Server
+from .ServerBusyError import ServerBusyError
 from .SRequest import SRequest
+from .Storage import Storage
+from .SwarmDownload import SwarmDownload
 from .SyncFile import SyncFile
+from .SyncUpdateQueue import SyncUpdateQueue
+from .TokenBucket import TokenBucket
+from .UploadScheduler import UploadScheduler
+from .WorkerPool import WorkerPool
@@ -1,7 +1,56 @@
 BUFFER_SIZE: int = 4096
 C_REQUEST_BYTE_LENGTH: int = 32  # The fixed length to be sent and received for each request
-DISPLAYED_USER_OPTIONS: int = 4
+DISPLAYED_USER_OPTIONS: int = 7
 DOWNLOAD_FOLDER_TIMEOUT: int = 120  # The amount of time the file is expected to download
+DOWNLOAD_RETRY_ATTEMPTS: int = 3  # How many times an interrupted download is resumed before giving up
 S_REQUEST_BYTE_LENGTH: int = 32
 FIXED_LENGTH_HEADER: int = 8
-INITIAL_CONNECTION_TIMEOUT: int = 10  # The more peers expected in the network, the greater this number should be
\ No newline at end of file
+RANGE_TO_END: int = (1 << (8 * FIXED_LENGTH_HEADER)) - 1  # Range length meaning "until the end of the file"
+INITIAL_CONNECTION_TIMEOUT: int = 10  # The more peers expected in the network, the greater this number should be
+SWARM_PIECE_SIZE: int = 1024 * 1024  # The size of each piece a swarm download is split in to
+SWARM_PIECE_TIMEOUT: int = 30  # The amount of time a single piece is expected to download
+SWARM_MAX_PEER_FAILURES: int = 3  # A peer is dropped from a swarm download after failing this many pieces
+SWARM_SLOW_PEER_RATIO: int = 4  # A peer this many times slower than the fastest peer stops taking new pieces
+PARTIAL_FILE_SUFFIX: str = '.part'  # Unfinished downloads are kept as <filename>.part
+PARTIAL_STATE_SUFFIX: str = '.part.json'  # The pieces of <filename>.part that are already downloaded
+DELTA_MIN_BLOCK_SIZE: int = 2048  # Smallest block size used for sync file signatures
+DELTA_MAX_BLOCK_SIZE: int = 128 * 1024  # Largest block size used for sync file signatures
+DELTA_MAX_LITERAL: int = 1024 * 1024  # Longest run of literal bytes sent in one delta operation
+DELTA_READ_SIZE: int = 1024 * 1024  # How much of a sync file send_delta reads at a time
+MUX_MAX_FRAME: int = 16 * 1024  # Largest frame sent on a multiplexed peer connection
+MUX_STREAM_WINDOW: int = 256 * 1024  # Unread bytes allowed in flight per stream, must be at least 2 * MUX_MAX_FRAME
+SERVER_BUSY_READ_TIMEOUT: float = 0.5  # How long a turned away client gets to send its request before being told Busy
+SERVER_BUSY_RETRY_DELAY: float = 1  # How long a client waits before asking a busy server again
+FAN_OUT_MAX_THREADS: int = 32  # The most peers contacted at the same time when sending a request to many peers
+GOSSIP_FANOUT: int = 3  # How many random peers each peer passes news of a new user on to
+GOSSIP_EXTRA_ROUNDS: int = 2  # Rounds of passing news on beyond log(peers) / log(GOSSIP_FANOUT)
+GOSSIP_INTERVAL: int = 30  # Seconds between comparing peer lists with a random peer, which fixes missed news
+JSON_CODEC: str = 'json'  # The payload encoding every peer understands
+BINARY_CODEC: str = 'binary-v1'  # The compact encoding of Codec_Functions, used when both peers support it
+WIRE_CODECS: tuple[str, ...] = (BINARY_CODEC, JSON_CODEC)  # The payload encodings this peer offers, preferred first
+CATALOG_CHANGE_LOG_LENGTH: int = 10000  # Catalog changes remembered for peers asking for the changes since a version
+SYNC_WATCH_POLL_INTERVAL: float = 0.5  # Seconds between listings of the SyncFiles folder where inotify isn't available
+HASH_CACHE_FILENAME: str = '.sync_hashes.json'  # Where the hashes of SyncFiles are kept between runs
+HASH_READ_SIZE: int = 1024 * 1024  # How much of a file is read at a time when hashing it
+HASH_THREADS: int = 8  # The most files hashed at the same time when looking through the SyncFiles folder
+CHUNK_MIN_SIZE: int = 2 * 1024  # Smallest chunk files are cut in to for deduplication (except the last one)
+CHUNK_AVG_SIZE: int = 8 * 1024  # Size chunks are aimed at, must be a power of two
+CHUNK_MAX_SIZE: int = 64 * 1024  # Largest chunk, a cut is forced here when the contents don't pick one
+WIRE_COMPRESSIONS: tuple[str, ...] = ('lzma', 'bz2', 'zlib')  # The compression algorithms this peer can decompress
+COMPRESSION_MIN_SIZE: int = 1024  # Payloads and files smaller than this are always sent as they are
+COMPRESSION_SAMPLE_SIZE: int = 64 * 1024  # How much of a file is compressed to find out if it is worth compressing
+COMPRESSION_MAX_RATIO: float = 0.9  # Data whose sample doesn't get smaller than this ratio is sent as it is
+COMPRESSION_STRONG_MAX_SIZE: int = 1024 * 1024  # Largest file compressed with bz2 instead of the much faster zlib
+COMPRESSION_FRAME_SIZE: int = 256 * 1024  # How much of a file is compressed at a time
+COMPRESSION_MAX_PAYLOAD_SIZE: int = 64 * 1024 * 1024  # Largest a compressed peer list or catalog may decompress to
+STORAGE_VIEW_SIZE: int = 1024 * 1024  # How much of a file is sent at a time to connections that can't use sendfile
+UPLOAD_QUANTUM: int = 64 * 1024  # How much of an upload is sent at a time when uploads are rate limited
+# Upper bounds (seconds) of the buckets request latencies are counted in, anything slower goes in one more bucket
+METRICS_LATENCY_BUCKETS: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                                              30, 60, 120)
+SYNC_FILE_LOCK_STRIPES: int = 64  # The locks SyncFiles are spread over by filename, updates to one file take turns
+SYNC_UPDATE_RETRY_ATTEMPTS: int = 5  # How many times a SyncFile update is sent to a subscriber before giving up on it
+SYNC_UPDATE_RETRY_DELAY: float = 1  # Seconds before a failed SyncFile update is sent again, doubled after every failure
+SYNC_UPDATE_RETRY_MAX_DELAY: float = 60  # The longest a failed SyncFile update waits to be sent again
+TRACE_MAX_SPANS: int = 10000  # The most recent spans kept while tracing, older ones are forgotten
+PROFILE_MIN_SECONDS: float = 0.00001  # Call paths with less time than this are left out of the folded stacks
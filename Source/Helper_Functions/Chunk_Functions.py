@@ -0,0 +1,319 @@
+"""
+Content-defined chunking, used by DownloadFileChunks and SyncFileUpdateChunks to send only the parts of a file the
+receiver doesn't have anywhere in its Files and SyncFiles folders.
+
+Files are cut where the contents say so instead of every N bytes, so inserting or removing bytes only changes the
+chunks around the edit, and the same data in two files (a renamed copy, another version of the same document) is cut
+the same way in both. Every byte is given a class, 0 or 1, from a table lookup of it and the 3 bytes before it. A
+chunk ends after the first run of STRICT_RUN bytes of class 0 once it is CHUNK_MIN_SIZE long, or after a shorter run
+of LOOSE_RUN bytes once it has passed CHUNK_AVG_SIZE (which keeps chunk sizes close to the average, like FastCDC's
+normalized chunking), and at CHUNK_MAX_SIZE at the latest. Classes are worked out with bytes.translate and integer
+XOR and runs are found with bytes.find, so no Python code runs per byte.
+
+Chunks are named by their BLAKE2b hash. The sender describes its copy with a recipe:
+    file size (8 bytes) | BLAKE2b hash of the file (64 bytes) | [chunk hash (16 bytes) | chunk length (4 bytes)]...
+The receiver copies every chunk it already has in to place, answers with a bitmap of the chunks it still needs, and
+the sender sends those, back to back in recipe order.
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import (FIXED_LENGTH_HEADER,
+                       CHUNK_MIN_SIZE,
+                       CHUNK_AVG_SIZE,
+                       CHUNK_MAX_SIZE)
+
+# noinspection PyUnresolvedReferences
+from Classes.HashCache import HashCache
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Tracing_Functions as TR
+
+import hashlib
+import os
+import random
+import socket
+from pathlib import Path
+
+CHUNK_HASH_SIZE: int = 16
+CHUNK_LENGTH_SIZE: int = 4
+FILE_HASH_SIZE: int = 64  # The default BLAKE2b digest, the same hash HashCache keeps
+
+CLASS_CONTEXT: int = 4  # Bytes that decide the class of a byte (itself and the ones before it)
+STRICT_RUN: bytes = bytes(CHUNK_AVG_SIZE.bit_length() - 2)  # Found about every CHUNK_AVG_SIZE bytes
+LOOSE_RUN: bytes = bytes(len(STRICT_RUN) - 2)  # Found about 4 times as often
+CLASS_WINDOW: int = 16 * CHUNK_MAX_SIZE  # Bytes classified at a time
+
+# Fixed tables, every peer has to cut the same data the same way
+_TABLE_SOURCE: random.Random = random.Random(0x5EED_C0DE)
+BYTE_TABLES: list[bytes] = [bytes(_TABLE_SOURCE.sample(range(256), 256)) for _ in range(CLASS_CONTEXT)]
+CLASS_TABLE: bytes = bytes(_TABLE_SOURCE.getrandbits(1) for _ in range(256))
+
+
+def chunk_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=CHUNK_HASH_SIZE).digest()
+
+
+def byte_classes(data, start: int, end: int, context: bytes = b'') -> bytes:
+    """
+    :param data: the file, or a piece of it
+    :param start:
+    :param end:
+    :param context: the bytes of the file before data, b'' at the start of the file
+    :return: the class of every byte of data[start:end]
+    """
+    before: bytes = (context + data[max(0, start - CLASS_CONTEXT + 1):start])[-(CLASS_CONTEXT - 1):]
+    window: bytes = bytes(CLASS_CONTEXT - 1 - len(before)) + before + data[start:end]
+    length: int = end - start
+
+    # Each table is applied to the window shifted by one more byte, so byte i of the sum mixes bytes i-3 to i
+    mixed: int = 0
+    for shift, table in enumerate(BYTE_TABLES):
+        offset: int = CLASS_CONTEXT - 1 - shift
+        mixed ^= int.from_bytes(window[offset:offset + length].translate(table), 'little')
+    return mixed.to_bytes(length, 'little').translate(CLASS_TABLE)
+
+
+def chunk_boundaries(data, context: bytes = b'', final: bool = True) -> list[int]:
+    """
+    :param data: the file, or a piece of it starting where a chunk starts
+    :param context: the bytes of the file before data, b'' at the start of the file
+    :param final: data runs to the end of the file. Otherwise the chunks that the data after it could still change are
+                  left out
+    :return: where every chunk ends in data, the last one is len(data) if final
+    """
+    data_length: int = len(data)
+    boundaries: list[int] = []
+    classes: bytes = b''
+    classes_start: int = 0
+
+    start: int = 0
+    while start < data_length:
+        end: int = min(start + CHUNK_MAX_SIZE, data_length)
+        if not final and end - start < CHUNK_MAX_SIZE:
+            break
+        if end - start <= CHUNK_MIN_SIZE:
+            boundaries.append(end)
+            break
+
+        if end > classes_start + len(classes):
+            classes_start = start
+            classes = byte_classes(data, start, min(start + CLASS_WINDOW, data_length), context)
+
+        # Positions in classes, a run found at i ends the chunk at i + the length of the run
+        first: int = start + CHUNK_MIN_SIZE - len(STRICT_RUN) - classes_start
+        normal: int = min(start + CHUNK_AVG_SIZE, end) - classes_start
+        last: int = end - classes_start
+
+        found: int = classes.find(STRICT_RUN, first, normal)
+        if found >= 0:
+            cut: int = found + len(STRICT_RUN)
+        else:
+            found = classes.find(LOOSE_RUN, normal - len(LOOSE_RUN) + 1, last)
+            cut = found + len(LOOSE_RUN) if found >= 0 else last
+
+        start = classes_start + cut
+        boundaries.append(start)
+
+    return boundaries
+
+
+def chunk_file(file_path: Path) -> tuple[str, list[tuple[bytes, int]]]:
+    """
+    The file is read a piece at a time in to one buffer, not mapped, since the user can edit SyncFiles in place while
+    they are chunked and reading a mapping past the new end of a file that got shorter kills the process. A file that
+    gets shorter while it is read is chunked as far as it was read
+    :param file_path:
+    :return: (hex hash of the whole file, [(chunk hash, chunk length), ...])
+    """
+    file_hasher = HashCache.new_hasher()
+    chunks: list[tuple[bytes, int]] = []
+
+    buffer: bytearray = bytearray(CLASS_WINDOW + CHUNK_MAX_SIZE)
+    pending: int = 0  # Bytes at the start of buffer that haven't been cut in to chunks yet
+    context: bytes = b''  # The bytes of the file before buffer
+
+    with open(file_path, 'rb') as f, TR.span('chunk', filename=file_path.name), memoryview(buffer) as view:
+        final: bool = False
+        while not final:
+            while pending < len(buffer):
+                read_size: int = f.readinto(view[pending:])
+                if not read_size:
+                    final = True
+                    break
+                pending += read_size
+
+            start: int = 0
+            for end in chunk_boundaries(view[:pending], context, final):
+                file_hasher.update(view[start:end])
+                chunks.append((chunk_hash(view[start:end]), end - start))
+                start = end
+
+            context = (context + view[max(0, start - CLASS_CONTEXT + 1):start])[-(CLASS_CONTEXT - 1):]
+            buffer[:pending - start] = buffer[start:pending]
+            pending -= start
+
+    return file_hasher.hexdigest(), chunks
+
+
+def encode_recipe(file_size: int, file_hash: str, chunks: list[tuple[bytes, int]]) -> bytes:
+    recipe: bytearray = bytearray(file_size.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+    recipe += bytes.fromhex(file_hash)
+    for hash_of_chunk, length in chunks:
+        recipe += hash_of_chunk
+        recipe += length.to_bytes(CHUNK_LENGTH_SIZE, 'big')
+    return bytes(recipe)
+
+
+def decode_recipe(received_data) -> tuple[int, str, list[tuple[bytes, int]]]:
+    """
+    :param received_data:
+    :return: (file size, hex hash of the whole file, [(chunk hash, chunk length), ...])
+    """
+    data: bytes = bytes(received_data)
+    file_size: int = int.from_bytes(data[:FIXED_LENGTH_HEADER], 'big')
+    position: int = FIXED_LENGTH_HEADER + FILE_HASH_SIZE
+    file_hash: str = data[FIXED_LENGTH_HEADER:position].hex()
+
+    entry_size: int = CHUNK_HASH_SIZE + CHUNK_LENGTH_SIZE
+    chunks: list[tuple[bytes, int]] = [(data[start:start + CHUNK_HASH_SIZE],
+                                        int.from_bytes(data[start + CHUNK_HASH_SIZE:start + entry_size], 'big'))
+                                       for start in range(position, len(data), entry_size)]
+
+    if sum(length for _, length in chunks) != file_size:
+        raise ValueError("The chunks of the recipe don't add up to the size of the file")
+    if any(length > CHUNK_MAX_SIZE for _, length in chunks):
+        raise ValueError(f"The recipe has chunks longer than {CHUNK_MAX_SIZE} bytes")
+    return file_size, file_hash, chunks
+
+
+def encode_wanted(wanted: list[bool]) -> bytes:
+    bitmap: bytearray = bytearray((len(wanted) + 7) // 8)
+    for index, is_wanted in enumerate(wanted):
+        if is_wanted:
+            bitmap[index // 8] |= 0x80 >> index % 8
+    return bytes(bitmap)
+
+
+def decode_wanted(received_data, chunk_count: int) -> list[bool]:
+    if len(received_data) != (chunk_count + 7) // 8:
+        raise ValueError(f"Expected a bitmap of {chunk_count} chunks, got {len(received_data)} bytes")
+    return [bool(received_data[index // 8] & 0x80 >> index % 8) for index in range(chunk_count)]
+
+
+def send_chunks(connection_socket: socket.socket, file_path: Path):
+    """
+    The sending side: sends the recipe of the file at file_path, then the chunks the receiver asks for
+    :param connection_socket:
+    :param file_path:
+    :return:
+    """
+    file_size, file_hash, chunks = FF.CHUNK_INDEX.recipe(file_path)
+
+    FF.send_payload(connection_socket, encode_recipe(file_size, file_hash, chunks))
+
+    wanted: list[bool] = decode_wanted(FF.receive_payload(connection_socket), len(chunks))
+
+    # Wanted chunks next to each other are sent as one range
+    run_start: int = 0
+    run_length: int = 0
+    offset: int = 0
+    for (_, length), is_wanted in zip(chunks, wanted):
+        if is_wanted:
+            if run_length and run_start + run_length != offset:
+                FF.send_file_contents(connection_socket, file_path, run_length, run_start)
+                run_length = 0
+            if not run_length:
+                run_start = offset
+            run_length += length
+        offset += length
+
+    if run_length:
+        FF.send_file_contents(connection_socket, file_path, run_length, run_start)
+
+
+def receive_recipe(connection_socket: socket.socket) -> tuple[int, str, list[tuple[bytes, int]]]:
+    return decode_recipe(FF.receive_payload(connection_socket))
+
+
+def receive_chunks(connection_socket: socket.socket, target, chunks: list[tuple[bytes, int]],
+                   is_present=None, on_written=None):
+    """
+    The receiving side, after receive_recipe: fills target with the chunks found locally, asks for the others and
+    writes them as they arrive. Every chunk is checked against its hash before it is written
+    :param connection_socket:
+    :param target: the file being rebuilt, opened for writing and as large as the whole file
+    :param chunks: from the recipe
+    :param is_present: called with (offset, length), True for chunks target already holds
+    :param on_written: called with (offset, length) for every chunk written to target
+    :return:
+    """
+    offsets: list[int] = []
+    offset: int = 0
+    for _, length in chunks:
+        offsets.append(offset)
+        offset += length
+
+    wanted: list[bool] = []
+    with FF.CHUNK_INDEX.reader() as read_local_chunk:
+        for (hash_of_chunk, length), offset in zip(chunks, offsets):
+            if is_present is not None and is_present(offset, length):
+                wanted.append(False)
+                continue
+
+            data: bytes | None = read_local_chunk(hash_of_chunk, length)
+            wanted.append(data is None)
+            if data is not None:
+                target.seek(offset)
+                target.write(data)
+                if on_written is not None:
+                    on_written(offset, length)
+
+    FF.send_payload(connection_socket, encode_wanted(wanted))
+
+    for (hash_of_chunk, length), offset, is_wanted in zip(chunks, offsets, wanted):
+        if not is_wanted:
+            continue
+
+        data = FF.receive_exact(connection_socket, length)
+        if chunk_hash(data) != hash_of_chunk:
+            raise ValueError(f"A chunk at byte {offset} does not match its hash")
+        target.seek(offset)
+        target.write(data)
+        if on_written is not None:
+            on_written(offset, length)
+
+
+def receive_file(connection_socket: socket.socket, file_path: Path):
+    """
+    Rebuilds the sender's copy of a SyncFile, using the chunks of the current copy and of every other local file. Like
+    DF.receive_delta, the new copy is written next to the old one and only replaces it once its hash has been checked
+    :param connection_socket:
+    :param file_path:
+    :return:
+    """
+    file_size, file_hash, chunks = receive_recipe(connection_socket)
+
+    FF.CHUNK_INDEX.refresh()
+
+    temporary_path: Path = file_path.with_name(file_path.name + '.sync~')
+    try:
+        with open(temporary_path, 'wb') as f:
+            f.truncate(file_size)
+            receive_chunks(connection_socket, f, chunks)
+
+        with TR.span('hash', filename=file_path.name):
+            received_hash, stat_result = HashCache.read_digest(temporary_path)
+        if received_hash != file_hash:
+            raise ValueError(f"The rebuilt copy of {file_path.name} does not match the sender's copy")
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+    # Before the replace, so whoever watches the folder already knows this copy came from another user
+    FF.SYNC_FILE_HASHES.put(file_path, stat_result, file_hash)
+    FF.record_received_sync_file(file_path.name, file_hash)
+    os.replace(temporary_path, file_path)
+    FF.CHUNK_INDEX.add(file_path, stat_result, file_size, file_hash, chunks)
@@ -0,0 +1,217 @@
+"""
+The compact binary encoding of Peer, File and SyncFile payloads, used instead of JSON between peers that agreed on
+it with a Codecs request.
+
+A payload is:
+    MAGIC (1 byte) | kind (1 byte) | peer count | peers | item count | items
+
+Every peer named in the payload (a File's owner, a SyncFile's subscribers) is written once in the peer table and
+referred to by its index after that. Counts, indexes and string lengths are varints (7 bits per byte, the high bit
+set on every byte but the last), strings are UTF-8. A peer is:
+    address family (1 byte) | host (4 bytes for IPv4, 16 for IPv6, a string otherwise) | port (2 bytes) | username
+
+MAGIC can never start a JSON payload (nor any UTF-8 text), so a receiver can always tell the two encodings apart
+and decoding doesn't need to know what was negotiated.
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Classes.File import File
+# noinspection PyUnresolvedReferences
+from Classes.Peer import Peer
+# noinspection PyUnresolvedReferences
+from Classes.SyncFile import SyncFile
+
+import socket
+
+MAGIC: int = 0xB1
+
+# The kind byte, 0 for an empty payload
+KINDS: dict[type, int] = {Peer: 1, File: 2, SyncFile: 3}
+
+HOST_STRING: int = 0
+HOST_IPV4: int = 4
+HOST_IPV6: int = 6
+
+NO_OWNER: int = 0  # Written instead of an owner index (which is shifted up by one) for a File without an address
+
+
+def is_binary(received_data) -> bool:
+    return len(received_data) > 0 and received_data[0] == MAGIC
+
+
+def write_varint(buffer: bytearray, value: int):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data, position: int) -> tuple[int, int]:
+    """
+    :param data:
+    :param position: where the varint starts
+    :return: (value, position after the varint)
+    """
+    byte: int = data[position]
+    if byte < 0x80:
+        return byte, position + 1
+
+    value: int = byte & 0x7F
+    shift: int = 7
+    while True:
+        position += 1
+        byte = data[position]
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position + 1
+        shift += 7
+
+
+def write_string(buffer: bytearray, text: str):
+    encoded: bytes = text.encode('utf-8')
+    write_varint(buffer, len(encoded))
+    buffer += encoded
+
+
+def read_string(data, position: int) -> tuple[str, int]:
+    length, position = read_varint(data, position)
+    end: int = position + length
+    if end > len(data):
+        raise ValueError("Truncated string in binary payload")
+    return data[position:end].decode('utf-8'), end
+
+
+def write_peer(buffer: bytearray, addr: tuple[str, int], username: str):
+    host, port = addr
+    try:
+        packed_host: bytes = socket.inet_pton(socket.AF_INET, host)
+        buffer.append(HOST_IPV4)
+        buffer += packed_host
+    except OSError:
+        try:
+            packed_host = socket.inet_pton(socket.AF_INET6, host)
+            buffer.append(HOST_IPV6)
+            buffer += packed_host
+        except OSError:
+            buffer.append(HOST_STRING)
+            write_string(buffer, host)
+
+    buffer += port.to_bytes(2, 'big')
+    write_string(buffer, username)
+
+
+def read_peer(data, position: int) -> tuple[Peer, int]:
+    family: int = data[position]
+    position += 1
+
+    if family == HOST_IPV4:
+        host: str = socket.inet_ntop(socket.AF_INET, data[position:position + 4])
+        position += 4
+    elif family == HOST_IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, data[position:position + 16])
+        position += 16
+    elif family == HOST_STRING:
+        host, position = read_string(data, position)
+    else:
+        raise ValueError(f"Unknown address family {family} in binary payload")
+
+    port: int = data[position] << 8 | data[position + 1]
+    username, position = read_string(data, position + 2)
+    return Peer((host, port), username), position
+
+
+def encode_objects(objects) -> bytes:
+    """
+    Encodes Peer, File or SyncFile objects, all of the same class
+    :param objects:
+    :return:
+    """
+    peer_indexes: dict[tuple[tuple[str, int], str], int] = {}
+    peer_table: bytearray = bytearray()
+    items: bytearray = bytearray()
+    kind: int = 0
+    count: int = 0
+
+    def peer_index(addr, username: str) -> int:
+        key: tuple[tuple[str, int], str] = (tuple(addr), username)
+        index: int | None = peer_indexes.get(key)
+        if index is None:
+            index = peer_indexes[key] = len(peer_indexes)
+            write_peer(peer_table, key[0], username)
+        return index
+
+    for obj in objects:
+        if not kind:
+            kind = KINDS[type(obj)]
+        count += 1
+
+        if kind == 1:
+            write_varint(items, peer_index(obj.addr, obj.username))
+        elif kind == 2:
+            write_string(items, obj.filename)
+            if obj.addr is None:
+                write_varint(items, NO_OWNER)
+                write_string(items, obj.username)
+            else:
+                write_varint(items, peer_index(obj.addr, obj.username) + 1)
+        else:
+            write_string(items, obj.filename)
+            write_varint(items, len(obj.users_subbed))
+            for user in obj.users_subbed:
+                write_varint(items, peer_index(user.addr, user.username))
+
+    encoded: bytearray = bytearray((MAGIC, kind))
+    write_varint(encoded, len(peer_indexes))
+    encoded += peer_table
+    write_varint(encoded, count)
+    encoded += items
+    return bytes(encoded)
+
+
+def decode_objects(received_data, object_class) -> list:
+    """
+    Decodes a payload encoded by encode_objects
+    :param received_data:
+    :param object_class: Peer, File or SyncFile
+    :return:
+    """
+    data: bytes = bytes(received_data)
+    kind: int = data[1]
+    if kind and kind != KINDS[object_class]:
+        raise ValueError(f"Expected a payload of {object_class.__name__} objects, got kind {kind}")
+
+    try:
+        peer_count, position = read_varint(data, 2)
+        peers: list[Peer] = []
+        for _ in range(peer_count):
+            peer, position = read_peer(data, position)
+            peers.append(peer)
+
+        count, position = read_varint(data, position)
+        objects: list = []
+        for _ in range(count):
+            if kind == 1:
+                index, position = read_varint(data, position)
+                objects.append(peers[index])
+            elif kind == 2:
+                filename, position = read_string(data, position)
+                owner, position = read_varint(data, position)
+                if owner == NO_OWNER:
+                    username, position = read_string(data, position)
+                    objects.append(File(filename, username))
+                else:
+                    peer = peers[owner - 1]
+                    objects.append(File(filename, peer.username, peer.addr))
+            else:
+                filename, position = read_string(data, position)
+                subscriber_count, position = read_varint(data, position)
+                users_subbed: list[Peer] = []
+                for _ in range(subscriber_count):
+                    index, position = read_varint(data, position)
+                    users_subbed.append(peers[index])
+                objects.append(SyncFile(filename, users_subbed))
+    except IndexError:
+        raise ValueError("Truncated binary payload") from None
+
+    return objects
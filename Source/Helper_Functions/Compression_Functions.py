@@ -0,0 +1,325 @@
+"""
+Compression of payloads and file transfers between peers that agreed on it with a Compressions request.
+
+Both sides name the algorithms they can decompress (zlib, bz2 and lzma from the standard library) and the sender picks
+one for every transfer, or none:
+    - Data that is already compressed isn't compressed again. Files are skipped by their extension, and anything else
+      by compressing a sample with zlib's fastest level and checking how much smaller it got.
+    - Peer lists and catalogs are small, very repetitive and sent to many peers, lzma's fastest preset shrinks them the
+      most without costing more time than zlib.
+    - Files up to COMPRESSION_STRONG_MAX_SIZE that compress well (text) use bz2, which is slow but compresses text the
+      best. Larger files use zlib's fastest level, so the network isn't left waiting on the CPU.
+
+A compressed payload starts with COMPRESSED_MAGIC, which can't start a JSON payload, a binary payload (see
+Codec_Functions) or any UTF-8 text, followed by the algorithm byte, so receivers don't need to know what was agreed
+on. A file is sent as its size, the algorithm byte, and then either the file as it is (algorithm 0) or compressed
+frames of at most COMPRESSION_FRAME_SIZE bytes, each with its length in front, ending with an empty frame.
+
+A few compressed bytes can decompress to gigabytes, so what peers send is decompressed a piece at a time and given
+up on as soon as it grows past what is expected: the size sent before a file, COMPRESSION_MAX_PAYLOAD_SIZE for a
+payload.
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import (WIRE_COMPRESSIONS,
+                       COMPRESSION_MIN_SIZE,
+                       COMPRESSION_SAMPLE_SIZE,
+                       COMPRESSION_MAX_RATIO,
+                       COMPRESSION_STRONG_MAX_SIZE,
+                       COMPRESSION_FRAME_SIZE,
+                       COMPRESSION_MAX_PAYLOAD_SIZE)
+
+# noinspection PyUnresolvedReferences
+from Classes.Storage import Storage
+# noinspection PyUnresolvedReferences
+from Classes.UploadScheduler import UploadScheduler
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+
+import bz2
+import lzma
+import threading
+import time
+import zlib
+from pathlib import PurePath
+
+COMPRESSED_MAGIC: int = 0xC0
+NO_COMPRESSION: int = 0
+ALGORITHM_IDS: dict[str, int] = {'zlib': 1, 'bz2': 2, 'lzma': 3}
+ALGORITHM_NAMES: dict[int, str] = {algorithm_id: name for name, algorithm_id in ALGORITHM_IDS.items()}
+FRAME_LENGTH_SIZE: int = 4
+
+# Formats that are compressed already, compressing them again only costs time
+COMPRESSED_EXTENSIONS: frozenset[str] = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a',
+    '.mp4', '.mkv', '.avi', '.mov', '.webm',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.jar', '.apk',
+    '.pdf', '.woff', '.woff2'})
+
+# algorithm (or None for transfers sent as they are) -> [transfers, bytes before compression, bytes sent, CPU seconds]
+TRANSFER_STATS: dict[str | None, list] = {}
+TRANSFER_STATS_LOCK: threading.Lock = threading.Lock()
+
+
+def record_transfer(algorithm: str | None, raw_size: int, sent_size: int, cpu_time: float):
+    with TRANSFER_STATS_LOCK:
+        stats: list = TRANSFER_STATS.setdefault(algorithm, [0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += raw_size
+        stats[2] += sent_size
+        stats[3] += cpu_time
+
+
+def transfer_stats() -> dict[str, dict]:
+    """
+    :return: algorithm ('none' for uncompressed transfers) -> transfers, bytes, bytes sent, ratio (bytes sent / bytes)
+             and the CPU seconds spent compressing
+    """
+    with TRANSFER_STATS_LOCK:
+        return {algorithm or 'none': {'transfers': transfers,
+                                      'bytes': raw_size,
+                                      'sent_bytes': sent_size,
+                                      'ratio': sent_size / raw_size if raw_size else 1.0,
+                                      'cpu_seconds': cpu_time}
+                for algorithm, (transfers, raw_size, sent_size, cpu_time) in TRANSFER_STATS.items()}
+
+
+def connection_compressions(connection_socket) -> tuple[str, ...]:
+    """
+    The algorithms the peer on the other end can decompress (see CRequest.Compressions). Only multiplexed connections
+    agree on any, every other connection sends everything as it is
+    :param connection_socket:
+    :return:
+    """
+    return getattr(connection_socket, 'compressions', ())
+
+
+def pick_compressions(offer: bytes) -> tuple[str, ...]:
+    """
+    :param offer: the comma separated algorithms the client can decompress
+    :return: the ones this peer can decompress too
+    """
+    offered: list[str] = offer.decode('utf-8').split(',')
+    return tuple(algorithm for algorithm in offered if algorithm in WIRE_COMPRESSIONS)
+
+
+def compresses_well(sample) -> bool:
+    """
+    :param sample:
+    :return: True if zlib's fastest level makes sample noticeably smaller
+    """
+    return len(zlib.compress(sample, 1)) <= len(sample) * COMPRESSION_MAX_RATIO
+
+
+def compress(data, algorithm: str) -> bytes:
+    if algorithm == 'lzma':
+        return lzma.compress(data, preset=0)
+    if algorithm == 'bz2':
+        return bz2.compress(data)
+    return zlib.compress(data, 1)
+
+
+def compressor(algorithm: str):
+    if algorithm == 'lzma':
+        return lzma.LZMACompressor(preset=0)
+    if algorithm == 'bz2':
+        return bz2.BZ2Compressor()
+    return zlib.compressobj(1)
+
+
+def decompressor(algorithm_id: int):
+    algorithm: str | None = ALGORITHM_NAMES.get(algorithm_id)
+    if algorithm is None:
+        raise ValueError(f"Unknown compression algorithm {algorithm_id}")
+    if algorithm == 'lzma':
+        return lzma.LZMADecompressor()
+    if algorithm == 'bz2':
+        return bz2.BZ2Decompressor()
+    return zlib.decompressobj()
+
+
+def decompressed_pieces(decompressing, data: bytes):
+    """
+    Decompresses data at most COMPRESSION_FRAME_SIZE bytes at a time, so the caller can stop before a small input that
+    decompresses to a lot is held in memory
+    :param decompressing: from decompressor
+    :param data:
+    :return: yields the decompressed data in pieces
+    """
+    while True:
+        piece: bytes = decompressing.decompress(data, COMPRESSION_FRAME_SIZE)
+        # zlib hands back the input it didn't get to, bz2 and lzma keep it and carry on when called with none
+        data = getattr(decompressing, 'unconsumed_tail', b'')
+        if piece:
+            yield piece
+        if decompressing.eof or (len(piece) < COMPRESSION_FRAME_SIZE and not data):
+            return
+
+
+def compress_payload(connection_socket, payload: bytes) -> bytes:
+    """
+    Compresses an encoded Peer, File or SyncFile payload if the peer can decompress it and it is worth it
+    :param connection_socket:
+    :param payload: from FF.encode_object or FF.encode_object_list
+    :return: the payload to send
+    """
+    compressions: tuple[str, ...] = connection_compressions(connection_socket)
+    if not compressions or len(payload) < COMPRESSION_MIN_SIZE:
+        return payload
+
+    algorithm: str = 'lzma' if 'lzma' in compressions else compressions[0]
+    start: float = time.thread_time()
+    compressed: bytes = bytes((COMPRESSED_MAGIC, ALGORITHM_IDS[algorithm])) + compress(payload, algorithm)
+    cpu_time: float = time.thread_time() - start
+
+    if len(compressed) >= len(payload):
+        record_transfer(None, len(payload), len(payload), cpu_time)
+        return payload
+    record_transfer(algorithm, len(payload), len(compressed), cpu_time)
+    return compressed
+
+
+def decompress_payload(received_data):
+    """
+    :param received_data:
+    :return: received_data, decompressed if it was compressed by compress_payload
+    """
+    if len(received_data) < 2 or received_data[0] != COMPRESSED_MAGIC:
+        return received_data
+
+    decompressing = decompressor(received_data[1])
+    data: bytearray = bytearray()
+    for piece in decompressed_pieces(decompressing, bytes(received_data[2:])):
+        data += piece
+        if len(data) > COMPRESSION_MAX_PAYLOAD_SIZE:
+            raise ValueError(f"Compressed payload decompresses to more than {COMPRESSION_MAX_PAYLOAD_SIZE} bytes")
+    if not decompressing.eof:
+        raise ValueError("Truncated compressed payload")
+    return data
+
+
+def is_compressed_file(name: str) -> bool:
+    """
+    :param name:
+    :return: True if the file's extension says it is compressed already, so it is always sent as it is
+    """
+    return PurePath(name).suffix.lower() in COMPRESSED_EXTENSIONS
+
+
+def choose_file_compression(storage: Storage, name: str, file_size: int,
+                            compressions: tuple[str, ...]) -> str | None:
+    """
+    :param storage:
+    :param name:
+    :param file_size:
+    :param compressions: the algorithms the receiver can decompress
+    :return: the algorithm to send the file with, None to send it as it is
+    """
+    if not compressions or file_size < COMPRESSION_MIN_SIZE or is_compressed_file(name):
+        return None
+
+    # A sample from the middle, the start of a file is often a header that doesn't look like the rest
+    if not compresses_well(storage.read(name, max(0, file_size // 2 - COMPRESSION_SAMPLE_SIZE // 2),
+                                        COMPRESSION_SAMPLE_SIZE)):
+        return None
+
+    if file_size <= COMPRESSION_STRONG_MAX_SIZE and 'bz2' in compressions:
+        return 'bz2'
+    return 'zlib' if 'zlib' in compressions else compressions[0]
+
+
+def send_file_stream(connection_socket, storage: Storage, name: str, file_size: int):
+    """
+    Sends file_size bytes of a file after its size has been sent. Peers that agreed on compression get the algorithm
+    byte first, and the file compressed if choose_file_compression thinks it is worth it
+    :param connection_socket:
+    :param storage:
+    :param name:
+    :param file_size:
+    :return:
+    """
+    compressions: tuple[str, ...] = connection_compressions(connection_socket)
+    if not compressions:
+        storage.send_range(connection_socket, name, 0, file_size)
+        return
+
+    algorithm: str | None = choose_file_compression(storage, name, file_size, compressions)
+    if algorithm is None:
+        connection_socket.sendall(bytes((NO_COMPRESSION,)))
+        storage.send_range(connection_socket, name, 0, file_size)
+        record_transfer(None, file_size, file_size, 0.0)
+        return
+
+    connection_socket.sendall(bytes((ALGORITHM_IDS[algorithm],)))
+    compressing = compressor(algorithm)
+    sent_size: int = 0
+    cpu_time: float = 0.0
+
+    def send_frame(frame: bytes):
+        nonlocal sent_size
+        if frame:
+            UploadScheduler.pace(FRAME_LENGTH_SIZE + len(frame))
+            connection_socket.sendall(len(frame).to_bytes(FRAME_LENGTH_SIZE, 'big') + frame)
+            sent_size += FRAME_LENGTH_SIZE + len(frame)
+
+    for piece in storage.pieces(name, 0, file_size, COMPRESSION_FRAME_SIZE):
+        start: float = time.thread_time()
+        frame: bytes = compressing.compress(piece)
+        cpu_time += time.thread_time() - start
+        send_frame(frame)
+
+    start = time.thread_time()
+    send_frame(compressing.flush())
+    cpu_time += time.thread_time() - start
+    connection_socket.sendall(bytes(FRAME_LENGTH_SIZE))
+
+    record_transfer(algorithm, file_size, sent_size, cpu_time)
+
+
+def receive_file_stream(connection_socket, file_size: int):
+    """
+    Receives a file sent by send_file_stream
+    :param connection_socket:
+    :param file_size: the size sent before the file
+    :return: yields the file's data in pieces
+    """
+    if not connection_compressions(connection_socket):
+        yield from receive_raw(connection_socket, file_size)
+        return
+
+    algorithm_id: int = FF.receive_exact(connection_socket, 1)[0]
+    if algorithm_id == NO_COMPRESSION:
+        yield from receive_raw(connection_socket, file_size)
+        return
+
+    decompressing = decompressor(algorithm_id)
+    received_size: int = 0
+    while True:
+        frame_length: int = int.from_bytes(FF.receive_exact(connection_socket, FRAME_LENGTH_SIZE), 'big')
+        if not frame_length:
+            break
+        if frame_length > 2 * COMPRESSION_FRAME_SIZE + 1024:
+            raise ValueError(f"Compressed frame of {frame_length} bytes is too large")
+
+        for data in decompressed_pieces(decompressing, FF.receive_exact(connection_socket, frame_length)):
+            received_size += len(data)
+            if received_size > file_size:
+                raise ValueError("The file decompressed to more than its size")
+            yield data
+
+    if received_size != file_size:
+        raise ValueError(f"Expected {file_size} bytes, the file decompressed to {received_size}")
+
+
+def receive_raw(connection_socket, file_size: int):
+    received_size: int = 0
+    while received_size < file_size:
+        data: bytes = connection_socket.recv(min(COMPRESSION_FRAME_SIZE, file_size - received_size))
+        if not data:
+            raise ConnectionError("Connection closed before the whole file was received")
+        received_size += len(data)
+        yield data
@@ -0,0 +1,322 @@
+"""
+rsync style delta transfer used by SyncFileUpdate.
+
+The receiver splits its current copy of the sync file in to blocks and sends a signature for each one (a weak rolling
+checksum and a strong hash). The sender slides a window over its new copy looking for blocks the receiver already
+has, and sends back only block references and the literal bytes in between. The weak checksum is Adler-32, which can
+be rolled forward one byte at a time, so only the regions that actually changed are scanned byte by byte.
+"""
+# noinspection PyUnresolvedReferences
+from Constants import (FIXED_LENGTH_HEADER,
+                       BUFFER_SIZE,
+                       DELTA_MIN_BLOCK_SIZE,
+                       DELTA_MAX_BLOCK_SIZE,
+                       DELTA_MAX_LITERAL,
+                       DELTA_READ_SIZE)
+
+# noinspection PyUnresolvedReferences
+from Classes.UploadScheduler import UploadScheduler
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Tracing_Functions as TR
+
+import hashlib
+import math
+import os
+import socket
+import zlib
+from pathlib import Path
+
+ADLER_MOD: int = 65521
+STRONG_HASH_SIZE: int = 16
+WEAK_HASH_SIZE: int = 4
+BLOCK_SIZE_BYTES: int = 4
+
+LITERAL_OP: bytes = b'L'
+BLOCK_OP: bytes = b'B'
+END_OP: bytes = b'E'
+
+
+def strong_hash(data) -> bytes:
+    return hashlib.md5(data).digest()
+
+
+def choose_block_size(file_size: int) -> int:
+    """
+    Same rule of thumb as rsync, the square root of the file size. Larger files get larger blocks so the amount of
+    signatures sent stays small
+    :param file_size:
+    :return:
+    """
+    block_size: int = math.isqrt(file_size) // 8 * 8
+    return max(DELTA_MIN_BLOCK_SIZE, min(DELTA_MAX_BLOCK_SIZE, block_size))
+
+
+def compute_signatures(file_path: Path) -> tuple[int, list[tuple[int, bytes]]]:
+    """
+    Computes the weak and strong checksum of every full block in the file. A missing file has no blocks
+    :param file_path:
+    :return: (block size, [(weak checksum, strong hash), ...])
+    """
+    try:
+        file_size: int = os.stat(file_path).st_size
+    except FileNotFoundError:
+        return DELTA_MIN_BLOCK_SIZE, []
+
+    block_size: int = choose_block_size(file_size)
+    signatures: list[tuple[int, bytes]] = []
+
+    with open(file_path, 'rb') as f, TR.span('signatures', filename=file_path.name):
+        while True:
+            block: bytes = f.read(block_size)
+            if len(block) < block_size:
+                # The last partial block is never matched, the sender will send it as a literal
+                break
+            signatures.append((zlib.adler32(block), strong_hash(block)))
+
+    return block_size, signatures
+
+
+def send_signatures(connection_socket: socket.socket, file_path: Path) -> int:
+    """
+    Sends the signatures of the file at file_path
+    :param connection_socket:
+    :param file_path:
+    :return: the block size used, which is needed to apply the delta later
+    """
+    block_size, signatures = compute_signatures(file_path)
+
+    payload: bytearray = bytearray(block_size.to_bytes(BLOCK_SIZE_BYTES, 'big'))
+    for weak, strong in signatures:
+        payload += weak.to_bytes(WEAK_HASH_SIZE, 'big')
+        payload += strong
+
+    connection_socket.sendall(len(payload).to_bytes(FIXED_LENGTH_HEADER, 'big') + payload)
+
+    return block_size
+
+
+def receive_signatures(connection_socket: socket.socket) -> tuple[int, dict[int, list[tuple[bytes, int]]]]:
+    """
+    Receives the block signatures of the receiver's copy
+    :param connection_socket:
+    :return: (block size, {weak checksum: [(strong hash, block index), ...]})
+    """
+    length_bytes: bytes = connection_socket.recv(FIXED_LENGTH_HEADER)
+    payload: bytearray = FF.receive_data(connection_socket, length_bytes)
+
+    block_size: int = int.from_bytes(payload[:BLOCK_SIZE_BYTES], 'big')
+    entry_size: int = WEAK_HASH_SIZE + STRONG_HASH_SIZE
+
+    signature_table: dict[int, list[tuple[bytes, int]]] = {}
+    for index, start in enumerate(range(BLOCK_SIZE_BYTES, len(payload), entry_size)):
+        weak: int = int.from_bytes(payload[start:start + WEAK_HASH_SIZE], 'big')
+        strong: bytes = bytes(payload[start + WEAK_HASH_SIZE:start + entry_size])
+        signature_table.setdefault(weak, []).append((strong, index))
+
+    return block_size, signature_table
+
+
+def send_delta(connection_socket: socket.socket, file_path: Path, block_size: int,
+               signature_table: dict[int, list[tuple[bytes, int]]]) -> tuple[int, int]:
+    """
+    Sends the file at file_path as a list of operations the receiver can rebuild it from:
+        L <length> <bytes>      literal bytes the receiver doesn't have
+        B <index> <count>       count blocks of the receiver's copy starting at block index
+        E <hash>                end, with the strong hash of the whole file so the receiver can check the result
+    :param connection_socket:
+    :param file_path:
+    :param block_size:
+    :param signature_table: as returned by receive_signatures
+    :return: (literal bytes sent, bytes matched against the receiver's copy)
+    """
+    literal_bytes: int = 0
+    matched_bytes: int = 0
+
+    # The file is read once, front to back. window holds what has been read and not sent yet, starting at the first
+    # byte not sent, so it never holds more than DELTA_MAX_LITERAL + block_size + DELTA_READ_SIZE bytes whatever the
+    # size of the file
+    window: bytearray = bytearray()
+    file_hasher = hashlib.md5()
+    at_end: bool = False
+
+    def fill(size: int):
+        nonlocal at_end
+        while len(window) < size and not at_end:
+            data: bytes = f.read(DELTA_READ_SIZE)
+            if not data:
+                at_end = True
+                break
+            file_hasher.update(data)
+            window.extend(data)
+
+    def send_literal(length: int):
+        nonlocal literal_bytes
+        sent: int = 0
+        while sent < length:
+            piece_length: int = min(DELTA_MAX_LITERAL, UploadScheduler.piece_size(length - sent), length - sent)
+            UploadScheduler.pace(piece_length)
+            connection_socket.sendall(LITERAL_OP + piece_length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+            with memoryview(window) as view, view[sent:sent + piece_length] as piece:
+                connection_socket.sendall(piece)
+            literal_bytes += piece_length
+            sent += piece_length
+        del window[:length]
+
+    def send_blocks(index: int, count: int):
+        connection_socket.sendall(BLOCK_OP + index.to_bytes(FIXED_LENGTH_HEADER, 'big')
+                                  + count.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+
+    def block_at(start: int):
+        return memoryview(window)[start:start + block_size]
+
+    # Read a piece at a time rather than mapped: a mapping of a file the user truncates while it is sent crashes the
+    # process (SIGBUS) instead of raising
+    with open(file_path, 'rb') as f:
+        position: int = 0  # Where the block being looked at starts in window, the bytes before it are literal
+        run_index: int = -1  # A run of consecutive matched blocks waiting to be sent
+        run_count: int = 0
+        weak: int | None = None
+
+        while signature_table:
+            if position + block_size >= len(window):
+                # One byte past the block as well, for rolling the checksum forward
+                fill(position + block_size + 1)
+                if position + block_size > len(window):
+                    break
+
+            if weak is None:
+                with block_at(position) as block:
+                    weak = zlib.adler32(block)
+
+            match: int | None = None
+            candidates: list[tuple[bytes, int]] | None = signature_table.get(weak)
+            if candidates:
+                with block_at(position) as block:
+                    strong: bytes = strong_hash(block)
+                for candidate_strong, index in candidates:
+                    if candidate_strong == strong:
+                        match = index
+                        # Prefer the block right after the previous match so runs stay together
+                        if index == run_index + run_count:
+                            break
+
+            if match is not None:
+                if position:
+                    if run_count:
+                        send_blocks(run_index, run_count)
+                        run_count = 0
+                    send_literal(position)
+
+                if run_count and match == run_index + run_count:
+                    run_count += 1
+                else:
+                    if run_count:
+                        send_blocks(run_index, run_count)
+                    run_index, run_count = match, 1
+
+                matched_bytes += block_size
+                del window[:block_size]
+                position = 0
+                weak = None
+                continue
+
+            # Roll the window forward by one byte
+            if position + block_size < len(window):
+                a: int = weak & 0xFFFF
+                b: int = weak >> 16
+                out_byte: int = window[position]
+                a = (a - out_byte + window[position + block_size]) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                weak = (b << 16) | a
+            position += 1
+
+            if position >= DELTA_MAX_LITERAL:
+                # The checksum is of the block at position, which stays the same block once the literal is sent
+                if run_count:
+                    send_blocks(run_index, run_count)
+                    run_count = 0
+                send_literal(position)
+                position = 0
+
+        if run_count:
+            send_blocks(run_index, run_count)
+
+        # Whatever is left after the last block that could match
+        while True:
+            send_literal(len(window))
+            fill(DELTA_READ_SIZE)
+            if not window:
+                break
+
+    connection_socket.sendall(END_OP + file_hasher.digest())
+
+    return literal_bytes, matched_bytes
+
+
+def receive_delta(connection_socket: socket.socket, file_path: Path, block_size: int):
+    """
+    Rebuilds the file from the operations sent by send_delta, using the current copy at file_path for block
+    references. The new copy is written next to the old one and only replaces it once its hash has been checked
+    :param connection_socket:
+    :param file_path:
+    :param block_size: the block size the signatures were computed with
+    :return:
+    """
+    temporary_path: Path = file_path.with_name(file_path.name + '.sync~')
+    hasher = hashlib.md5()
+    content_hasher = FF.SYNC_FILE_HASHES.new_hasher()  # The hash the SyncFiles folder is compared with
+
+    basis = open(file_path, 'rb') if file_path.exists() else None
+    try:
+        with open(temporary_path, 'wb') as f:
+            while True:
+                op: bytes = FF.receive_exact(connection_socket, 1)
+
+                if op == LITERAL_OP:
+                    remaining: int = int.from_bytes(FF.receive_exact(connection_socket, FIXED_LENGTH_HEADER), 'big')
+                    while remaining:
+                        data = connection_socket.recv(min(BUFFER_SIZE, remaining))
+                        if not data:
+                            raise ConnectionError("Connection closed before full delta received")
+                        f.write(data)
+                        hasher.update(data)
+                        content_hasher.update(data)
+                        remaining -= len(data)
+
+                elif op == BLOCK_OP:
+                    index: int = int.from_bytes(FF.receive_exact(connection_socket, FIXED_LENGTH_HEADER), 'big')
+                    count: int = int.from_bytes(FF.receive_exact(connection_socket, FIXED_LENGTH_HEADER), 'big')
+                    if basis is None:
+                        raise ValueError("Received a block reference without a copy of the file")
+                    basis.seek(index * block_size)
+                    data = basis.read(count * block_size)
+                    f.write(data)
+                    hasher.update(data)
+                    content_hasher.update(data)
+
+                elif op == END_OP:
+                    expected_hash: bytes = FF.receive_exact(connection_socket, STRONG_HASH_SIZE)
+                    break
+
+                else:
+                    raise ValueError(f"Unknown delta operation: {op}")
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+    finally:
+        if basis is not None:
+            basis.close()
+
+    if hasher.digest() != expected_hash:
+        temporary_path.unlink(missing_ok=True)
+        raise ValueError(f"The rebuilt copy of {file_path.name} does not match the sender's copy")
+
+    # Before the replace, so whoever watches the folder already knows this copy came from another user
+    # os.replace keeps the inode and modification time, so the cached hash stays valid for file_path
+    content_hash: str = content_hasher.hexdigest()
+    FF.SYNC_FILE_HASHES.put(file_path, os.stat(temporary_path), content_hash)
+    FF.record_received_sync_file(file_path.name, content_hash)
+    os.replace(temporary_path, file_path)
@@ -0,0 +1,99 @@
+"""
+Sends the same kind of request to many peers at once.
+
+Every peer is contacted on its own thread (at most FAN_OUT_MAX_THREADS at a time) and the caller waits until every
+peer has answered or the deadline has passed, so a broadcast takes about as long as the slowest peer instead of the
+sum of all of them, and a dead peer costs one timeout no matter how many peers there are.
+"""
+# noinspection PyUnresolvedReferences
+from Constants import FAN_OUT_MAX_THREADS
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Tracing_Functions as TR
+
+from collections import deque
+import threading
+import time
+
+
+def fan_out(peers, send_to_peer, deadline: float) -> dict[tuple[str, int], object]:
+    """
+    Calls send_to_peer(peer) for every peer at the same time
+    :param peers: Peer objects (or anything with an addr), a peer listed twice is only contacted once
+    :param send_to_peer: does the request for one peer, what it returns is kept as the result for that peer
+    :param deadline: seconds to wait for all peers to finish
+    :return: {peer address: what send_to_peer returned or the exception it raised}. Peers that hadn't finished by the
+             deadline get a TimeoutError
+    """
+    unique_peers: dict[tuple[str, int], object] = {}
+    for peer in peers:
+        unique_peers.setdefault(tuple(peer.addr), peer)
+
+    results: dict[tuple[str, int], object] = {}
+    if not unique_peers:
+        return results
+
+    condition: threading.Condition = threading.Condition()
+    waiting: deque = deque(unique_peers.items())
+    # The requests made on the threads belong to the span the caller is in
+    parent_span: dict | None = TR.current_span()
+
+    def work():
+        while True:
+            with condition:
+                if not waiting:
+                    return
+                addr, peer = waiting.popleft()
+
+            try:
+                with TR.continued(parent_span):
+                    result = send_to_peer(peer)
+            except Exception as e:
+                result = e
+
+            with condition:
+                results[addr] = result
+                condition.notify_all()
+
+    for _ in range(min(len(unique_peers), FAN_OUT_MAX_THREADS)):
+        threading.Thread(target=work, daemon=True).start()
+
+    end: float = time.monotonic() + deadline
+    with condition:
+        while len(results) < len(unique_peers):
+            remaining: float = end - time.monotonic()
+            if remaining <= 0:
+                break
+            condition.wait(remaining)
+
+        # Peers that haven't been started yet won't be, the ones in progress finish on their own
+        waiting.clear()
+        finished: dict[tuple[str, int], object] = dict(results)
+
+    for addr in unique_peers:
+        if addr not in finished:
+            finished[addr] = TimeoutError(f"No answer within {deadline} seconds")
+    return finished
+
+
+def succeeded(results: dict[tuple[str, int], object]) -> dict[tuple[str, int], object]:
+    """
+    :param results: as returned by fan_out
+    :return: the results of the peers that didn't fail
+    """
+    return {addr: result for addr, result in results.items() if not isinstance(result, Exception)}
+
+
+def report_failures(results: dict[tuple[str, int], object], action: str) -> int:
+    """
+    Prints the peers that failed
+    :param results: as returned by fan_out
+    :param action: what was being done, for the message
+    :return: the amount of peers that failed
+    """
+    failures: int = 0
+    for addr, result in results.items():
+        if isinstance(result, Exception):
+            print(f"[Error] Failed to {action} {addr}: {result}")
+            failures += 1
+    return failures
@@ -5,24 +5,148 @@ from Constants import (FIXED_LENGTH_HEADER,
                        BUFFER_SIZE,
                        C_REQUEST_BYTE_LENGTH,
                        S_REQUEST_BYTE_LENGTH,
-                       DOWNLOAD_FOLDER_TIMEOUT)
+                       DOWNLOAD_FOLDER_TIMEOUT,
+                       DOWNLOAD_RETRY_ATTEMPTS,
+                       RANGE_TO_END,
+                       PARTIAL_FILE_SUFFIX,
+                       PARTIAL_STATE_SUFFIX,
+                       SERVER_BUSY_RETRY_DELAY,
+                       JSON_CODEC,
+                       BINARY_CODEC,
+                       HASH_CACHE_FILENAME,
+                       SYNC_FILE_LOCK_STRIPES)
 
 import json
 
 # noinspection PyUnresolvedReferences
-from Classes import (Peer,
-                     File,
-                     SyncFile)
+from Classes.Catalog import Catalog
+# noinspection PyUnresolvedReferences
+from Classes.ChunkIndex import ChunkIndex
+# noinspection PyUnresolvedReferences
+from Classes.ConnectionPool import ConnectionPool
 # noinspection PyUnresolvedReferences
 from Classes.CRequest import CRequest
+# noinspection PyUnresolvedReferences
+from Classes.DiskStorage import DiskStorage
 # Import these separately to avoid compiler error
 # noinspection PyUnresolvedReferences
+from Classes.File import File
+# noinspection PyUnresolvedReferences
+from Classes.HashCache import HashCache
+# noinspection PyUnresolvedReferences
+from Classes.LockStripes import LockStripes
+# noinspection PyUnresolvedReferences
+from Classes.MeteredSocket import MeteredSocket
+# noinspection PyUnresolvedReferences
+from Classes.Peer import Peer
+# noinspection PyUnresolvedReferences
 from Classes.SRequest import SRequest
 # noinspection PyUnresolvedReferences
+from Classes.ServerBusyError import ServerBusyError
+# noinspection PyUnresolvedReferences
+from Classes.Storage import Storage
+# noinspection PyUnresolvedReferences
 from Classes.SyncFile import SyncFile
+# noinspection PyUnresolvedReferences
+from Classes.SyncUpdateQueue import SyncUpdateQueue
+# noinspection PyUnresolvedReferences
+from Classes.PartialDownload import PartialDownload
+# noinspection PyUnresolvedReferences
+from Classes.UploadScheduler import UploadScheduler
 
 from pathlib import Path
 import socket
+import threading
+import time
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Chunk_Functions as CH
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Codec_Functions as CF
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Compression_Functions as CP
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Delta_Functions as DF
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Fan_Out_Functions as FO
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Metrics_Functions as MT
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Tracing_Functions as TR
+
+# The long-lived connections to other peers that control requests are sent over
+CONNECTION_POOL: ConnectionPool = ConnectionPool()
+
+# Shares the uplink out between the peers this peer uploads to, see run_server for the limits
+UPLOAD_SCHEDULER: UploadScheduler = UploadScheduler()
+
+# The (epoch, version) the last catalog refresh from a peer ended at, by (peer address, request name)
+CATALOG_CURSORS: dict[tuple[tuple[str, int], str], tuple[int, int]] = {}
+
+# Where shared files and SyncFiles are kept. Files are read, sent and written through the storages, the directories
+# are for what only works on disk (listing the folders, the chunk index, resumable downloads)
+FILES_DIRECTORY: Path = Path.cwd() / "Files"
+SYNC_FILES_DIRECTORY: Path = Path.cwd() / "SyncFiles"
+FILE_STORAGE: Storage = DiskStorage(FILES_DIRECTORY)
+SYNC_FILE_STORAGE: Storage = DiskStorage(SYNC_FILES_DIRECTORY)
+
+# The content hashes of SyncFiles, kept between runs
+SYNC_FILE_HASHES: HashCache = HashCache(Path.cwd() / HASH_CACHE_FILENAME)
+
+# Where the chunks of every local file are, so files being received can reuse them
+CHUNK_INDEX: ChunkIndex = ChunkIndex([FILES_DIRECTORY, SYNC_FILES_DIRECTORY],
+                                     ignore=lambda name: name.endswith('~') or is_partial_download(name))
+
+# The hash of the last copy of a SyncFile received from another user, by filename, so it isn't sent back as a change
+RECEIVED_SYNC_FILE_HASHES: dict[str, str] = {}
+RECEIVED_SYNC_FILE_LOCK: threading.Lock = threading.Lock()
+
+# Held by filename while a SyncFile is sent to a new subscriber, received or sent as an update, so one file's copies
+# are written and sent one at a time without holding up other files. The SyncFile lists keep their own lock, which
+# is only taken briefly, and always after the file's lock
+SYNC_FILE_LOCKS: LockStripes = LockStripes('sync_file_stripes', SYNC_FILE_LOCK_STRIPES)
+
+# Sends the updates of the SyncFiles this user changes in the background, see run.publish_sync_file
+SYNC_UPDATE_QUEUE: SyncUpdateQueue = SyncUpdateQueue(lambda sync_file, user:
+                                                     send_queued_sync_file_update(sync_file, user))
+
+DIRECTORY_LISTINGS: dict[Path, tuple[int, frozenset[str]]] = {}  # directory -> (modification time, file names)
+DIRECTORY_LISTING_LOCK: threading.Lock = threading.Lock()
+
+
+def open_peer_stream(addr: tuple[str, int], timeout: float | None):
+    """
+    Returns a connected stream to the peer's server for a single request. The stream is carried over the persistent
+    connection to that peer (opened on first use), closing it only ends the request
+    :param addr:
+    :param timeout:
+    :return:
+    """
+    return CONNECTION_POOL.open_stream(addr, timeout)
+
+
+def open_peer_socket(addr: tuple[str, int], timeout: float | None) -> socket.socket:
+    """
+    Returns a connection of its own to the peer's server for a single request that carries a file's contents. Unlike
+    a stream of the persistent connection, files sent over it are handed to the kernel with socket.sendfile, but
+    nothing is compressed (see CP.connection_compressions)
+    :param addr:
+    :param timeout:
+    :return:
+    """
+    return CONNECTION_POOL.open_plain_socket(addr, timeout)
+
+
+def connection_peer_host(connection_socket) -> str | None:
+    """
+    :param connection_socket: a socket, a stream of a multiplexed connection or a channel of the AsyncServer
+    :return: the host of the peer on the other end, None if it isn't known
+    """
+    try:
+        addr = getattr(connection_socket, 'peer_addr', None) or connection_socket.getpeername()
+    except (AttributeError, OSError):
+        return None
+    return addr[0] if addr else None
 
 
 def receive_data(connection_socket, length_bytes):
@@ -36,7 +160,8 @@ def receive_data(connection_socket, length_bytes):
 
     received_data: bytearray = bytearray()
     while len(received_data) < data_length:
-        chunk = connection_socket.recv(BUFFER_SIZE)
+        # Never read past the end of this message, whatever follows it belongs to the next one
+        chunk = connection_socket.recv(min(BUFFER_SIZE, data_length - len(received_data)))
         if not chunk:
             raise ConnectionError("Connection closed before full data received")
         received_data.extend(chunk)
@@ -44,10 +169,22 @@ def receive_data(connection_socket, length_bytes):
     return received_data
 
 
+def receive_exact(connection_socket, size: int) -> bytes:
+    """
+    Receives exactly size bytes
+    :param connection_socket:
+    :param size:
+    :return:
+    """
+    return bytes(receive_data(connection_socket, size.to_bytes(FIXED_LENGTH_HEADER, 'big')))
+
+
 def receive_Ok(connection_socket):
     response_bytes: bytes = connection_socket.recv(S_REQUEST_BYTE_LENGTH)
     response: str = response_bytes.rstrip(b'\x00').decode('utf-8')
 
+    if response == SRequest.Busy.name:
+        raise ServerBusyError("The server is busy, try again later")
     if response != SRequest.Ok.name:
         raise ValueError(f"Expected Ok, got: {response}")
 
@@ -60,36 +197,118 @@ def send_request(connection_socket, request_type):
     connection_socket.sendall(request_type_bytes)
 
 
-def receive_Peer(connection_socket):
+def send_payload(connection_socket, payload: bytes):
     """
-    This method receives a Peer object and returns the object
+    Sends the length of the payload followed by the payload itself, in one go: a separate header is a small segment
+    the payload waits behind until it is acknowledged (Nagle and delayed ACKs), on peers that haven't turned Nagle off
+    :param connection_socket:
+    :param payload:
+    :return:
+    """
+    data_length: int = len(payload)
+    UploadScheduler.pace(FIXED_LENGTH_HEADER + data_length)
+    connection_socket.sendall(data_length.to_bytes(FIXED_LENGTH_HEADER, 'big') + payload)
+
+
+def receive_payload(connection_socket) -> bytearray:
+    """
+    Receives a payload sent with send_payload
     :param connection_socket:
     :return:
     """
-    # Receive data length
     length_bytes: bytes = connection_socket.recv(FIXED_LENGTH_HEADER)
 
-    received_data = receive_data(connection_socket, length_bytes)
+    return receive_data(connection_socket, length_bytes)
+
+
+def connection_codec(connection_socket) -> str:
+    """
+    The encoding agreed on for the connection (see CRequest.Codecs). Only streams of a multiplexed connection negotiate
+    one, every other connection uses JSON
+    :param connection_socket:
+    :return:
+    """
+    return getattr(connection_socket, 'codec', JSON_CODEC)
+
+
+@TR.traced('encode')
+def encode_object(object_to_send, codec: str = JSON_CODEC) -> bytes:
+    """
+    Encodes a Peer, File or SyncFile to be sent
+    :param object_to_send:
+    :param codec: JSON_CODEC or BINARY_CODEC
+    :return:
+    """
+    if codec == BINARY_CODEC:
+        return CF.encode_objects((object_to_send,))
+
+    return json.dumps(object_to_send.__dict__()).encode('utf-8')
+
+
+@TR.traced('encode')
+def encode_object_list(objects_to_send, codec: str = JSON_CODEC) -> bytes:
+    """
+    Encodes a list of Peer, File or SyncFile objects to be sent. None is sent as an empty list
+    :param objects_to_send:
+    :param codec: JSON_CODEC or BINARY_CODEC
+    :return:
+    """
+    if codec == BINARY_CODEC:
+        return CF.encode_objects(objects_to_send or [])
+
+    return json.dumps([obj.__dict__() for obj in objects_to_send or []]).encode('utf-8')
+
+
+@TR.traced('decode')
+def decode_object(received_data, object_class):
+    """
+    Decodes an object encoded by encode_object, in either encoding and compressed or not
+    :param received_data:
+    :param object_class: Peer, File or SyncFile
+    :return: the object or None if nothing was sent
+    """
+    received_data = CP.decompress_payload(received_data)
+    if CF.is_binary(received_data):
+        objects: list = CF.decode_objects(received_data, object_class)
+        return objects[0] if objects else None
 
-    json_user_as_peer: str = received_data.decode('utf-8')
-    if not json_user_as_peer:
+    json_object: str = received_data.decode('utf-8')
+    if not json_object:
         return
 
-    dict_user = json.loads(json_user_as_peer)
+    return object_class.from_dict(json.loads(json_object))
 
-    client_user_as_peer = Peer.from_dict(dict_user)
 
-    return client_user_as_peer
+@TR.traced('decode')
+def decode_object_list(received_data, object_class) -> list:
+    """
+    Decodes a list encoded by encode_object_list, in either encoding and compressed or not
+    :param received_data:
+    :param object_class: Peer, File or SyncFile
+    :return:
+    """
+    received_data = CP.decompress_payload(received_data)
+    if CF.is_binary(received_data):
+        return CF.decode_objects(received_data, object_class)
 
+    json_object_list: str = received_data.decode('utf-8')
+    if not json_object_list or json_object_list == '[]':
+        return []
 
-def send_Peer(connection_socket: socket.socket, user_peer):
-    json_peer: str = json.dumps(user_peer.__dict__())
-    bytes_peer: bytes = json_peer.encode('utf-8')
+    return [object_class.from_dict(object_dict) for object_dict in json.loads(json_object_list)]
 
-    data_length: int = len(bytes_peer)
-    connection_socket.sendall(data_length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
 
-    connection_socket.sendall(bytes_peer)
+def receive_Peer(connection_socket):
+    """
+    This method receives a Peer object and returns the object
+    :param connection_socket:
+    :return:
+    """
+    return decode_object(receive_payload(connection_socket), Peer)
+
+
+def send_Peer(connection_socket: socket.socket, user_peer):
+    send_payload(connection_socket, encode_object(user_peer, connection_codec(connection_socket)))
 
 
 def receive_File(connection_socket):
@@ -98,101 +317,247 @@ def receive_File(connection_socket):
     :param connection_socket:
     :return:
     """
-    length_bytes: bytes = connection_socket.recv(FIXED_LENGTH_HEADER)
+    return decode_object(receive_payload(connection_socket), File)
 
-    received_data = receive_data(connection_socket, length_bytes)
 
-    json_file: str = received_data.decode('utf-8')
-    if not json_file:
-        return
+def send_file(connection_socket, file_object):
+    send_payload(connection_socket, encode_object(file_object, connection_codec(connection_socket)))
 
-    dict_file = json.loads(json_file)
-    client_file = File.from_dict(dict_file)
 
-    return client_file
+def send_file_list(connection_socket, user_file_objects):
+    send_payload(connection_socket,
+                 CP.compress_payload(connection_socket,
+                                     encode_object_list(user_file_objects, connection_codec(connection_socket))))
 
 
-def send_file(connection_socket, file_object):
-    json_file: str = json.dumps(file_object.__dict__())
-    bytes_file: bytes = json_file.encode('utf-8')
+def send_sync_file_list(connection_socket, user_sync_file_objects):
+    send_payload(connection_socket,
+                 CP.compress_payload(connection_socket,
+                                     encode_object_list(user_sync_file_objects, connection_codec(connection_socket))))
 
-    data_length: int = len(bytes_file)
-    connection_socket.sendall(data_length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
 
-    connection_socket.sendall(bytes_file)
+def send_sync_file(connection_socket: socket.socket, sync_file_object):
+    send_payload(connection_socket, encode_object(sync_file_object, connection_codec(connection_socket)))
 
 
-def send_file_list(connection_socket, user_file_objects):
-    json_file_list: str = json.dumps([file.__dict__() for file in user_file_objects])
-    bytes_file_list: bytes = json_file_list.encode('utf-8')
+def receive_SyncFile(connection_socket: socket.socket):
+    return decode_object(receive_payload(connection_socket), SyncFile)
 
-    data_length: int = len(bytes_file_list)
-    connection_socket.sendall(data_length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
 
-    connection_socket.sendall(bytes_file_list)
+def send_peer_with_request(connection_socket, user, request_type):
+    """
+    This method sends a peer using a specified format
+    :param connection_socket:
+    :param user:
+    :param request_type:
+    :return:
+    """
+    with MT.measure(MT.CLIENT, request_type, connection_socket):
+        send_request(connection_socket, request_type)
 
+        receive_Ok(connection_socket)
+
+        send_Peer(connection_socket, user)
 
-def send_sync_file_list(connection_socket, user_sync_file_objects):
-    json_sync_file_list: str = json.dumps([sync_file.__dict__() for sync_file in user_sync_file_objects])
-    bytes_sync_file_list: bytes = json_sync_file_list.encode('utf-8')
 
-    data_length: int = len(bytes_sync_file_list)
-    connection_socket.sendall(data_length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+def request_peer_list(server_address: tuple[str, int], timeout: float | None) -> list:
+    """
+    Asks the peer at server_address for its peer list, which includes the peer itself
+    :param server_address:
+    :param timeout:
+    :return:
+    """
+    with open_peer_stream(server_address, timeout) as user_socket, \
+            MT.measure(MT.CLIENT, CRequest.RequestPeerList, user_socket):
+        send_request(user_socket, CRequest.RequestPeerList)
 
-    connection_socket.sendall(bytes_sync_file_list)
+        receive_Ok(user_socket)
 
+        return decode_object_list(receive_payload(user_socket), Peer)
 
-def send_sync_file(connection_socket: socket.socket, sync_file_object):
-    json_sync_file: str = json.dumps(sync_file_object.__dict__())
-    bytes_sync_file: bytes = json_sync_file.encode('utf-8')
 
-    data_length: int = len(bytes_sync_file)
-    connection_socket.sendall(data_length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+def encode_stats(stats: dict) -> bytes:
+    """
+    Stats are sent as JSON whatever codec the connection agreed on, they aren't Peer, File or SyncFile objects
+    :param stats: from Metrics_Functions.node_stats
+    :return:
+    """
+    return json.dumps(stats).encode('utf-8')
 
-    connection_socket.sendall(bytes_sync_file)
 
+def send_stats(connection_socket, stats: dict):
+    send_payload(connection_socket, CP.compress_payload(connection_socket, encode_stats(stats)))
 
-def receive_SyncFile(connection_socket: socket.socket):
-    length_bytes: bytes = connection_socket.recv(FIXED_LENGTH_HEADER)
 
-    received_data = receive_data(connection_socket, length_bytes)
+def request_stats(server_address: tuple[str, int], timeout: float | None) -> dict:
+    """
+    Asks the peer at server_address what it has measured (see Metrics_Functions.node_stats)
+    :param server_address:
+    :param timeout:
+    :return:
+    """
+    with open_peer_stream(server_address, timeout) as user_socket, MT.measure(MT.CLIENT, CRequest.Stats, user_socket):
+        send_request(user_socket, CRequest.Stats)
 
-    json_sync_file: str = received_data.decode('utf-8')
-    if not json_sync_file:
-        return
+        receive_Ok(user_socket)
 
-    dict_sync_file = json.loads(json_sync_file)
-    client_sync_file = SyncFile.from_dict(dict_sync_file)
+        return json.loads(CP.decompress_payload(receive_payload(user_socket)))
 
-    return client_sync_file
 
+def encode_catalog_cursor(cursor: tuple[int, int], full: bool | None = None) -> bytes:
+    """
+    :param cursor: (epoch, version) of a ChangeLog
+    :param full: sent by the server, whether the entries that follow are the whole catalog
+    :return:
+    """
+    epoch, version = cursor
+    encoded: bytes = epoch.to_bytes(FIXED_LENGTH_HEADER, 'big') + version.to_bytes(FIXED_LENGTH_HEADER, 'big')
+    return encoded if full is None else encoded + bytes([full])
 
-def send_peer_with_request(connection_socket, user, request_type):
+
+def decode_catalog_cursor(received_data) -> tuple[tuple[int, int], bool]:
     """
-    This method sends a peer using a specified format
+    :param received_data:
+    :return: ((epoch, version), full)
+    """
+    epoch: int = int.from_bytes(received_data[:FIXED_LENGTH_HEADER], 'big')
+    version: int = int.from_bytes(received_data[FIXED_LENGTH_HEADER:2 * FIXED_LENGTH_HEADER], 'big')
+    full: bool = len(received_data) > 2 * FIXED_LENGTH_HEADER and received_data[2 * FIXED_LENGTH_HEADER] == 1
+    return (epoch, version), full
+
+
+def encode_catalog_keys(keys: list[tuple]) -> bytes:
+    """
+    Encodes the (filename, owner address) keys of removed catalog entries. There are few of them, so they are always
+    sent as JSON
+    :param keys:
+    :return:
+    """
+    return json.dumps(keys).encode('utf-8')
+
+
+def decode_catalog_keys(received_data) -> list[tuple]:
+    keys: list = json.loads(received_data.decode('utf-8') or '[]')
+    return [(filename, tuple(owner) if owner is not None else None) for filename, owner in keys]
 
-    Todo: This is a method that can and should be abstracted down but was made early. There is no need to do this but
-          if ever continuing in the future, it would be nice to do.
+
+def send_catalog_changes(connection_socket, cursor: tuple[int, int], full: bool, added: list, removed: list[tuple]):
+    """
+    The answer to RequestFilesSince and RequestSyncFilesSince
     :param connection_socket:
-    :param user:
-    :param request_type:
+    :param cursor: the version the client is at after applying the changes
+    :param full: whether added is the whole catalog
+    :param added: the entries added or replaced
+    :param removed: the keys of the entries removed
     :return:
     """
-    request_type_bytes: bytes = request_type.name.encode('utf-8').ljust(C_REQUEST_BYTE_LENGTH, b'\x00')
+    send_payload(connection_socket, encode_catalog_cursor(cursor, full))
+    send_payload(connection_socket,
+                 CP.compress_payload(connection_socket, encode_object_list(added, connection_codec(connection_socket))))
+    send_payload(connection_socket, encode_catalog_keys(removed))
 
-    connection_socket.sendall(request_type_bytes)
 
-    receive_Ok(connection_socket)
+def request_catalog_changes(server_address: tuple[str, int], request_type, object_class,
+                            cursor: tuple[int, int], timeout: float | None) -> tuple:
+    """
+    Asks the peer at server_address what changed in its catalog since cursor
+    :param server_address:
+    :param request_type: RequestFilesSince or RequestSyncFilesSince
+    :param object_class: File or SyncFile
+    :param cursor: the (epoch, version) the last answer of this peer ended at, (0, 0) for none
+    :param timeout:
+    :return: (the new cursor, whether added is the whole catalog, the entries added, the keys of the entries removed)
+    """
+    with open_peer_stream(server_address, timeout) as user_socket, MT.measure(MT.CLIENT, request_type, user_socket):
+        send_request(user_socket, request_type)
+
+        receive_Ok(user_socket)
+
+        send_payload(user_socket, encode_catalog_cursor(cursor))
+
+        new_cursor, full = decode_catalog_cursor(receive_payload(user_socket))
+        added: list = decode_object_list(receive_payload(user_socket), object_class)
+        removed: list[tuple] = decode_catalog_keys(receive_payload(user_socket))
+
+    return new_cursor, full, added, removed
 
-    json_user: str = json.dumps(user.__dict__())
-    bytes_user: bytes = json_user.encode('utf-8')
 
-    # Send the data length to socket using big endian
-    data_length: int = len(bytes_user)
-    connection_socket.sendall(data_length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+def request_catalog(server_address: tuple[str, int], request_type, object_class, timeout: float | None) -> list:
+    """
+    Asks the peer at server_address for its whole catalog
+    :param server_address:
+    :param request_type: RequestFiles or RequestSyncFiles
+    :param object_class: File or SyncFile
+    :param timeout:
+    :return:
+    """
+    with open_peer_stream(server_address, timeout) as user_socket, MT.measure(MT.CLIENT, request_type, user_socket):
+        send_request(user_socket, request_type)
+
+        receive_Ok(user_socket)
+
+        return decode_object_list(receive_payload(user_socket), object_class)
+
+
+def refresh_catalog(server_address: tuple[str, int], object_class, catalog: Catalog, lock: threading.Lock,
+                    timeout: float | None):
+    """
+    Brings catalog up to date with the catalog of the peer at server_address. Only the changes since the last refresh
+    from that peer are sent, the first refresh (or one after the peer restarted) gets everything.
+
+    Removed entries are only taken out of catalog when the peer owns them, a file another peer owns is only gone once
+    its owner says so. When the peer sends its whole catalog instead of the changes (it can't tell what changed since
+    the last refresh), the entries it owns that aren't in it were removed in between. SyncFiles have no owner and are
+    never taken out
+    :param server_address:
+    :param object_class: File or SyncFile
+    :param catalog: the available files or sync files, which is modified
+    :param lock: the lock of catalog
+    :param timeout:
+    :return:
+    """
+    server_address = tuple(server_address)
+    if object_class is File:
+        since_request, full_request, merge = CRequest.RequestFilesSince, CRequest.RequestFiles, merge_files
+    else:
+        since_request, full_request, merge = CRequest.RequestSyncFilesSince, CRequest.RequestSyncFiles, merge_sync_files
+
+    cursor_key: tuple[tuple[str, int], str] = (server_address, since_request.name)
+    cursor: tuple[int, int] = CATALOG_CURSORS.get(cursor_key, (0, 0))
 
-    # Send the actual data of the user
-    connection_socket.sendall(bytes_user)
+    try:
+        cursor, full, added, removed = request_catalog_changes(server_address, since_request, object_class, cursor,
+                                                               timeout)
+    except ServerBusyError:
+        raise
+    except ValueError:
+        # Peers from before since_request don't answer it
+        cursor, full, removed = None, True, []
+        added = request_catalog(server_address, full_request, object_class, timeout)
+
+    with lock:
+        if full:
+            sent_keys: set[tuple] = {Catalog.key(entry) for entry in added}
+            removed = [key for key in catalog.keys_owned_by(server_address) if key not in sent_keys]
+        for key in removed:
+            if key[1] == server_address:
+                catalog.discard_key(key)
+        if added:
+            # The peer sends entries that were replaced as well as added, its copy is the newer one
+            merge(added, catalog, replace=True)
+
+    if cursor is not None:
+        CATALOG_CURSORS[cursor_key] = cursor
+
+
+def is_partial_download(filename: str) -> bool:
+    """
+    Unfinished downloads and their records live next to the real files but should never be shared
+    :param filename:
+    :return:
+    """
+    filename = filename.rstrip('~')
+    return filename.endswith(PARTIAL_FILE_SUFFIX) or filename.endswith(PARTIAL_STATE_SUFFIX)
 
 
 def list_files_in_directory(directory_path):
@@ -203,166 +568,379 @@ def list_files_in_directory(directory_path):
     """
     try:
         # files = [f for f in os.listdir(directory_path) if os.path.isfile(os.path.join(directory_path, f))]
-        files = [f.name for f in directory_path.iterdir() if f.is_file()]
+        files = [f.name for f in directory_path.iterdir() if f.is_file() and not is_partial_download(f.name)]
         return files
     except FileNotFoundError:
         print("File not found")
 
 
-def receive_files(connection_socket, file_list):
-    length_bytes: bytes = connection_socket.recv(FIXED_LENGTH_HEADER)
-
-    received_data = receive_data(connection_socket, length_bytes)
+def record_received_sync_file(filename: str, content_hash: str):
+    """
+    Called when a SyncFile was written with another user's copy
+    :param filename:
+    :param content_hash: the hash of the new copy, like get_sync_file_hash
+    :return:
+    """
+    with RECEIVED_SYNC_FILE_LOCK:
+        RECEIVED_SYNC_FILE_HASHES[filename] = content_hash
 
-    json_file_list: str = received_data.decode('utf-8')
-    if not json_file_list or json_file_list == '[]':
-        return
 
-    dict_file_list = json.loads(json_file_list)
-    client_file_list = [File.from_dict(file_dict) for file_dict in dict_file_list]
+def take_received_sync_file_hash(filename: str) -> str | None:
+    """
+    :param filename:
+    :return: the hash of the copy received since the last call for filename, None if nothing was received
+    """
+    with RECEIVED_SYNC_FILE_LOCK:
+        return RECEIVED_SYNC_FILE_HASHES.pop(filename, None)
 
-    file_directory_path: Path = Path.cwd() / 'Files'
-    current_files: list[str] = list_files_in_directory(file_directory_path)
 
+def local_file_names(directory_path: Path) -> frozenset[str]:
     """
-    This makes a new list that...
-    1. The file is NOT in the current available files for download (sync_file_list)
-    2. AND the file is NOT already downloaded (not in current_files)
+    The names list_files_in_directory would return, as a set. The listing is only read again when the directory's
+    modification time changes (which happens whenever a file is added, removed or renamed in it), so merging the
+    lists peers send doesn't list the directory every time
+    :param directory_path:
+    :return:
     """
+    try:
+        modified: int = os.stat(directory_path).st_mtime_ns
+    except FileNotFoundError:
+        print("File not found")
+        return frozenset()
 
-    new_files = [
-        f for f in client_file_list
-        if not any(sf.filename == f.filename for sf in file_list)
-        and f.filename not in current_files
-    ]
+    with DIRECTORY_LISTING_LOCK:
+        cached: tuple[int, frozenset[str]] | None = DIRECTORY_LISTINGS.get(directory_path)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
 
-    file_list.extend(new_files)
+    names: frozenset[str] = frozenset(list_files_in_directory(directory_path) or ())
+    with DIRECTORY_LISTING_LOCK:
+        DIRECTORY_LISTINGS[directory_path] = (modified, names)
+    return names
 
 
-def receive_sync_files(connection_socket, sync_file_list):
+def receive_files(connection_socket, file_catalog, lock: threading.Lock):
     """
-    THis receives a LIST of sync files
+    Receives a list of files and merges it in to file_catalog. The lock is only taken once the list has arrived
     :param connection_socket:
-    :param sync_file_list:
+    :param file_catalog:
+    :param lock: the lock of file_catalog
     :return:
     """
-    length_bytes: bytes = connection_socket.recv(FIXED_LENGTH_HEADER)
+    client_file_list = decode_object_list(receive_payload(connection_socket), File)
+    if not client_file_list:
+        return
 
-    received_data = receive_data(connection_socket, length_bytes)
+    with lock:
+        merge_files(client_file_list, file_catalog)
 
-    json_sync_file_list: str = received_data.decode('utf-8')
-    if not json_sync_file_list or json_sync_file_list == '[]':
+
+def merge_files(client_file_list, file_catalog: Catalog, replace: bool = False):
+    """
+    Adds the files another peer has sent to the catalog of files available for download, unless this user already
+    has a file with that name. The same file from different owners is kept so it can be swarm downloaded from all of
+    them
+    :param client_file_list: the files that were received
+    :param file_catalog: the available files, which is modified
+    :param replace: also replace the files already in the catalog that have changed (see Catalog.merge)
+    :return:
+    """
+    file_catalog.merge(client_file_list, skip_filenames=local_file_names(FILES_DIRECTORY), replace=replace)
+
+
+def receive_sync_files(connection_socket, sync_file_catalog, lock: threading.Lock):
+    """
+    THis receives a LIST of sync files. The lock is only taken once the list has arrived
+    :param connection_socket:
+    :param sync_file_catalog:
+    :param lock: the lock of sync_file_catalog
+    :return:
+    """
+    client_sync_file_list = decode_object_list(receive_payload(connection_socket), SyncFile)
+    if not client_sync_file_list:
         print("An empty list of sync files were sent")
         return
 
-    dict_sync_file_list = json.loads(json_sync_file_list)
-    client_sync_file_list = [SyncFile.from_dict(sync_file) for sync_file in dict_sync_file_list]
+    with lock:
+        merge_sync_files(client_sync_file_list, sync_file_catalog)
+
+
+def merge_sync_files(client_sync_file_list, sync_file_catalog: Catalog, replace: bool = False):
+    """
+    Adds the sync files another peer has sent to the catalog of sync files available for subscription, unless it is
+    already there or this user is subscribed to it
+    :param client_sync_file_list: the sync files that were received
+    :param sync_file_catalog: the available sync files, which is modified
+    :param replace: also replace the sync files already in the catalog whose subscribers have changed (see
+                    Catalog.merge)
+    :return:
+    """
+    sync_file_catalog.merge(client_sync_file_list, skip_filenames=local_file_names(SYNC_FILES_DIRECTORY),
+                            replace=replace)
+
+
+@TR.traced('download_file', lambda file, server_address: {'peer': server_address[0], 'filename': file.filename},
+           request=True)
+def download_file(file, server_address: tuple[str, int]) -> bool:
+    """
+    Downloads the file in to Files/<filename>.part and renames it once it is complete. If the transfer times out or
+    the connection drops, it is resumed from the last piece written (up to DOWNLOAD_RETRY_ATTEMPTS times). Whatever
+    was downloaded is kept, so selecting the file again later continues where it stopped, as long as the peer's copy
+    hasn't changed since (which is checked against the hash the peer sent with DownloadFileChunks).
+    :param file:
+    :param server_address:
+    :return: True if the whole file was downloaded
+    """
+    partial: PartialDownload = PartialDownload(file.filename, FILES_DIRECTORY)
+
+    if download_file_chunks(file, server_address, partial):
+        return True
+
+    attempt: int = 0
+    while attempt < DOWNLOAD_RETRY_ATTEMPTS:
+        attempt += 1
+        offset: int = partial.resume_offset()
+        received_size: int = 0
+
+        user_socket: socket.socket = MeteredSocket(socket.AF_INET, socket.SOCK_STREAM)
+        with user_socket, MT.measure(MT.CLIENT, CRequest.DownloadFileRange, user_socket) as measurement:
+            try:
+                user_socket.settimeout(DOWNLOAD_FOLDER_TIMEOUT)
+                user_socket.connect(server_address)
+
+                file_length, range_length = request_file_range(user_socket, file, offset, RANGE_TO_END)
 
-    sync_file_directory_path: Path = Path.cwd() / 'SyncFiles'
-    current_files: list[str] = list_files_in_directory(sync_file_directory_path)
+                if not partial.resume_or_start(file_length) and offset:
+                    # The file is new or has changed since the last attempt, so the old pieces are useless
+                    attempt -= 1
+                    continue
 
-    new_files = [
-        f for f in client_sync_file_list
-        if not any(sf.filename == f.filename for sf in sync_file_list)
-        and f.filename not in current_files
-    ]
+                with open(partial.part_path, 'r+b') as f:
+                    f.seek(offset)
+                    while received_size < range_length:
+                        data = user_socket.recv(min(BUFFER_SIZE, range_length - received_size))
+                        if not data:
+                            break
+                        f.write(data)
+                        received_size += len(data)
 
-    sync_file_list.extend(new_files)
+                if received_size < range_length:
+                    measurement['outcome'] = MT.ERROR
 
+            except TimeoutError as e:
+                measurement['outcome'] = MT.TIMEOUT
+                print(e)
+                print(f"The file download was not able to go through in the specified time: "
+                      f"{DOWNLOAD_FOLDER_TIMEOUT} seconds")
+            except ServerBusyError:
+                measurement['outcome'] = MT.BUSY
+                print(f"{server_address} is busy, asking again in {SERVER_BUSY_RETRY_DELAY} seconds")
+                time.sleep(SERVER_BUSY_RETRY_DELAY)
+            except (ConnectionError, ValueError) as e:
+                measurement['outcome'] = MT.ERROR
+                print(f"[Error] Download of {file.filename} was interrupted: {e}")
+            finally:
+                if partial.file_size is not None:
+                    partial.mark_range(offset, received_size)
+                    partial.save()
+
+        if partial.is_complete():
+            with TR.span('hash', filename=file.filename):
+                is_same_copy: bool = partial.matches_hash()
+            if is_same_copy:
+                partial.finish()
+                return True
+
+            # The peer's copy changed while it was being downloaded
+            print(f"[Error] The downloaded copy of {file.filename} does not match the peer's copy, starting over")
+            partial.start(partial.file_size)
+            continue
+
+        if partial.file_size is not None:
+            print(f"Resuming {file.filename} from byte {partial.resume_offset()} of {partial.file_size}")
+
+    print(f"{file.filename} is incomplete, select it again to resume the download")
+    return False
+
+
+def download_file_chunks(file, server_address: tuple[str, int], partial: PartialDownload) -> bool:
+    """
+    Downloads the file with DownloadFileChunks, so only the chunks that aren't in any local file are sent. The file is
+    put together in the same .part file as download_file, and every piece completed is recorded along with the hash of
+    the peer's copy, so when this fails download_file carries on from there
+    :param file:
+    :param server_address:
+    :param partial: the .part file of the download, shared with download_file
+    :return: True if the whole file was downloaded, False if download_file should be used
+    """
+    written: list[tuple[int, int]] = []
 
-def download_file(file, server_address: tuple[str, int]):
-    user_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    with user_socket:
+    user_socket: socket.socket = MeteredSocket(socket.AF_INET, socket.SOCK_STREAM)
+    with user_socket, MT.measure(MT.CLIENT, CRequest.DownloadFileChunks, user_socket) as measurement:
         try:
             user_socket.settimeout(DOWNLOAD_FOLDER_TIMEOUT)
             user_socket.connect(server_address)
 
-            # Send a request to download file from server
-            send_request(user_socket, CRequest.DownloadFile)
-
-            receive_Ok(user_socket)
+            send_request(user_socket, CRequest.DownloadFileChunks)
+            try:
+                receive_Ok(user_socket)
+            except ValueError as e:
+                # Peers from before DownloadFileChunks don't answer it, busy peers are left to download_file
+                measurement['outcome'] = MT.BUSY if isinstance(e, ServerBusyError) else MT.ERROR
+                return False
 
-            # Send file object to server so server knows what the name of it is
             send_file(user_socket, file)
 
-            # [DEBUG] Receive ok is working
             receive_Ok(user_socket)
 
-            length_bytes: bytes = user_socket.recv(FIXED_LENGTH_HEADER)
+            file_size, file_hash, chunks = CH.receive_recipe(user_socket)
 
-            file_length: int = int.from_bytes(length_bytes, 'big')
-
-            file_path: Path = Path.cwd() / "Files" / file.filename
+            CHUNK_INDEX.refresh()
+            partial.resume_or_start(file_size, file_hash)
 
-            received_size: int = 0
-            with open(file_path, 'wb') as f:
-                while received_size < file_length:
-                    data = user_socket.recv(BUFFER_SIZE)
-                    if not data:
-                        break
-                    f.write(data)
-                    received_size += len(data)
+            with open(partial.part_path, 'r+b') as f:
+                CH.receive_chunks(user_socket, f, chunks, is_present=partial.has_range,
+                                  on_written=lambda offset, length: written.append((offset, length)))
 
         except TimeoutError as e:
+            measurement['outcome'] = MT.TIMEOUT
             print(e)
             print(f"The file download was not able to go through in the specified time: "
                   f"{DOWNLOAD_FOLDER_TIMEOUT} seconds")
+            return False
+        except (OSError, ValueError) as e:
+            measurement['outcome'] = MT.ERROR
+            print(f"[Error] Download of {file.filename} was interrupted: {e}")
+            return False
+        finally:
+            if partial.file_size is not None:
+                partial.mark_ranges(written)
+                partial.save()
+
+    if not partial.is_complete():
+        return False
+
+    with TR.span('hash', filename=file.filename):
+        received_hash, stat_result = HashCache.read_digest(partial.part_path)
+    if received_hash != file_hash:
+        # The peer's copy changed while it was being downloaded
+        print(f"[Error] The downloaded copy of {file.filename} does not match the peer's copy, starting over")
+        partial.start(file_size, file_hash)
+        return False
+
+    partial.finish()
+    CHUNK_INDEX.add(partial.file_path, stat_result, file_size, file_hash, chunks)
+    return True
+
+
+def send_file_contents(connection_socket: socket, file_path: Path, count: int, offset: int = 0) -> None:
+    """
+    Sends count bytes of the file at file_path, starting at offset, through the socket. Like every file sent from a
+    DiskStorage, regular files are handed to the kernel with socket.sendfile when the connection is a socket of its
+    own, and read and sent a piece at a time otherwise
+    :param connection_socket:
+    :param file_path:
+    :param count: the amount of bytes the receiver was told to expect
+    :param offset: where in the file to start reading from
+    :return:
+    """
+    DiskStorage(file_path.parent).send_range(connection_socket, file_path.name, offset, count)
 
 
 def send_full_file(connection_socket: socket, file):
-    file_path: Path = Path.cwd() / "Files" / file.filename
-
     # Get the size of the file
-    file_size: int = os.stat(str(file_path)).st_size
+    file_size: int = FILE_STORAGE.size(file.filename)
 
     connection_socket.sendall(file_size.to_bytes(FIXED_LENGTH_HEADER, 'big'))
 
-    with open(file_path, 'rb') as f:
-        while True:
-            data = f.read(BUFFER_SIZE)
-            if not data:
-                break
-            connection_socket.sendall(data)
+    CP.send_file_stream(connection_socket, FILE_STORAGE, file.filename, file_size)
+
+
+def send_file_range(connection_socket: socket, file, offset: int, length: int):
+    """
+    Serves one piece of a file for a DownloadFileRange request. The total size of the file is sent first so the
+    client can work out how many pieces the file has, followed by the length of the piece actually being sent
+    (the requested range is clamped to the end of the file) and then the piece itself.
+    :param connection_socket:
+    :param file:
+    :param offset:
+    :param length:
+    :return:
+    """
+    file_size: int = FILE_STORAGE.size(file.filename)
+    offset = min(offset, file_size)
+    length = min(length, file_size - offset)
+
+    connection_socket.sendall(file_size.to_bytes(FIXED_LENGTH_HEADER, 'big')
+                              + length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+
+    FILE_STORAGE.send_range(connection_socket, file.filename, offset, length)
+
+
+def request_file_range(connection_socket: socket.socket, file, offset: int, length: int) -> tuple[int, int]:
+    """
+    Sends a DownloadFileRange request on an already connected socket. The caller is expected to read the piece from
+    the socket afterward.
+    :param connection_socket:
+    :param file:
+    :param offset:
+    :param length:
+    :return: (size of the whole file, length of the piece that follows)
+    """
+    send_request(connection_socket, CRequest.DownloadFileRange)
+
+    receive_Ok(connection_socket)
+
+    send_file(connection_socket, file)
+
+    connection_socket.sendall(offset.to_bytes(FIXED_LENGTH_HEADER, 'big')
+                              + length.to_bytes(FIXED_LENGTH_HEADER, 'big'))
+
+    receive_Ok(connection_socket)
+
+    file_size: int = int.from_bytes(connection_socket.recv(FIXED_LENGTH_HEADER), 'big')
+    range_length: int = int.from_bytes(connection_socket.recv(FIXED_LENGTH_HEADER), 'big')
+
+    return file_size, range_length
 
 
 def send_full_sync_file(connection_socket: socket, sync_file):
     """
-    This functions sends a sync function to a client
+    This functions sends a sync function to a client, compressed if the client agreed on it
     :param connection_socket:
     :param sync_file:
     :return:
     """
-    file_path: Path = Path.cwd() / "SyncFiles" / sync_file.filename
-
-    file_size: int = os.stat(str(file_path)).st_size
+    file_size: int = SYNC_FILE_STORAGE.size(sync_file.filename)
 
     connection_socket.sendall(file_size.to_bytes(FIXED_LENGTH_HEADER, 'big'))
 
-    with open(file_path, 'rb') as f:
-        while True:
-            data = f.read(BUFFER_SIZE)
-            if not data:
-                break
-            connection_socket.sendall(data)
+    CP.send_file_stream(connection_socket, SYNC_FILE_STORAGE, sync_file.filename, file_size)
 
 
+@TR.traced('subscribe_to_file',
+           lambda sync_file, user_as_peer, server_address: {'peer': server_address[0], 'filename': sync_file.filename},
+           request=True)
 def subscribe_to_file(sync_file, user_as_peer, server_address: tuple[str, int]):
     """
     This method:
     1. Sends the user to be added to subscription
     2. Sends the wanted file
     3. Receives the wanted file
+    The file's lock is held throughout, so an update the server sends once this user is subscribed waits for the copy
+    being received to be in place
     :param sync_file:
     :param user_as_peer:
     :param server_address:
     :return:
     """
-    user_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    with user_socket:
-        try:
-            user_socket.settimeout(DOWNLOAD_FOLDER_TIMEOUT)
-            user_socket.connect(server_address)
-
+    try:
+        # Files that may be sent compressed go over the persistent connection, which agreed on the compression, the
+        # rest over a connection of their own so the server can send them with sendfile
+        open_connection = open_peer_socket if CP.is_compressed_file(sync_file.filename) else open_peer_stream
+        with SYNC_FILE_LOCKS.lock(sync_file.filename), \
+                open_connection(server_address, DOWNLOAD_FOLDER_TIMEOUT) as user_socket, \
+                MT.measure(MT.CLIENT, CRequest.SubscribeFile, user_socket):
             send_request(user_socket, CRequest.SubscribeFile)
 
             receive_Ok(user_socket)
@@ -379,43 +957,39 @@ def subscribe_to_file(sync_file, user_as_peer, server_address: tuple[str, int]):
 
             file_length: int = int.from_bytes(length_bytes, 'big')
 
-            file_path: Path = Path.cwd() / "SyncFiles" / sync_file.filename
-
-            received_size: int = 0
-            with open(file_path, 'wb') as f:
-                while received_size < file_length:
-                    data = user_socket.recv(BUFFER_SIZE)
-                    if not data:
-                        break
+            hasher = SYNC_FILE_HASHES.new_hasher()
+            with SYNC_FILE_STORAGE.open_write(sync_file.filename) as f:
+                for data in CP.receive_file_stream(user_socket, file_length):
                     f.write(data)
-                    received_size += len(data)
-
-        except TimeoutError as e:
-            print(e)
-            print(f"The file download was not able to go through in the specified time: "
-                  f"{DOWNLOAD_FOLDER_TIMEOUT} seconds")
-
-
-def download_sync_file(connection_socket, sync_file):
-    length_bytes: bytes = connection_socket.recv(FIXED_LENGTH_HEADER)
-
-    file_length: int = int.from_bytes(length_bytes, 'big')
-
-    file_path: Path = Path.cwd() / "SyncFiles" / sync_file.filename
-
-    received_size: int = 0
-    with open(file_path, 'wb') as f:
-        while received_size < file_length:
-            data = connection_socket.recv(BUFFER_SIZE)
-            if not data:
-                break
-            f.write(data)
-            received_size += len(data)
-
-
+                    hasher.update(data)
+
+                # Before the new copy replaces the old one, so whoever watches the folder knows it came from another
+                # user. Renaming keeps the file's inode, size and modification time, so the stat still holds after
+                file_path: Path | None = SYNC_FILE_STORAGE.path(sync_file.filename)
+                if file_path is not None:
+                    f.flush()
+                    SYNC_FILE_HASHES.put(file_path, os.fstat(f.fileno()), hasher.hexdigest())
+                record_received_sync_file(sync_file.filename, hasher.hexdigest())
+
+    except TimeoutError as e:
+        print(e)
+        print(f"The file download was not able to go through in the specified time: "
+              f"{DOWNLOAD_FOLDER_TIMEOUT} seconds")
+    except ServerBusyError:
+        raise
+    except (ConnectionError, ValueError) as e:
+        print(f"[Error] Download of {sync_file.filename} was interrupted: {e}")
+
+
+@TR.traced('send_sync_file_update',
+           lambda sync_file, users_to_send_update: {'filename': sync_file.filename,
+                                                    'subscribers': len(users_to_send_update)},
+           request=True)
 def send_sync_file_update(sync_file, users_to_send_update: list):
     """
-    This method is called whenever a user saves their changes to a syncFile
+    Sends the update of a SyncFile to every subscriber at the same time and waits for them (see
+    send_sync_file_update_to), holding the file's lock for all of them. Saves of the user go through SYNC_UPDATE_QUEUE
+    instead, which doesn't wait
     :param sync_file:
     :param users_to_send_update:
     :return:
@@ -424,24 +998,83 @@ def send_sync_file_update(sync_file, users_to_send_update: list):
         print("There are no users to send this update to")
         return
 
-    for user in users_to_send_update:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as user_socket:
-            try:
-                user_socket.settimeout(15)
-                user_socket.connect(user.addr)
+    # The deadline allows for large files, a subscriber that stops answering still fails after 15 seconds
+    with SYNC_FILE_LOCKS.lock(sync_file.filename):
+        results: dict[tuple[str, int], object] = FO.fan_out(users_to_send_update,
+                                                            lambda user: send_sync_file_update_to(sync_file, user),
+                                                            DOWNLOAD_FOLDER_TIMEOUT)
+    if FO.report_failures(results, "send the update of " + sync_file.filename + " to"):
+        print("File Sync could not go through")
 
-                send_request(user_socket, CRequest.SyncFileUpdate)
 
-                receive_Ok(user_socket)
+def send_queued_sync_file_update(sync_file, user):
+    """
+    Sends one update from SYNC_UPDATE_QUEUE. The subscribers of a file are sent its updates one at a time, updates of
+    other files aren't held up
+    :param sync_file:
+    :param user: the subscriber
+    :return:
+    """
+    with SYNC_FILE_LOCKS.lock(sync_file.filename):
+        send_sync_file_update_to(sync_file, user)
 
-                send_sync_file(user_socket, sync_file)
 
-                receive_Ok(user_socket)
+@TR.traced('sync_file_update', lambda sync_file, user: {'filename': sync_file.filename, 'peer': user.addr[0]})
+def send_sync_file_update_to(sync_file, user):
+    """
+    This method is called whenever a user saves their changes to a syncFile. The subscriber is sent the chunk list of
+    the new copy and only the chunks it can't find in any of its files are sent. Subscribers that don't know
+    SyncFileUpdateChunks send the signatures of their current copy instead and only the parts of the file they don't
+    have are sent back. The file is read as it is when the update is sent, the caller holds the file's lock
+    (SYNC_FILE_LOCKS) so a copy received from another user can't replace it part way through
+    :param sync_file:
+    :param user: the subscriber
+    :return:
+    """
+    file_path: Path = SYNC_FILES_DIRECTORY / sync_file.filename
 
-                send_full_sync_file(user_socket, sync_file)
+    def send_update_chunks() -> bool:
+        # The chunks are sent as they are, on a connection of their own they are sent with sendfile
+        with open_peer_socket(user.addr, 15) as user_socket, \
+                MT.measure(MT.CLIENT, CRequest.SyncFileUpdateChunks, user_socket):
+            send_request(user_socket, CRequest.SyncFileUpdateChunks)
 
+            try:
                 receive_Ok(user_socket)
+            except ServerBusyError:
+                raise
+            except ValueError:
+                # Peers from before SyncFileUpdateChunks don't answer it
+                return False
 
+            send_sync_file(user_socket, sync_file)
 
-            except TimeoutError as e:
-                print("File Sync could not go through")
+            receive_Ok(user_socket)
+
+            CH.send_chunks(user_socket, file_path)
+
+            receive_Ok(user_socket)
+            return True
+
+    def send_update():
+        if send_update_chunks():
+            return
+
+        with open_peer_stream(user.addr, 15) as user_socket, \
+                MT.measure(MT.CLIENT, CRequest.SyncFileUpdate, user_socket):
+            send_request(user_socket, CRequest.SyncFileUpdate)
+
+            receive_Ok(user_socket)
+
+            send_sync_file(user_socket, sync_file)
+
+            receive_Ok(user_socket)
+
+            block_size, signature_table = DF.receive_signatures(user_socket)
+
+            DF.send_delta(user_socket, file_path, block_size, signature_table)
+
+            receive_Ok(user_socket)
+
+    with UPLOAD_SCHEDULER.transfer(user.addr[0], UploadScheduler.SYNC):
+        send_update()
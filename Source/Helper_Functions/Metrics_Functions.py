@@ -0,0 +1,263 @@
+"""
+Counts what every request this peer serves or makes does: how many there are per CRequest and how they end (ok, busy,
+timeout or error), how many bytes they receive and send, and how long they take (see RequestMetrics).
+
+Server.client_request (and the AsyncServer's) measures every request it serves, and every client call in
+File_Functions measures the request it makes. Both use measure, which reads the byte counters every kind of connection
+keeps (MeteredSocket, MuxStream, AsyncChannel and AsyncMuxStream).
+
+The locks of the shared lists are MeteredLocks made by metered_lock, so how long requests wait for them and hold them
+is reported with the requests, as are the per-file SyncFile locks (File_Functions.SYNC_FILE_LOCKS), added up.
+
+Other peers ask for the numbers with a Stats request. They are also served as text on a local port (see
+start_metrics_endpoint) in the Prometheus text format, one line per number, so they can be read with curl or scraped.
+The same port serves the spans and profiles of Tracing_Functions.
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Classes.CRequest import CRequest
+# noinspection PyUnresolvedReferences
+from Classes.MeteredLock import MeteredLock
+# noinspection PyUnresolvedReferences
+from Classes.RequestMetrics import RequestMetrics
+# noinspection PyUnresolvedReferences
+from Classes.ServerBusyError import ServerBusyError
+
+# noinspection PyUnresolvedReferences
+from Constants import METRICS_LATENCY_BUCKETS
+
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Compression_Functions as CP
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Tracing_Functions as TR
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+SERVER: str = 'server'
+CLIENT: str = 'client'
+
+OK: str = 'ok'
+BUSY: str = 'busy'
+TIMEOUT: str = 'timeout'
+ERROR: str = 'error'
+
+# (side, CRequest name) -> what happened to those requests
+REQUEST_METRICS: dict[tuple[str, str], RequestMetrics] = {}
+REQUEST_METRICS_LOCK: threading.Lock = threading.Lock()
+
+# name -> the lock, every lock made by metered_lock
+LOCKS: dict[str, MeteredLock] = {}
+
+STARTED_AT: float = time.monotonic()
+
+
+def request_name(request_type) -> str:
+    """
+    :param request_type: a CRequest or its name
+    :return: the name, 'unknown' for names that aren't a CRequest, so clients can't make up new ones to count
+    """
+    name: str = getattr(request_type, 'name', request_type)
+    return name if name in CRequest.__members__ else 'unknown'
+
+
+def record_request(side: str, request_type, seconds: float, bytes_received: int, bytes_sent: int, outcome: str):
+    key: tuple[str, str] = (side, request_name(request_type))
+    with REQUEST_METRICS_LOCK:
+        metrics: RequestMetrics | None = REQUEST_METRICS.get(key)
+        if metrics is None:
+            metrics = REQUEST_METRICS[key] = RequestMetrics()
+        metrics.record(seconds, bytes_received, bytes_sent, outcome)
+
+
+@contextmanager
+def measure(side: str, request_type, connection_socket):
+    """
+    Records the request made or served in the block, which ends as a timeout or an error if the block raises one
+    (ServerBusyError counts as busy). The outcome can be set on what is yielded, for requests turned away without
+    raising. While tracing is on the request is also a span (see Tracing_Functions)
+    :param side: SERVER or CLIENT
+    :param request_type: a CRequest or its name
+    :param connection_socket: the connection the request is on
+    :return: yields {'outcome': None}
+    """
+    measurement: dict[str, str | None] = {'outcome': None}
+    received_before, sent_before = TR.connection_bytes(connection_socket)
+    start: float = time.perf_counter()
+    name: str = request_name(request_type)
+    try:
+        # A Multiplex request lasts as long as its connection, the requests sent over it are profiled on their own
+        with TR.span(f"{side} {name}", connection_socket, request=name != CRequest.Multiplex.name) as request_span:
+            if request_span is not None:
+                request_span['peer'] = FF.connection_peer_host(connection_socket)
+            yield measurement
+    except ServerBusyError:
+        measurement['outcome'] = BUSY
+        raise
+    except TimeoutError:
+        measurement['outcome'] = TIMEOUT
+        raise
+    except Exception:
+        measurement['outcome'] = ERROR
+        raise
+    finally:
+        received_after, sent_after = TR.connection_bytes(connection_socket)
+        record_request(side, request_type, time.perf_counter() - start, received_after - received_before,
+                       sent_after - sent_before, measurement['outcome'] or OK)
+
+
+def metered_lock(name: str) -> MeteredLock:
+    """
+    :param name: what the lock guards, the name it is reported under
+    :return: a new lock whose wait and hold times are part of node_stats
+    """
+    lock: MeteredLock = MeteredLock(name)
+    LOCKS[name] = lock
+    return lock
+
+
+def lock_stats() -> dict[str, dict]:
+    """
+    :return: lock name -> MeteredLock.to_dict(), with the per-file SyncFile locks added up under their own name
+    """
+    locks: dict = dict(LOCKS)
+    locks[FF.SYNC_FILE_LOCKS.name] = FF.SYNC_FILE_LOCKS
+    return {name: lock.to_dict() for name, lock in sorted(locks.items())}
+
+
+def request_stats() -> dict[str, dict[str, dict]]:
+    """
+    :return: side -> CRequest name -> RequestMetrics.to_dict()
+    """
+    with REQUEST_METRICS_LOCK:
+        stats: dict[str, dict[str, dict]] = {SERVER: {}, CLIENT: {}}
+        for (side, name), metrics in sorted(REQUEST_METRICS.items()):
+            stats[side][name] = metrics.to_dict()
+        return stats
+
+
+def node_stats() -> dict:
+    """
+    :return: everything this peer measures, the answer to a Stats request
+    """
+    return {'uptime_seconds': time.monotonic() - STARTED_AT,
+            'requests': request_stats(),
+            'locks': lock_stats(),
+            'compression': CP.transfer_stats(),
+            'upload_limits': FF.UPLOAD_SCHEDULER.limits(),
+            'sync_updates': FF.SYNC_UPDATE_QUEUE.stats()}
+
+
+def format_stats(stats: dict) -> str:
+    """
+    :param stats: from node_stats (of this peer or another)
+    :return: the Prometheus text format of stats
+    """
+    lines: list[str] = [f"p2p_uptime_seconds {stats['uptime_seconds']:.3f}"]
+
+    for side, requests in stats['requests'].items():
+        for name, metrics in requests.items():
+            labels: str = f'side="{side}",request="{name}"'
+            for outcome, count in sorted(metrics['outcomes'].items()):
+                lines.append(f'p2p_requests_total{{{labels},outcome="{outcome}"}} {count}')
+            lines.append(f"p2p_request_bytes_received_total{{{labels}}} {metrics['bytes_received']}")
+            lines.append(f"p2p_request_bytes_sent_total{{{labels}}} {metrics['bytes_sent']}")
+
+            cumulative: int = 0
+            for upper_bound, count in zip(METRICS_LATENCY_BUCKETS + ('+Inf',), metrics['buckets']):
+                cumulative += count
+                lines.append(f'p2p_request_seconds_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+            lines.append(f"p2p_request_seconds_sum{{{labels}}} {metrics['total_seconds']:.6f}")
+            lines.append(f"p2p_request_seconds_count{{{labels}}} {metrics['count']}")
+            for quantile in ('50', '90', '99'):
+                lines.append(f'p2p_request_seconds{{{labels},quantile="0.{quantile}"}} '
+                             f"{metrics[f'p{quantile}_seconds']:.6f}")
+
+    # Peers from before lock metrics don't send them
+    for name, metrics in stats.get('locks', {}).items():
+        labels = f'lock="{name}"'
+        lines.append(f"p2p_lock_acquisitions_total{{{labels}}} {metrics['acquisitions']}")
+        lines.append(f"p2p_lock_contended_total{{{labels}}} {metrics['contended']}")
+        lines.append(f"p2p_lock_wait_seconds_total{{{labels}}} {metrics['total_wait_seconds']:.6f}")
+        lines.append(f"p2p_lock_wait_seconds_max{{{labels}}} {metrics['max_wait_seconds']:.6f}")
+
+        cumulative = 0
+        for upper_bound, count in zip(METRICS_LATENCY_BUCKETS + ('+Inf',), metrics['hold_buckets']):
+            cumulative += count
+            lines.append(f'p2p_lock_hold_seconds_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+        lines.append(f"p2p_lock_hold_seconds_sum{{{labels}}} {metrics['total_hold_seconds']:.6f}")
+        lines.append(f"p2p_lock_hold_seconds_count{{{labels}}} {cumulative}")
+        lines.append(f"p2p_lock_hold_seconds_max{{{labels}}} {metrics['max_hold_seconds']:.6f}")
+
+    for algorithm, algorithm_stats in sorted(stats['compression'].items()):
+        labels = f'algorithm="{algorithm}"'
+        lines.append(f"p2p_compression_transfers_total{{{labels}}} {algorithm_stats['transfers']}")
+        lines.append(f"p2p_compression_bytes_total{{{labels}}} {algorithm_stats['bytes']}")
+        lines.append(f"p2p_compression_sent_bytes_total{{{labels}}} {algorithm_stats['sent_bytes']}")
+        lines.append(f"p2p_compression_cpu_seconds_total{{{labels}}} {algorithm_stats['cpu_seconds']:.6f}")
+
+    lines.append(f"p2p_upload_rate_limit_bytes {stats['upload_limits']['upload_rate']:g}")
+    lines.append(f"p2p_peer_upload_rate_limit_bytes {stats['upload_limits']['peer_upload_rate']:g}")
+
+    # Peers from before the update queue don't send it
+    if 'sync_updates' in stats:
+        sync_updates: dict = stats['sync_updates']
+        for peer, depth in sorted(sync_updates['queue_depth'].items()):
+            lines.append(f'p2p_sync_update_queue_depth{{peer="{peer}"}} {depth}')
+        lines.append(f"p2p_sync_updates_sending {sync_updates['sending']}")
+        for counter in ('sent', 'coalesced', 'retried', 'failed'):
+            lines.append(f"p2p_sync_updates_{counter}_total {sync_updates[counter]}")
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    /spans serves the spans traced so far (Chrome trace format), /profile the profile taken so far (folded stacks)
+    and any other path the metrics
+    """
+
+    def do_GET(self):
+        path: str = self.path.split('?', 1)[0]
+        if path == '/spans':
+            body: bytes = json.dumps(TR.chrome_trace()).encode('utf-8')
+            content_type: str = 'application/json'
+        elif path == '/profile':
+            body = TR.folded_stacks().encode('utf-8')
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            body = format_stats(node_stats()).encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Every scrape would be printed in the middle of the menu otherwise
+        pass
+
+
+def start_metrics_endpoint(port: int) -> ThreadingHTTPServer | None:
+    """
+    Serves format_stats(node_stats()), and the spans and profile while tracing, to HTTP GETs on port, on this machine
+    only (127.0.0.1)
+    :param port:
+    :return: the HTTP server, None if the port couldn't be used
+    """
+    try:
+        http_server: ThreadingHTTPServer = ThreadingHTTPServer(('127.0.0.1', port), MetricsRequestHandler)
+    except OSError as e:
+        print(f"[Error] The metrics could not be served on port {port}: {e}")
+        return None
+
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server
@@ -0,0 +1,321 @@
+"""
+Opt-in tracing of what a slow peer spends its time on. It is off unless G_TRACING is set or it is turned on with
+option 7, and while it is off a span costs a check of TRACING.
+
+While it is on, every request this peer serves or makes (see Metrics_Functions.measure) and the client calls users
+wait for (download_file, subscribe_to_file and send_sync_file_update) is a span: how long it took, the bytes it
+received and sent and the peer on the other end. Encoding and decoding payloads, hashing and chunking files and
+working out delta signatures are spans within them, so the time of a request that isn't in any of them was spent on
+the network and on disk.
+
+A sample of the requests (PROFILE_SAMPLE_RATE of them) is also run under cProfile. The profiles are added up and can
+be written out as folded stacks (one "caller;callee;... microseconds" line per call path), which flamegraph.pl and
+speedscope draw as a flame graph, and as a pstats file for snakeviz or pstats itself. The spans are written in the
+Chrome trace format, which chrome://tracing and ui.perfetto.dev show as a timeline. Both are written by option 7 and
+served by the metrics endpoint, so neither needs the peer to be restarted.
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Constants import (TRACE_MAX_SPANS,
+                       PROFILE_MIN_SECONDS)
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+import cProfile
+import itertools
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+TRACES_DIRECTORY: Path = Path.cwd() / "Traces"
+
+TRACING: bool = False
+PROFILE_SAMPLE_RATE: float = 0  # The share of requests profiled while tracing, from 0 to 1
+
+# The most recent finished spans, oldest first
+FINISHED_SPANS: deque[dict] = deque(maxlen=TRACE_MAX_SPANS)
+SPAN_IDS = itertools.count(1)
+# Guards the byte counts of spans, which the spans of fan_out threads add to
+TRACE_LOCK: threading.Lock = threading.Lock()
+
+CURRENT_SPAN: ContextVar[dict | None] = ContextVar('CURRENT_SPAN', default=None)
+
+# The profiles of every sampled request added up, None until one has been taken
+PROFILE: pstats.Stats | None = None
+PROFILED_REQUESTS: int = 0
+PROFILE_LOCK: threading.Lock = threading.Lock()
+# cProfile profiles the thread it is started on, and only one profiler can run on a thread at a time
+PROFILING: threading.local = threading.local()
+
+
+def configure(tracing: bool | None = None, profile_sample_rate: float | None = None):
+    """
+    Changes the settings, the ones left as None are kept
+    :param tracing: turns spans (and profiling) on or off
+    :param profile_sample_rate: the share of requests profiled, from 0 to 1
+    :return:
+    """
+    global TRACING, PROFILE_SAMPLE_RATE
+    if tracing is not None:
+        TRACING = tracing
+    if profile_sample_rate is not None:
+        PROFILE_SAMPLE_RATE = min(max(profile_sample_rate, 0.0), 1.0)
+
+
+def reset():
+    """
+    Forgets every span and profile taken so far
+    :return:
+    """
+    global PROFILE, PROFILED_REQUESTS
+    FINISHED_SPANS.clear()
+    with PROFILE_LOCK:
+        PROFILE = None
+        PROFILED_REQUESTS = 0
+
+
+def current_span() -> dict | None:
+    return CURRENT_SPAN.get()
+
+
+@contextmanager
+def continued(parent: dict | None):
+    """
+    Makes the spans opened in the block children of parent, for work handed to another thread
+    :param parent: from current_span on the thread that handed the work over
+    :return:
+    """
+    token = CURRENT_SPAN.set(parent)
+    try:
+        yield
+    finally:
+        CURRENT_SPAN.reset(token)
+
+
+@contextmanager
+def span(name: str, connection_socket=None, request: bool = False, **attributes):
+    """
+    Times the block as a span, a child of the span it is opened in. The bytes of a span are those received and sent on
+    connection_socket during the block, or without one, the bytes of its children
+    :param name:
+    :param connection_socket: the connection the block uses, if it uses one
+    :param request: the block is a whole request, one of the PROFILE_SAMPLE_RATE requests that are profiled
+    :param attributes: anything else worth knowing about the span (a filename, the peer, ...)
+    :return: yields the span (a dict that more attributes can be added to), None while tracing is off
+    """
+    if not TRACING:
+        yield None
+        return
+
+    parent: dict | None = CURRENT_SPAN.get()
+    new_span: dict = {'name': name,
+                      'id': next(SPAN_IDS),
+                      'parent': parent['id'] if parent else None,
+                      'thread': threading.get_ident(),
+                      'start': time.time(),
+                      'seconds': 0.0,
+                      'bytes_received': 0,
+                      'bytes_sent': 0,
+                      **attributes}
+    received_before, sent_before = connection_bytes(connection_socket)
+    profiler: cProfile.Profile | None = start_profiler() if request else None
+    if profiler:
+        new_span['profiled'] = True
+
+    token = CURRENT_SPAN.set(new_span)
+    start: float = time.perf_counter()
+    try:
+        yield new_span
+    except Exception as e:
+        new_span['error'] = repr(e)
+        raise
+    finally:
+        new_span['seconds'] = time.perf_counter() - start
+        CURRENT_SPAN.reset(token)
+        if profiler:
+            stop_profiler(profiler)
+
+        with TRACE_LOCK:
+            if connection_socket is not None:
+                received_after, sent_after = connection_bytes(connection_socket)
+                new_span['bytes_received'] += received_after - received_before
+                new_span['bytes_sent'] += sent_after - sent_before
+            if parent is not None and parent.get('sums_children', False):
+                parent['bytes_received'] += new_span['bytes_received']
+                parent['bytes_sent'] += new_span['bytes_sent']
+        FINISHED_SPANS.append(new_span)
+
+
+def traced(name: str, describe=None, request: bool = False):
+    """
+    Makes every call of the decorated function a span with no connection of its own, whose bytes are those of the
+    requests made in it
+    :param name:
+    :param describe: called with the arguments of the function, returns the attributes of the span
+    :param request: see span
+    :return:
+    """
+    def decorator(function):
+        @wraps(function)
+        def traced_function(*args, **kwargs):
+            if not TRACING:
+                return function(*args, **kwargs)
+
+            attributes: dict = describe(*args, **kwargs) if describe else {}
+            with span(name, request=request, sums_children=True, **attributes):
+                return function(*args, **kwargs)
+        return traced_function
+    return decorator
+
+
+def connection_bytes(connection_socket) -> tuple[int, int]:
+    """
+    :param connection_socket:
+    :return: (bytes received, bytes sent) on the connection so far, 0 for connections that don't count them
+    """
+    return getattr(connection_socket, 'bytes_received', 0), getattr(connection_socket, 'bytes_sent', 0)
+
+
+def start_profiler() -> cProfile.Profile | None:
+    """
+    :return: a running profiler for one of PROFILE_SAMPLE_RATE requests, None for the rest or if this thread is
+             already profiled
+    """
+    if not PROFILE_SAMPLE_RATE or random.random() >= PROFILE_SAMPLE_RATE or getattr(PROFILING, 'active', False):
+        return None
+
+    profiler: cProfile.Profile = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Newer Pythons allow one profiler in the whole program, another request is being profiled
+        return None
+    PROFILING.active = True
+    return profiler
+
+
+def stop_profiler(profiler: cProfile.Profile):
+    global PROFILE, PROFILED_REQUESTS
+    profiler.disable()
+    PROFILING.active = False
+
+    with PROFILE_LOCK:
+        if PROFILE is None:
+            PROFILE = pstats.Stats(profiler)
+        else:
+            PROFILE.add(profiler)
+        PROFILED_REQUESTS += 1
+
+
+def tracing_stats() -> dict:
+    """
+    :return: the settings and how much has been traced and profiled
+    """
+    return {'tracing': TRACING,
+            'profile_sample_rate': PROFILE_SAMPLE_RATE,
+            'spans': len(FINISHED_SPANS),
+            'profiled_requests': PROFILED_REQUESTS}
+
+
+def chrome_trace() -> dict:
+    """
+    :return: the finished spans in the Chrome trace format (complete events, microseconds)
+    """
+    events: list[dict] = []
+    for finished_span in list(FINISHED_SPANS):
+        arguments: dict = {key: value for key, value in finished_span.items()
+                           if key not in ('name', 'thread', 'start', 'seconds', 'sums_children')}
+        events.append({'name': finished_span['name'],
+                       'ph': 'X',
+                       'ts': int(finished_span['start'] * 1_000_000),
+                       'dur': int(finished_span['seconds'] * 1_000_000),
+                       'pid': os.getpid(),
+                       'tid': finished_span['thread'],
+                       'args': arguments})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def frame_label(function: tuple[str, int, str]) -> str:
+    filename, line, name = function
+    if filename == '~':
+        # Built in functions, e.g. <method 'recv_into' of '_socket.socket' objects>, without the addresses some of them
+        # have so the same function gets the same label in every run
+        return re.sub(r' at 0x[0-9a-f]+', '', name).replace(';', ',')
+    return f"{name} ({os.path.basename(filename)}:{line})".replace(';', ',')
+
+
+def folded_stacks() -> str:
+    """
+    cProfile only knows which function called which, not whole stacks, so the time of a function is shared between
+    the paths leading to it in the same proportions as between its callers. Paths that got less than
+    PROFILE_MIN_SECONDS are left out
+    :return: the profile added up so far as folded stacks, one "caller;callee;... microseconds" line per call path
+    """
+    with PROFILE_LOCK:
+        if PROFILE is None:
+            return ''
+        # function -> (primitive calls, calls, own time, time including callees, callers)
+        stats: dict = dict(PROFILE.stats)
+
+    callees: dict[tuple, dict[tuple, float]] = {}
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, {})[function] = caller_stats[3]
+
+    lines: list[str] = []
+
+    def walk(function: tuple, path: list[str], on_path: set, seconds: float):
+        own_seconds, total_seconds = stats[function][2], stats[function][3]
+        share: float = min(seconds / total_seconds, 1.0) if total_seconds else 0.0
+        path.append(frame_label(function))
+        on_path.add(function)
+
+        if own_seconds * share >= PROFILE_MIN_SECONDS:
+            lines.append(f"{';'.join(path)} {round(own_seconds * share * 1_000_000)}")
+        for callee, callee_seconds in callees.get(function, {}).items():
+            if callee not in on_path and callee in stats and callee_seconds * share >= PROFILE_MIN_SECONDS:
+                walk(callee, path, on_path, callee_seconds * share)
+
+        path.pop()
+        on_path.discard(function)
+
+    for function, (_, _, _, total_seconds, callers) in stats.items():
+        if not any(caller in stats for caller in callers):
+            walk(function, [], set(), total_seconds)
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def dump(directory: Path = TRACES_DIRECTORY) -> list[Path]:
+    """
+    Writes the spans (spans-<time>.json), and the profile if one has been taken, as folded stacks
+    (profile-<time>.folded) and as a pstats file (profile-<time>.prof)
+    :param directory:
+    :return: the files written
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp: str = time.strftime('%Y%m%d-%H%M%S')
+
+    spans_path: Path = directory / f"spans-{stamp}.json"
+    spans_path.write_text(json.dumps(chrome_trace()))
+    written: list[Path] = [spans_path]
+
+    folded: str = folded_stacks()
+    if folded:
+        folded_path: Path = directory / f"profile-{stamp}.folded"
+        folded_path.write_text(folded)
+        written.append(folded_path)
+
+        profile_path: Path = directory / f"profile-{stamp}.prof"
+        with PROFILE_LOCK:
+            PROFILE.dump_stats(profile_path)
+        written.append(profile_path)
+    return written
@@ -1,20 +1,24 @@
 # noinspection PyUnresolvedReferences
-from Constants import (DOWNLOAD_FOLDER_TIMEOUT,
-                       BUFFER_SIZE)
+from Constants import DOWNLOAD_FOLDER_TIMEOUT
 # noinspection PyUnresolvedReferences
 from Helper_Functions import File_Functions as FF
-
-import hashlib
-import socket
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Metrics_Functions as MT
+# noinspection PyUnresolvedReferences
+from Helper_Functions import Tracing_Functions as TR
+# noinspection PyUnresolvedReferences
+from Classes.SwarmDownload import SwarmDownload
 
 
-def create_connection_socket() -> socket.socket:
+def create_connection_socket(addr: tuple[str, int], timeout: float | None):
     """
-    This returns a socket for the user client to use
+    This returns a connected socket for the user client to use for one request. It is a stream on the persistent
+    connection to the peer at addr
+    :param addr:
+    :param timeout:
     :return:
     """
-    user_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    return user_socket
+    return FF.open_peer_stream(addr, timeout)
 
 
 def first_user_wait():
@@ -61,26 +65,192 @@ def display_available_peers(peer_list):
     return
 
 
-def display_and_download_file(file_list: list):
+def display_transfer_stats(peer_list):
+    """
+    Prints what this user has measured (see display_stats), then lets the user see what another peer has measured
+    :param peer_list:
+    :return:
+    """
+    display_stats(MT.node_stats())
+
+    while peer_list:
+        for counter, peer in enumerate(peer_list, 1):
+            print(f"{counter}. {peer}")
+        user_choice: str = input("Select the number of a peer to see its statistics or press . to go back: ")
+        print()
+        if user_choice == '.':
+            return
+        if not user_choice.isdigit() or not 0 < int(user_choice) <= len(peer_list):
+            print("Please enter a valid input.\n")
+            continue
+
+        peer = peer_list[int(user_choice) - 1]
+        try:
+            display_stats(FF.request_stats(peer.addr, DOWNLOAD_FOLDER_TIMEOUT))
+        except (OSError, ValueError) as e:
+            print(f"[Error] {peer} could not send its statistics: {e}\n")
+
+    userPressesPeriod()
+
+
+def display_stats(stats: dict):
+    """
+    Prints the requests served and made, how long they took and how much they moved, how long the shared lists were
+    locked, the SyncFile updates waiting to be sent, and how much compression saved on what was sent and the CPU time
+    it cost
+    :param stats: from Metrics_Functions.node_stats
+    :return:
+    """
+    if not any(stats['requests'].values()):
+        print("No requests have been served or made yet")
+
+    for side, requests in stats['requests'].items():
+        for name, metrics in requests.items():
+            problems: str = ", ".join(f"{count} {outcome}" for outcome, count in sorted(metrics['outcomes'].items())
+                                      if outcome != MT.OK)
+            print(f"{side} {name}: {metrics['count']} requests{f' ({problems})' if problems else ''}, "
+                  f"p50 {metrics['p50_seconds'] * 1000:.1f} ms, p99 {metrics['p99_seconds'] * 1000:.1f} ms, "
+                  f"{metrics['bytes_received']} bytes received, {metrics['bytes_sent']} sent, "
+                  f"{metrics['bytes_per_second'] / 1024 ** 2:.2f} MiB/s")
+
+    # Peers from before lock metrics don't send them
+    for name, metrics in stats.get('locks', {}).items():
+        print(f"{name} lock: taken {metrics['acquisitions']} times ({metrics['contended']} had to wait, "
+              f"{metrics['max_wait_seconds'] * 1000:.1f} ms at most), "
+              f"held p50 {metrics['p50_hold_seconds'] * 1000:.1f} ms, p99 {metrics['p99_hold_seconds'] * 1000:.1f} ms, "
+              f"max {metrics['max_hold_seconds'] * 1000:.1f} ms")
+
+    # Peers from before the update queue don't send it
+    if 'sync_updates' in stats:
+        sync_updates: dict = stats['sync_updates']
+        waiting: str = ", ".join(f"{depth} for {peer}" for peer, depth in sorted(sync_updates['queue_depth'].items()))
+        print(f"SyncFile updates: {sync_updates['sent']} sent, {sync_updates['coalesced']} replaced by a newer save, "
+              f"{sync_updates['retried']} tried again, {sync_updates['failed']} given up on, "
+              f"{sync_updates['sending']} being sent{f', waiting: {waiting}' if waiting else ''}")
+
+    if not stats['compression']:
+        print("Nothing has been sent to a peer that agreed on compression yet")
+
+    for algorithm, algorithm_stats in sorted(stats['compression'].items()):
+        print(f"{algorithm}: {algorithm_stats['transfers']} transfers, {algorithm_stats['bytes']} bytes sent as "
+              f"{algorithm_stats['sent_bytes']} ({algorithm_stats['ratio']:.1%}), "
+              f"{algorithm_stats['cpu_seconds']:.3f} CPU seconds")
+    print()
+
+
+def change_upload_limits():
+    """
+    Shows the upload limits and lets the user change them while the program runs
+    :return:
+    """
+    limits: dict = FF.UPLOAD_SCHEDULER.limits()
+    print(f"All uploads: {describe_rate(limits['upload_rate'])}\n"
+          f"Uploads to each peer: {describe_rate(limits['peer_upload_rate'])}")
+    for host, weight in sorted(limits['peer_weights'].items()):
+        print(f"{host} gets {weight} shares")
+    print()
+
+    upload_rate: float | None = ask_rate("New limit for all uploads in KiB/s (0 for none) or press enter to keep it: ")
+    peer_upload_rate: float | None = ask_rate("New limit for the uploads to each peer in KiB/s (0 for none) "
+                                              "or press enter to keep it: ")
+    FF.UPLOAD_SCHEDULER.configure(upload_rate, peer_upload_rate)
+    print("The upload limits have been changed\n")
+
+
+def change_tracing():
+    """
+    Shows whether requests are traced and profiled, lets the user change it while the program runs and writes what has
+    been traced so far to the Traces folder
+    :return:
+    """
+    while True:
+        stats: dict = TR.tracing_stats()
+        print(f"Tracing is {'on' if stats['tracing'] else 'off'}, {stats['profile_sample_rate']:.0%} of requests are "
+              f"profiled\n"
+              f"{stats['spans']} spans and {stats['profiled_requests']} profiled requests have been kept\n")
+        print("1. Turn tracing " + ("off" if stats['tracing'] else "on") + "\n"
+              "2. Change the share of requests profiled\n"
+              "3. Write the spans and the profile to the Traces folder\n"
+              "4. Forget the spans and the profile\n"
+              "Press . to go back")
+        user_choice: str = input()
+        print()
+
+        match user_choice:
+            case '.':
+                return
+            case '1':
+                TR.configure(tracing=not stats['tracing'])
+            case '2':
+                user_input: str = input("Percentage of requests to profile (0 to 100): ").strip()
+                try:
+                    percentage: float = float(user_input)
+                except ValueError:
+                    percentage = -1
+                if 0 <= percentage <= 100:
+                    TR.configure(profile_sample_rate=percentage / 100)
+                else:
+                    print("Please enter a valid input.\n")
+            case '3':
+                try:
+                    for path in TR.dump():
+                        print(f"Written {path}")
+                    print()
+                except OSError as e:
+                    print(f"[Error] The traces could not be written: {e}\n")
+            case '4':
+                TR.reset()
+            case _:
+                print("Please enter a valid input.\n")
+
+
+def describe_rate(rate: float) -> str:
+    return f"{rate / 1024:g} KiB/s" if rate else "no limit"
+
+
+def ask_rate(prompt: str) -> float | None:
+    """
+    :param prompt:
+    :return: the rate the user entered in bytes a second, None if they didn't enter one
+    """
+    while True:
+        user_input: str = input(prompt).strip()
+        if not user_input:
+            return None
+        try:
+            rate: float = float(user_input)
+        except ValueError:
+            rate = -1
+        if rate >= 0:
+            return rate * 1024
+        print("Please enter a valid input.\n")
+
+
+def display_and_download_file(file_catalog):
     """
     This will display the available files for the user to download and pass the user's selection to the download file
-    function
-    :param file_list:
+    function. A file owned by more than one peer is listed once and downloaded from all of its owners at the same time
+    :param file_catalog:
     :return:
     """
 
-    if not file_list:
+    if not file_catalog:
         print("No files available to download.\n")
 
+    # Every owner of the same file can be used as a source
+    file_choices: list[list] = [sources for filename in file_catalog.filenames()
+                                if (sources := file_catalog.with_filename(filename))]
+
     counter: int = 1
-    for file in file_list:
-        print(f"|{counter}. Name: {file.filename}\n"
-              f"|   Owner:{file.username if file.username else 'No Owner'}")
+    for sources in file_choices:
+        owners: str = ", ".join(file.username if file.username else 'No Owner' for file in sources)
+        print(f"|{counter}. Name: {sources[0].filename}\n"
+              f"|   Owner:{owners}")
 
         counter += 1
     print()
 
-    user_file_choice = None  # File object
+    user_file_choice = None  # List of File objects with the same name
 
     while True:
         user_choice: str | int = input("Select the number of the file you would like to download "
@@ -89,17 +259,23 @@ def display_and_download_file(file_list: list):
         if user_choice.isdigit():
             # Allow user_choice to be used as an index
             user_choice = int(user_choice) - 1
-            if 0 <= user_choice < len(file_list):
-                user_file_choice = file_list[user_choice]
+            if 0 <= user_choice < len(file_choices):
+                user_file_choice = file_choices[user_choice]
                 break
         elif user_choice == '.':
             return  # Return because the user wishes to go back to menu
 
         print("Please enter a valid input.\n")
 
-    server_address = user_file_choice.addr
+    if len(user_file_choice) > 1:
+        print(f"Downloading from {len(user_file_choice)} peers...")
+        if not SwarmDownload(user_file_choice).run():
+            return
+    else:
+        server_address = user_file_choice[0].addr
 
-    FF.download_file(user_file_choice, server_address)
+        if not FF.download_file(user_file_choice[0], server_address):
+            return
     print("File successfully downloaded!")
 
 
@@ -109,7 +285,8 @@ def display_and_subscribe_sync_file(available_sync_files, subscribed_available_f
         userPressesPeriod()
         return
 
-    for idx, file in enumerate(available_sync_files, start=1):
+    sync_file_choices: list = list(available_sync_files)
+    for idx, file in enumerate(sync_file_choices, start=1):
         print(f"|{idx}. File name: {file.filename}")
         print(f"|   Users Subscribed:")
         for user in file.users_subbed:
@@ -123,8 +300,8 @@ def display_and_subscribe_sync_file(available_sync_files, subscribed_available_f
         print()
         if user_choice.isdigit():
             user_choice = int(user_choice) - 1
-            if 0 <= user_choice < len(available_sync_files):
-                user_sync_file_choice = available_sync_files[user_choice]
+            if 0 <= user_choice < len(sync_file_choices):
+                user_sync_file_choice = sync_file_choices[user_choice]
                 break
         elif user_choice == '.':
             return
@@ -135,20 +312,17 @@ def display_and_subscribe_sync_file(available_sync_files, subscribed_available_f
     """
     user_addr = user_sync_file_choice.users_subbed[0].addr
     FF.subscribe_to_file(user_sync_file_choice, user_as_peer, user_addr)
-    available_sync_files.remove(user_sync_file_choice)
-    subscribed_available_files.append(user_sync_file_choice)
+    available_sync_files.discard(user_sync_file_choice)
+    subscribed_available_files.add(user_sync_file_choice)
     print("Sync File successfully downloaded!")
 
 
 def get_sync_file_hash(file_path) -> str:
-    hasher: hash = hashlib.md5()
-    with open(file_path, 'rb') as file:
-        while True:
-            data = file.read(BUFFER_SIZE)
-            if not data:
-                break
-            hasher.update(data)
-    return hasher.hexdigest()
+    """
+    :param file_path:
+    :return: the hash of the file's contents, only read again if the file changed since it was last hashed
+    """
+    return FF.SYNC_FILE_HASHES.hash_file(file_path)
 
 
 def sync_file_has_updated(file_path, previous_hash: str) -> bool:
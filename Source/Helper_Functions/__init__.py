@@ -3,5 +3,8 @@ from .User_Functions import first_user_wait
 from .User_Functions import display_available_peers
 from .User_Functions import display_and_download_file
 from .User_Functions import display_and_subscribe_sync_file
+from .User_Functions import display_transfer_stats
+from .User_Functions import change_upload_limits
+from .User_Functions import change_tracing
 from .User_Functions import get_sync_file_hash
 from .User_Functions import sync_file_has_updated
@@ -0,0 +1,95 @@
+"""
+Checks that refresh_catalog brings the catalog of a client up to date with the catalog a peer serves, whether the
+peer sends the changes or its whole catalog. The request is answered straight from the peer's catalog instead of
+over a connection.
+
+Run from the Source folder (the same folder run.py is run from):
+    python -m unittest discover Tests
+"""
+from __future__ import annotations
+
+# noinspection PyUnresolvedReferences
+from Classes import Catalog, ChangeLog, File, Peer, SyncFile
+# noinspection PyUnresolvedReferences
+from Helper_Functions import File_Functions as FF
+
+from pathlib import Path
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+SERVER_ADDRESS: tuple[str, int] = ('127.0.0.1', 50001)
+OTHER_ADDRESS: tuple[str, int] = ('127.0.0.1', 50002)
+
+
+class RefreshCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for patch in (mock.patch.object(FF, 'FILES_DIRECTORY', Path(directory.name)),
+                      mock.patch.object(FF, 'SYNC_FILES_DIRECTORY', Path(directory.name)),
+                      mock.patch.dict(FF.CATALOG_CURSORS, clear=True),
+                      mock.patch.object(FF, 'request_catalog_changes', self.answer)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.served: Catalog = Catalog(change_log=ChangeLog())
+        self.client: Catalog = Catalog(change_log=ChangeLog())
+
+    def answer(self, server_address, request_type, object_class, cursor, timeout) -> tuple:
+        return Catalog.changes_since((self.served,), *cursor)
+
+    def refresh(self, object_class=File):
+        FF.refresh_catalog(SERVER_ADDRESS, object_class, self.client, threading.Lock(), None)
+
+    def test_changed_sync_file_reaches_client(self):
+        subscriber: Peer = Peer(SERVER_ADDRESS, 'server')
+        self.served.add(SyncFile('notes.txt', [subscriber]))
+        self.refresh(SyncFile)
+
+        new_subscriber: Peer = Peer(OTHER_ADDRESS, 'other')
+        self.served.replace(self.served.get('notes.txt').with_user(new_subscriber))
+        self.refresh(SyncFile)
+
+        self.assertEqual(self.client.get('notes.txt').users_subbed, (subscriber, new_subscriber))
+
+    def test_changed_file_reaches_client(self):
+        self.served.add(File('a.bin', 'old name', SERVER_ADDRESS))
+        self.refresh()
+
+        self.served.replace(File('a.bin', 'new name', SERVER_ADDRESS))
+        self.refresh()
+
+        self.assertEqual(self.client.get('a.bin', SERVER_ADDRESS).username, 'new name')
+
+    def test_unchanged_entries_are_not_replaced(self):
+        self.served.add(File('a.bin', 'server', SERVER_ADDRESS))
+        self.refresh()
+        version: int = self.client.change_log.version
+
+        # Another epoch, so the whole catalog is sent again
+        self.served.change_log.epoch += 1
+        self.refresh()
+
+        self.assertEqual(self.client.change_log.version, version)
+
+    def test_whole_catalog_removes_missing_entries(self):
+        self.served.change_log = ChangeLog(length=2)
+        for filename in ('a.bin', 'b.bin'):
+            self.served.add(File(filename, 'server', SERVER_ADDRESS))
+        self.client.add(File('c.bin', 'other', OTHER_ADDRESS))
+        self.refresh()
+
+        # More changes than the log keeps, so the whole catalog is sent
+        self.served.remove(File('a.bin', 'server', SERVER_ADDRESS))
+        for filename in ('d.bin', 'e.bin'):
+            self.served.add(File(filename, 'server', SERVER_ADDRESS))
+        self.refresh()
+
+        self.assertEqual(sorted(self.client.filenames()), ['b.bin', 'c.bin', 'd.bin', 'e.bin'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,29 +2,40 @@ from __future__ import annotations
 
 import time
 
-from Classes import (File,
+from Classes import (AsyncServer,
+                     Catalog,
+                     ChangeLog,
+                     DirectoryWatcher,
+                     File,
+                     MeteredLock,
                      Peer,
                      Server,
                      SyncFile,
+                     WorkerPool,
                      )
 from Classes.CRequest import CRequest
 from Constants import (C_REQUEST_BYTE_LENGTH,
-                       FIXED_LENGTH_HEADER,
                        INITIAL_CONNECTION_TIMEOUT,
+                       GOSSIP_INTERVAL,
                        DISPLAYED_USER_OPTIONS,)
 
 from Helper_Functions import (create_connection_socket,
                               display_available_peers,
                               first_user_wait,
                               File_Functions as FF,
+                              Fan_Out_Functions as FO,
+                              Metrics_Functions as MT,
+                              Tracing_Functions as TR,
                               display_and_download_file,
                               display_and_subscribe_sync_file,
-                              get_sync_file_hash,
-                              sync_file_has_updated)
+                              display_transfer_stats,
+                              change_upload_limits,
+                              change_tracing,
+                              get_sync_file_hash)
 
-import json
 import os
 from pathlib import Path
+import random
 import socket
 import threading
 
@@ -35,6 +46,23 @@ G_USER_IP: str = '10.42.27.127'
 G_USER_PORT: int = 59878  # By default 59878
 G_USER_USERNAME: str = 'MarshMellow' #MarshMellow. Testing to see if username is causing problems
 G_MAX_CONNECTIONS: int = 10  # The amount of connections a server listens to at once
+G_SERVER_ENGINE: str = 'threads'  # 'threads' serves connections from a pool of threads, 'asyncio' on one event loop
+G_WORKER_THREADS: int = 16  # The amount of requests the 'threads' engine serves at once
+G_REQUEST_QUEUE_LIMIT: int = 64  # Requests waiting for a worker, clients past this are told the server is Busy
+# The most requests of a type served at once (for either engine), so a burst of downloads can't take every worker
+G_REQUEST_LIMITS: dict[str, int] = {CRequest.DownloadFile.name: 4,
+                                    CRequest.DownloadFileRange.name: 8,
+                                    CRequest.SubscribeFile.name: 4,
+                                    CRequest.SyncFileUpdate.name: 8}
+G_AUTO_PUBLISH_SYNC_FILES: bool = False  # Send changes to SyncFiles without waiting for option 4
+G_SYNC_PUBLISH_DELAY: float = 2  # Seconds a changed SyncFile is left alone before it is sent automatically
+G_UPLOAD_RATE: float = 0  # Bytes a second this user uploads in total, 0 for no limit (option 6 changes it later)
+G_PEER_UPLOAD_RATE: float = 0  # Bytes a second this user uploads to any one peer, 0 for no limit
+# How many shares of the uplink a peer (by IP address) gets when it is limited, peers left out get 1
+G_PEER_UPLOAD_WEIGHTS: dict[str, int] = {}
+G_METRICS_PORT: int = 0  # Serves this peer's request metrics as text on http://127.0.0.1:<port>/, 0 to not serve them
+G_TRACING: bool = False  # Keep a span of every request (option 7 turns it on and off later)
+G_PROFILE_SAMPLE_RATE: float = 0  # The share of requests (0 to 1) run under cProfile while tracing
 
 """
 The server you wish to initially connect to
@@ -54,16 +82,18 @@ g_user_save_sync_file: bool = False
 # ----------------------
 
 g_peer_list: list[Peer] = []  # A list of peers currently connected to the P2P network
-PEER_LIST_LOCK: threading.Lock = threading.Lock()
+# The locks report how long they are waited for and held with the request metrics (option 5)
+PEER_LIST_LOCK: MeteredLock = MT.metered_lock('peer_list')
 
-g_available_files: list[File] = []  # A list of files available to download
-FILE_LOCK: threading.Lock = threading.Lock()
+g_available_files: Catalog = Catalog(change_log=ChangeLog())  # The files available to download, from every owner
+FILE_LOCK: MeteredLock = MT.metered_lock('files')
 
 # Files that are available to subscribe to. Does not include files currently subscribed to
-g_available_sync_files: list[SyncFile] = []
-SYNC_FILE_LOCK: threading.Lock = threading.Lock()
+g_available_sync_files: Catalog = Catalog(change_log=ChangeLog())
+SYNC_FILE_LOCK: MeteredLock = MT.metered_lock('sync_files')
 
-g_subscribed_sync_files: list[SyncFile] = []  # A list of SyncFiles currently subscribed to
+# The SyncFiles currently subscribed to, sent along with the available ones so they share a change log
+g_subscribed_sync_files: Catalog = Catalog(change_log=g_available_sync_files.change_log)
 
 
 def main():
@@ -79,6 +109,13 @@ def main():
     file_sync_thread: threading.Thread() = threading.Thread(target=check_sync_file_updates, daemon=True)
     file_sync_thread.start()
 
+    gossip_thread: threading.Thread = threading.Thread(target=exchange_peer_lists, daemon=True)
+    gossip_thread.start()
+
+    # Chunks the local files ahead of the first download, later refreshes only look at files that changed
+    chunk_index_thread: threading.Thread = threading.Thread(target=FF.CHUNK_INDEX.refresh, daemon=True)
+    chunk_index_thread.start()
+
     peer_thread: threading.Thread = threading.Thread(target=run_peer, daemon=True)
     peer_thread.start()
 
@@ -96,139 +133,116 @@ def initial_connection():
         Available Non-sync files
         Available Sync files
 
-    The server handles one connection at a time so ensure tcp sockets are opened and closed accordingly
+    Every request is a stream on the persistent connection to that peer, so only the first request to each peer pays
+    for a TCP connection
     :return:
     """
     first_user_wait()
 
-    user_socket: socket.socket = create_connection_socket()
-
-    with user_socket:
-
-        # First connection for AddMe
-        user_socket = create_connection_socket()
-        with user_socket:
-            try:
-                user_socket.settimeout(15)
-                user_socket.connect((g_server_ip, g_server_port))
-
-                user_as_peer = Peer((G_USER_IP, G_USER_PORT), G_USER_USERNAME)
-                # Automatically OK's
-                FF.send_peer_with_request(user_socket, user_as_peer, CRequest.AddMe)
-            except TimeoutError as err:
-                print(err)
-                print("Double check that you have the correct server address")
-                print("Try pinging the address first using your terminal. "
-                      "If the ping has dropped packets, you have a different problem.")
-                return
-
-        # Second connection for RequestPeerList
-        user_socket = create_connection_socket()
-        with user_socket:
-            try:
-                user_socket.settimeout(INITIAL_CONNECTION_TIMEOUT)
-                user_socket.connect((g_server_ip, g_server_port))
-
-                FF.send_request(user_socket, CRequest.RequestPeerList)
-
-                # Receive peer list
-                FF.receive_Ok(user_socket)
-                length_bytes = user_socket.recv(FIXED_LENGTH_HEADER)
-
-                received_data = FF.receive_data(user_socket, length_bytes)
-
-
-                json_peer_list = received_data.decode('utf-8')
-                dict_peer_list = json.loads(json_peer_list)
-                peer_list = [Peer.from_dict(peer_dict) for peer_dict in dict_peer_list]
-
-                with PEER_LIST_LOCK:
-                    for peer in peer_list:
-                        if peer != user_as_peer and peer not in g_peer_list:
-                            g_peer_list.append(peer)
-
-            except TimeoutError as err:
-                print(err)
-                return
-
-        # Request list of available Files
-        with FILE_LOCK:
-            with create_connection_socket() as user_socket:
-                try:
-                    user_socket.settimeout(INITIAL_CONNECTION_TIMEOUT)
-                    user_socket.connect(peer.addr)
-
-                    FF.send_request(user_socket, CRequest.RequestFiles)
+    # First connection for AddMe
+    try:
+        with create_connection_socket((g_server_ip, g_server_port), 15) as user_socket:
+            user_as_peer = Peer((G_USER_IP, G_USER_PORT), G_USER_USERNAME)
+            # Automatically OK's
+            FF.send_peer_with_request(user_socket, user_as_peer, CRequest.AddMe)
+    except TimeoutError as err:
+        print(err)
+        print("Double check that you have the correct server address")
+        print("Try pinging the address first using your terminal. "
+              "If the ping has dropped packets, you have a different problem.")
+        return
 
-                    FF.receive_Ok(user_socket)
+    # Second connection for RequestPeerList
+    try:
+        peer_list: list[Peer] = FF.request_peer_list((g_server_ip, g_server_port), INITIAL_CONNECTION_TIMEOUT)
+        add_peers(peer_list)
+        # The server adds itself at the end of its list
+        peer: Peer = peer_list[-1]
 
-                    FF.receive_files(user_socket, g_available_files)
+    except TimeoutError as err:
+        print(err)
+        return
 
-                except TimeoutError:
-                    pass
+    # Request list of available Files
+    try:
+        FF.refresh_catalog(peer.addr, File, g_available_files, FILE_LOCK, INITIAL_CONNECTION_TIMEOUT)
+    except TimeoutError:
+        pass
 
-        user_file_objects: list[File] = get_current_files()
-        # Send user available files to all peers in the network
-        with FILE_LOCK:
-            # Send the file list to each peer in the network
-            for peer in g_peer_list:
-                with create_connection_socket() as user_socket:
-                    try:
-                        user_socket.settimeout(INITIAL_CONNECTION_TIMEOUT)
-                        user_socket.connect(peer.addr)
+    user_file_objects: list[File] = get_current_files()
+    user_sync_file_objects: list[SyncFile] = get_current_sync_files()
 
-                        FF.send_request(user_socket, CRequest.SendFiles)
+    def exchange_files(peer: Peer):
+        """
+        Sends this user's files and SyncFiles to the peer and asks for its SyncFiles. The SyncFiles are asked for
+        before sending ours, since the server will not have updated its available sync files yet
+        """
+        with create_connection_socket(peer.addr, INITIAL_CONNECTION_TIMEOUT) as user_socket, \
+                MT.measure(MT.CLIENT, CRequest.SendFiles, user_socket):
+            FF.send_request(user_socket, CRequest.SendFiles)
 
-                        FF.receive_Ok(user_socket)
+            FF.receive_Ok(user_socket)
 
-                        FF.send_file_list(user_socket, user_file_objects)
+            FF.send_file_list(user_socket, user_file_objects)
 
-                    except TimeoutError:
-                        pass
-                    except Exception as e:
-                        print(f"[Error] Failed to send to {peer.addr}: {e}")
+        FF.refresh_catalog(peer.addr, SyncFile, g_available_sync_files, SYNC_FILE_LOCK, INITIAL_CONNECTION_TIMEOUT)
 
-        with SYNC_FILE_LOCK:
-            """
-            In the initial two connections the server will not have updated its available sync files
-            """
-            for peer in g_peer_list:
-                with create_connection_socket() as user_socket:
-                    try:
-                        user_socket.settimeout(INITIAL_CONNECTION_TIMEOUT)
-                        user_socket.connect(peer.addr)
+        with create_connection_socket(peer.addr, INITIAL_CONNECTION_TIMEOUT) as user_socket, \
+                MT.measure(MT.CLIENT, CRequest.SendSyncFiles, user_socket):
+            FF.send_request(user_socket, CRequest.SendSyncFiles)
 
-                        FF.send_request(user_socket, CRequest.RequestSyncFiles)
+            FF.receive_Ok(user_socket)
 
-                        FF.receive_Ok(user_socket)
+            # This should send list of SyncFile objects from SyncFile directory
+            FF.send_sync_file_list(user_socket, user_sync_file_objects)
 
-                        FF.receive_sync_files(user_socket, g_available_sync_files)
+    # Every peer in the network is contacted at the same time
+    with PEER_LIST_LOCK:
+        current_peers: list[Peer] = list(g_peer_list)
+    results: dict[tuple[str, int], object] = FO.fan_out(current_peers, exchange_files, 3 * INITIAL_CONNECTION_TIMEOUT)
+    FO.report_failures(results, "exchange files with")
 
-                    except TimeoutError:
-                        pass
-                    except Exception as e:
-                        print(f"[Error] Failed to send to {peer.addr}: {e}")
 
-        user_sync_file_objects: list[SyncFile] = get_current_sync_files()
+def add_peers(peer_list: list[Peer]):
+    """
+    Adds the peers in peer_list that aren't in g_peer_list yet
+    :param peer_list:
+    :return:
+    """
+    user_as_peer: Peer = Peer((G_USER_IP, G_USER_PORT), G_USER_USERNAME)
 
-        with SYNC_FILE_LOCK:
-            for peer in g_peer_list:
-                with create_connection_socket() as user_socket:
-                    try:
-                        user_socket.settimeout(INITIAL_CONNECTION_TIMEOUT)
-                        user_socket.connect(peer.addr)
+    with PEER_LIST_LOCK:
+        known_peers: set[Peer] = set(g_peer_list)
+        known_peers.add(user_as_peer)
+        for peer in peer_list:
+            if peer not in known_peers:
+                known_peers.add(peer)
+                g_peer_list.append(peer)
 
-                        FF.send_request(user_socket, CRequest.SendSyncFiles)
 
-                        FF.receive_Ok(user_socket)
+def exchange_peer_lists():
+    """
+    News of new users is gossiped, so now and then it may not reach this user. Every GOSSIP_INTERVAL seconds this asks
+    a random peer for its peer list and adds whoever is missing, so every peer list ends up complete. The files and
+    SyncFiles that changed on that peer since the last time it was asked are picked up at the same time
+    :return:
+    """
+    while not g_endprogram:
+        time.sleep(GOSSIP_INTERVAL)
 
-                        # This should send list of SyncFile objects from SyncFile directory
-                        FF.send_sync_file_list(user_socket, user_sync_file_objects)
+        with PEER_LIST_LOCK:
+            current_peers: list[Peer] = list(g_peer_list)
+        if not current_peers:
+            continue
 
-                    except TimeoutError:
-                        pass
-                    except Exception as e:
-                        print(f"[Error] Failed to send to {peer.addr}: {e}")
+        peer: Peer = random.choice(current_peers)
+        try:
+            add_peers(FF.request_peer_list(peer.addr, INITIAL_CONNECTION_TIMEOUT))
+            FF.refresh_catalog(peer.addr, File, g_available_files, FILE_LOCK, INITIAL_CONNECTION_TIMEOUT)
+            FF.refresh_catalog(peer.addr, SyncFile, g_available_sync_files, SYNC_FILE_LOCK, INITIAL_CONNECTION_TIMEOUT)
+        except (OSError, ValueError):
+            # The next round asks another peer
+            pass
 
 
 def run_peer():
@@ -253,6 +267,9 @@ def run_peer():
                   "2. Download Available File\n"
                   "3. List files available for subscription (file syncing service)\n"
                   "4. Save Subscribed File (Click this if you've edited a file in FilesForSync)\n"
+                  "5. View Transfer Statistics\n"
+                  "6. Change Upload Limits\n"
+                  "7. Tracing and Profiling\n"
                   "Press . to exit")
             user_option = input()
             print()
@@ -277,7 +294,11 @@ def run_peer():
                 case 4:
                     g_user_save_sync_file = True
                 case 5:
-                    pass
+                    display_transfer_stats(g_peer_list)
+                case 6:
+                    change_upload_limits()
+                case 7:
+                    change_tracing()
                 case _:
                     raise ValueError("Please enter a valid input")
 
@@ -306,51 +327,69 @@ def run_server():
 
     if current_sync_files:
         for sync_file_name in current_sync_files:
-            g_subscribed_sync_files.append(SyncFile(sync_file_name, [user_as_peer]))
+            g_subscribed_sync_files.add(SyncFile(sync_file_name, [user_as_peer]))
 
     # This adds the user's initial files to the initial file attribute in the server method
-    user_server: Server = Server((G_USER_IP, G_USER_PORT))
+    user_server: Server = AsyncServer((G_USER_IP, G_USER_PORT)) if G_SERVER_ENGINE == 'asyncio' \
+        else Server((G_USER_IP, G_USER_PORT))
     user_server.username = G_USER_USERNAME
+    user_server.set_request_limits(G_REQUEST_LIMITS)
+    FF.UPLOAD_SCHEDULER.configure(G_UPLOAD_RATE, G_PEER_UPLOAD_RATE, G_PEER_UPLOAD_WEIGHTS)
+    TR.configure(G_TRACING, G_PROFILE_SAMPLE_RATE)
+    if G_METRICS_PORT:
+        MT.start_metrics_endpoint(G_METRICS_PORT)
+    # This user's files are sent along with the available ones, so they share a change log
+    user_server.initial_files.change_log = g_available_files.change_log
 
     file_directory_path: Path = Path.cwd() / 'Files'
     current_files: list[str] = FF.list_files_in_directory(file_directory_path)
 
     if current_files:
         for file_name in current_files:
-            user_server.initial_files.append(File(file_name, G_USER_USERNAME, user_server.addr))
+            user_server.initial_files.add(File(file_name, G_USER_USERNAME, user_server.addr))
+
+    request_args: tuple = (g_peer_list,
+                           g_subscribed_sync_files,
+                           g_available_sync_files,
+                           g_available_files,
+                           FILE_LOCK,
+                           SYNC_FILE_LOCK,
+                           PEER_LIST_LOCK,)
 
     with user_server.create_TCP_socket() as listening_socket:
+        if isinstance(user_server, AsyncServer):
+            try:
+                user_server.serve_forever(listening_socket, request_args)
+            except KeyboardInterrupt:
+                print("\nShutting Down Server")
+            finally:
+                listening_socket.close()
+                print("Server socket closed")
+            return
+
         listening_socket.listen(G_MAX_CONNECTIONS)
-        connection_threads: list[threading.Thread] = []
+
+        worker_pool: WorkerPool = WorkerPool(G_WORKER_THREADS, G_REQUEST_QUEUE_LIMIT)
+        worker_pool.start()
+        user_server.worker_pool = worker_pool
 
         try:
             while True:
                 conn, addr = listening_socket.accept()
 
-                thread: threading.Thread = threading.Thread(target=user_server.client_request,
-                                                            args=(conn,
-                                                                  g_peer_list,
-                                                                  g_subscribed_sync_files,
-                                                                  g_available_sync_files,
-                                                                  g_available_files,
-                                                                  FILE_LOCK,
-                                                                  SYNC_FILE_LOCK,
-                                                                  PEER_LIST_LOCK,))
-                connection_threads.append(thread)
-                thread.start()
+                if not worker_pool.submit(user_server.client_request, conn, *request_args):
+                    # Every worker is busy and the queue is full, answer now instead of making the client wait
+                    Server.turn_away(conn)
 
                 # Doesn't happen instantly but g_peer_list DOES update
                 # time.sleep(5)
                 # with PEER_LIST_LOCK:
                 #     print(g_peer_list)
 
-                # Do I need a .join here
-
         except KeyboardInterrupt:
             print("\nShutting Down Server")
         finally:
-            for thread in connection_threads:
-                thread.join()
+            worker_pool.shutdown()
 
             listening_socket.close()
             print("Server socket closed")
@@ -360,72 +399,93 @@ def run_server():
 
 def check_sync_file_updates():
     """
-    Todo:
-    1. You need to add this user to the list of users subscribed
-    2. Remove the subscribed file from avaialable files and add it to subscribed
+    Sends the changes this user makes to SyncFiles to the other subscribers. The SyncFiles folder is watched, so only
+    the files that changed are looked at, and a file is only hashed once it has changed (to skip saves that didn't
+    change anything). The hashes are cached between runs, so at startup only the files that changed since the last
+    run are read.
+
+    Changes are sent when the user asks for it (option 4), or with G_AUTO_PUBLISH_SYNC_FILES once a file has been left
+    alone for G_SYNC_PUBLISH_DELAY seconds, so an editor saving a file a few times in a row only sends it once.
+    Files written with another user's copy are not sent back.
+
+    The updates are sent in the background by FF.SYNC_UPDATE_QUEUE, so a large file or a slow subscriber doesn't stop
+    newer changes from being seen, and a file saved again before its update reached a subscriber is only sent once.
     :return:
     """
     global g_user_save_sync_file
 
-    user_as_peer: Peer = Peer((G_USER_IP,G_USER_PORT), G_USER_USERNAME)
-
-    sync_file_hash: dict[str: str] = {}
+    user_as_peer: Peer = Peer((G_USER_IP, G_USER_PORT), G_USER_USERNAME)
 
     sync_files_dir: Path = Path.cwd() / "SyncFiles"
 
-    sync_file_names: list[str] = FF.list_files_in_directory(sync_files_dir)
+    changed_at: dict[str, float] = {}  # filename -> when it last changed, for changes that haven't been sent yet
+
+    # Backups and unfinished copies are never sent
+    watcher: DirectoryWatcher = DirectoryWatcher(sync_files_dir,
+                                                 ignore=lambda fn: fn.endswith('~') or FF.is_partial_download(fn))
+    with watcher:
+        # Started after the watcher so changes made while hashing aren't missed
+        sync_file_names: set[str] = {fn for fn in FF.local_file_names(sync_files_dir) if not watcher.ignore(fn)}
+        hashes: dict[Path, str] = FF.SYNC_FILE_HASHES.hash_files([sync_files_dir / fn for fn in sync_file_names])
+        # filename -> hash of the copy last sent or received
+        sync_file_hash: dict[str, str] = {path.name: digest for path, digest in hashes.items()}
+        FF.SYNC_FILE_HASHES.forget_missing(sync_files_dir, sync_file_names)
+        FF.SYNC_FILE_HASHES.save()
+
+        while not g_endprogram:
+            for fn in watcher.wait_for_changes(0.5):
+                changed_at[fn] = time.monotonic()
+
+            if g_user_save_sync_file:
+                g_user_save_sync_file = False
+                due: list[str] = list(changed_at)
+            elif G_AUTO_PUBLISH_SYNC_FILES:
+                now: float = time.monotonic()
+                due = [fn for fn, changed in changed_at.items() if now - changed >= G_SYNC_PUBLISH_DELAY]
+            else:
+                continue
+
+            for fn in due:
+                del changed_at[fn]
+                publish_sync_file(fn, sync_files_dir / fn, sync_file_hash, user_as_peer)
+            FF.SYNC_FILE_HASHES.save()
+
+
+def publish_sync_file(fn: str, sync_file_path: Path, sync_file_hash: dict[str, str], user_as_peer: Peer):
+    """
+    Queues the update of the SyncFile for its other subscribers (see FF.SYNC_UPDATE_QUEUE) if its contents changed
+    :param fn:
+    :param sync_file_path:
+    :param sync_file_hash: filename -> hash of the copy last sent or received, which is updated
+    :param user_as_peer:
+    :return:
+    """
+    received_hash: str | None = FF.take_received_sync_file_hash(fn)
+    if received_hash is not None:
+        sync_file_hash[fn] = received_hash
 
-    for fn in sync_file_names:
-        sync_file_hash[fn] = get_sync_file_hash(sync_files_dir / fn)
+    if not sync_file_path.is_file():
+        sync_file_hash.pop(fn, None)
+        return
 
-    while not g_endprogram:
-        """
-        This constantly checks to see what files are currently in the SyncFiles directory
-        """
-        # This prevents backups from being saved
-        sync_file_names: list[str] = [fn for fn in FF.list_files_in_directory(sync_files_dir) if not fn.endswith('~')]
-
-        # This checks to see if any files have been deleted and deletes them if so
-        sync_file_names_to_remove: list[str] = []
-        for fn in sync_file_hash.keys():
-            if fn not in sync_file_names:
-                sync_file_names_to_remove.append(fn)
-        for name in sync_file_names_to_remove:
-            sync_file_hash.pop(name)
-
-        # This checks if a new file has been added and if so, add it to the hash
-        for fn in sync_file_names:
-            if fn not in sync_file_hash.keys():
-                sync_file_hash[fn] = get_sync_file_hash(sync_files_dir / fn)
-
-        if g_user_save_sync_file:
-            for fn in sync_file_names:
-                sync_file_path: Path = sync_files_dir / fn
-
-                # This checks to see if the file has been modified
-                modified: bool = sync_file_has_updated(sync_file_path, sync_file_hash[fn])
-                if modified:
-                    # Update previous hash to current
-                    sync_file_hash[fn] = get_sync_file_hash(sync_file_path)
-
-                    subbed_users: list[Peer] = []
-                    this_sync_file: SyncFile = None
-
-                    for sync_file in g_subscribed_sync_files:
-                        if sync_file.filename == fn:
-                            subbed_users = sync_file.users_subbed
-                            this_sync_file = sync_file
-                            break
-                    subbed_users = [user for user in subbed_users if user != user_as_peer]
-
-                    if subbed_users:
-                        with SYNC_FILE_LOCK:
-                            FF.send_sync_file_update(this_sync_file, subbed_users)
-                    else:
-                        print("No user are subscribed to this file")
-
-        g_user_save_sync_file = False
-        time.sleep(0.5)
+    current_hash: str = get_sync_file_hash(sync_file_path)
+    if current_hash == sync_file_hash.get(fn):
+        return
+    sync_file_hash[fn] = current_hash
+
+    # The subscribers are read while holding the file's lock, so a user who subscribes before the update is queued is
+    # sent it, and one who subscribes after gets the new copy. Updates of other files aren't held up
+    with FF.SYNC_FILE_LOCKS.lock(fn):
+        with SYNC_FILE_LOCK:
+            this_sync_file: SyncFile | None = g_subscribed_sync_files.get(fn)
+        if this_sync_file is None:
+            return
+        subbed_users: list[Peer] = [user for user in this_sync_file.users_subbed if user != user_as_peer]
+
+        if subbed_users:
+            FF.SYNC_UPDATE_QUEUE.put(this_sync_file, subbed_users)
+        else:
+            print("No user are subscribed to this file")
 
 
 def get_current_files() -> list[File] | None:
@@ -437,7 +497,8 @@ def get_current_files() -> list[File] | None:
     current_directory: Path = Path.cwd()
     directory_path: Path = current_directory / "Files"
 
-    file_names: list[str] = [f.name for f in directory_path.iterdir() if f.is_file() if not f.name.endswith('~')]
+    file_names: list[str] = [f.name for f in directory_path.iterdir() if f.is_file() if not f.name.endswith('~')
+                             if not FF.is_partial_download(f.name)]
     if not file_names:
         return
 